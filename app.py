@@ -1,19 +1,43 @@
-from flask import Flask, render_template, request, redirect, url_for, session, send_file, make_response
+from flask import Flask, render_template, request, redirect, url_for, session, send_file, make_response, get_template_attribute
+from flask import before_render_template, template_rendered
 from flask_cors import CORS
 from fpdf import FPDF
+from fpdf.image_parsing import get_img_info
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
-from datetime import datetime, timedelta
-import pandas as pd
+from datetime import datetime, timedelta, timezone
 import io
 import os
 import gspread.utils 
 import json
+import hashlib
+import hmac
+import cProfile
+import random
+import sys
 import time
 import calendar
+import bisect
+import uuid
+import tempfile
+import threading
+import sqlite3
+import re
+import csv
+import gzip
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from copy import copy
+from collections import OrderedDict, Counter
+from functools import lru_cache
+from contextlib import contextmanager
 import requests 
-from openpyxl import load_workbook
-from openpyxl.styles import Font, Border, Side, PatternFill, Alignment
+from werkzeug.security import check_password_hash, generate_password_hash
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, Border, Side, PatternFill, Alignment, NamedStyle
 from openpyxl.utils import get_column_letter
 
 app = Flask(__name__)
@@ -42,37 +66,695 @@ def send_discord_msg(message):
     except Exception as e:
         print(f"Discord Notify Error: {e}")
 
+# ==========================================
+# [Metrics] นับ/จับเวลาการเรียก Google Sheets API ต่อ Route และต่อ Request
+# ==========================================
+# ทุก Request มีตัวนับของตัวเอง (เก็บใน Thread) พอจบ Request ค่อยรวมเข้ายอดรวมของ Process
+# ยอดรวมดูได้ที่ /metrics (Prometheus Text Format) / Request ที่ช้ากว่า SLOW_REQUEST_MS จะ print รายละเอียดลง Log
+# หมายเหตุ: ตัวเลขเป็นของ Process นี้ (รันหลาย Worker ต้องให้ Prometheus รวมเอง)
+SLOW_REQUEST_MS = int(os.environ.get('SLOW_REQUEST_MS', '1000'))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+# Method ของ gspread ที่ยิง API จริง (ตัวที่ไม่อยู่ในนี้ เช่น title/id อ่านจาก Object เฉย ๆ)
+SHEETS_API_METHODS = frozenset([
+    'get_all_records', 'get_all_values', 'row_values', 'col_values', 'cell', 'acell', 'get', 'batch_get',
+    'append_row', 'append_rows', 'batch_update', 'update', 'update_cell', 'update_acell', 'delete_rows', 'insert_row',
+    'worksheet', 'worksheets', 'add_worksheet', 'values_batch_get'
+])
+metrics_lock = threading.Lock()
+metrics_local = threading.local()
+metrics_totals = {
+    'api_calls': Counter(),    # (route, method, worksheet) -> จำนวนครั้ง
+    'api_seconds': Counter(),  # (route, method, worksheet) -> วินาทีรวม
+    'api_errors': Counter(),   # (route, method, status) -> จำนวนครั้ง
+    'cache': Counter(),        # (route, worksheet, result) -> จำนวนครั้ง (hit / miss / stale)
+    'requests': Counter(),     # (route, status) -> จำนวนครั้ง
+    'request_seconds': Counter(),  # route -> วินาทีรวม
+}
+
+def new_request_metrics(route, priority='bulk'):
+    return {'route': route, 'priority': priority, 'api_calls': Counter(), 'api_seconds': Counter(), 'api_errors': Counter(), 'cache': Counter(),
+            'phases': Counter()}
+
+def current_metrics():
+    """ตัวนับของ Request ปัจจุบัน (งานเบื้องหลัง เช่น Replicator / Export Thread นับเป็น Route 'background')"""
+    stats = getattr(metrics_local, 'stats', None)
+    if stats is None:
+        stats = metrics_local.stats = new_request_metrics('background')
+    return stats
+
+def flush_metrics(stats):
+    """รวมตัวนับของ Request เข้ายอดรวมของ Process"""
+    route = stats['route']
+    with metrics_lock:
+        for key in ('api_calls', 'api_seconds', 'api_errors', 'cache'):
+            for labels, value in stats[key].items():
+                metrics_totals[key][(route,) + labels] += value
+
+def release_background_metrics(stats):
+    # งานเบื้องหลังไม่มีจุดจบ Request -> รวมเข้ายอดรวมทันที
+    if stats['route'] == 'background':
+        flush_metrics(stats)
+        metrics_local.stats = None
+
+def record_api_call(method, worksheet, seconds, error_status=None):
+    stats = current_metrics()
+    stats['api_calls'][(method, worksheet)] += 1
+    stats['api_seconds'][(method, worksheet)] += seconds
+    if error_status is not None: stats['api_errors'][(method, str(error_status))] += 1
+    release_background_metrics(stats)
+
+def record_cache_lookup(worksheet, result):
+    stats = current_metrics()
+    stats['cache'][(worksheet, result)] += 1
+    release_background_metrics(stats)
+
+def timed_api_call(func, method, worksheet):
+    def wrapper(*args, **kwargs):
+        nonlocal worksheet
+        if not worksheet and method in ('worksheet', 'add_worksheet'): worksheet = str(args[0] if args else kwargs.get('title', ''))
+        start = time.perf_counter()
+        try:
+            with request_phase('fetch'): result = sheets_limiter.call(func, method, sheets_priority(method), *args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            record_api_call(method, worksheet, time.perf_counter() - start, api_error_status(e) or 'error')
+            raise
+        except SheetsThrottled:
+            record_api_call(method, worksheet, time.perf_counter() - start, 'throttled')
+            raise
+        record_api_call(method, worksheet, time.perf_counter() - start)
+        return instrument_sheets(result)
+    return wrapper
+
+class InstrumentedSheets:
+    """ห่อ Spreadsheet / Worksheet ของ gspread: Method ใน SHEETS_API_METHODS ถูกนับและจับเวลา ที่เหลือส่งต่อตรง ๆ"""
+
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name in SHEETS_API_METHODS and callable(attr):
+            # Spreadsheet (มี .worksheet) ไม่ใส่ชื่อ Worksheet ใน Label
+            title = '' if hasattr(self._target, 'worksheet') else getattr(self._target, 'title', '')
+            return timed_api_call(attr, name, title)
+        return attr
+
+def instrument_sheets(value):
+    if isinstance(value, (gspread.Spreadsheet, gspread.Worksheet)): return InstrumentedSheets(value)
+    if isinstance(value, list) and value and isinstance(value[0], gspread.Worksheet): return [InstrumentedSheets(v) for v in value]
+    return value
+
+@app.before_request
+def start_request_metrics():
+    rule = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    # POST = คนขับ/ผู้จัดการบันทึกข้อมูล -> การอ่านที่ต้องทำก่อนเขียน (เปิด Sheet / หาแถว) ได้ Priority เดียวกับการเขียน
+    # Export / ปิดยอดรายวัน (Cron) = งานเบื้องหลัง
+    if rule.startswith(('/export', '/close_days')): priority = 'bulk'
+    else: priority = 'write' if request.method == 'POST' else 'read'
+    metrics_local.stats = new_request_metrics(rule, priority)
+    metrics_local.started = time.perf_counter()
+    metrics_local.phase = None
+
+@app.after_request
+def finish_request_metrics(response):
+    stats = getattr(metrics_local, 'stats', None)
+    started = getattr(metrics_local, 'started', None)
+    if stats is None or started is None: return response
+    metrics_local.stats = metrics_local.started = None
+    elapsed = time.perf_counter() - started
+    route = stats['route']
+    flush_metrics(stats)
+    with metrics_lock:
+        metrics_totals['requests'][(route, str(response.status_code))] += 1
+        metrics_totals['request_seconds'][route] += elapsed
+
+    api_seconds = sum(stats['api_seconds'].values())
+    api_calls = sum(stats['api_calls'].values())
+    response.headers['Server-Timing'] = (f'sheets;dur={api_seconds * 1000:.1f};desc="{api_calls} calls", '
+                                         f'fetch;dur={stats["phases"]["fetch"] * 1000:.1f}, '
+                                         f'render;dur={stats["phases"]["render"] * 1000:.1f}, total;dur={elapsed * 1000:.1f}')
+    if elapsed * 1000 >= SLOW_REQUEST_MS:
+        print(format_slow_request(request.method, request.full_path.rstrip('?'), response.status_code, elapsed, stats))
+    return response
+
+def format_slow_request(method, path, status, elapsed, stats):
+    """บรรทัด Log ของ Request ที่ช้า: เวลารวม / เวลา Sheets API แยกตาม Method / Cache hit-miss / เวลาที่เหลือ (คำนวณ + Render)"""
+    api_seconds = sum(stats['api_seconds'].values())
+    calls = ', '.join(f"{m}({ws}) x{n} {stats['api_seconds'][(m, ws)] * 1000:.0f}ms"
+                      for (m, ws), n in sorted(stats['api_calls'].items(), key=lambda kv: -stats['api_seconds'][kv[0]]))
+    cache = Counter()
+    for (_, result), n in stats['cache'].items(): cache[result] += n
+    return (f"[Slow Request] {method} {path} -> {status} {elapsed * 1000:.0f}ms | "
+            f"sheets {sum(stats['api_calls'].values())} calls {api_seconds * 1000:.0f}ms [{calls or '-'}] | "
+            f"cache hit {cache['hit']} miss {cache['miss']} stale {cache['stale']} | "
+            f"other {(elapsed - api_seconds) * 1000:.0f}ms")
+
+def prometheus_labels(**labels):
+    def esc(v): return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{esc(v)}"' for k, v in labels.items()) + '}'
+
+def render_prometheus_metrics():
+    with metrics_lock:
+        totals = {k: dict(v) for k, v in metrics_totals.items()}
+    lines = []
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples: lines.append(f"{name}{prometheus_labels(**labels)} {value:g}")
+
+    metric('lmt_sheets_api_calls_total', 'counter', 'Google Sheets API calls',
+           ((dict(route=r, method=m, worksheet=ws), n) for (r, m, ws), n in sorted(totals['api_calls'].items())))
+    metric('lmt_sheets_api_seconds_total', 'counter', 'Time spent in Google Sheets API calls',
+           ((dict(route=r, method=m, worksheet=ws), s) for (r, m, ws), s in sorted(totals['api_seconds'].items())))
+    metric('lmt_sheets_api_errors_total', 'counter', 'Google Sheets API errors by HTTP status',
+           ((dict(route=r, method=m, status=st), n) for (r, m, st), n in sorted(totals['api_errors'].items())))
+    metric('lmt_cache_lookups_total', 'counter', 'get_cached_records lookups (hit, miss, stale = 429 fallback)',
+           ((dict(route=r, worksheet=ws, result=res), n) for (r, ws, res), n in sorted(totals['cache'].items())))
+    metric('lmt_http_requests_total', 'counter', 'HTTP requests by route and status',
+           ((dict(route=r, status=st), n) for (r, st), n in sorted(totals['requests'].items())))
+    metric('lmt_http_request_seconds_total', 'counter', 'Total time spent serving requests by route',
+           ((dict(route=r), s) for r, s in sorted(totals['request_seconds'].items())))
+    limiter = sheets_limiter.snapshot()
+    metric('lmt_sheets_limiter_tokens', 'gauge', 'Tokens left in the Sheets rate limiter bucket', [({}, limiter['tokens'])])
+    metric('lmt_sheets_breaker_open', 'gauge', '1 while reads are served from cache because Google is throttling',
+           [({}, 1 if limiter['breaker_open'] else 0)])
+    metric('lmt_sheets_limiter_wait_seconds_total', 'counter', 'Time spent waiting for a rate limiter token',
+           ((dict(priority=p), s) for p, s in sorted(limiter['wait_seconds'].items())))
+    metric('lmt_sheets_retries_total', 'counter', 'Sheets API calls retried after backoff',
+           ((dict(method=m, status=st), n) for (m, st), n in sorted(limiter['retries'].items())))
+    metric('lmt_sheets_rejected_total', 'counter', 'Sheets API calls not sent (breaker open / quota wait exceeded)',
+           ((dict(priority=p, reason=r), n) for (p, r), n in sorted(limiter['rejected'].items())))
+    return '\n'.join(lines) + '\n'
+
+@app.route('/metrics')
+def metrics():
+    """ตั้ง METRICS_TOKEN แล้วส่งเป็น Bearer Token (สำหรับ Prometheus) / ไม่ตั้ง = เฉพาะผู้จัดการที่ Login อยู่"""
+    if METRICS_TOKEN:
+        token = request.headers.get('Authorization', '').replace('Bearer ', '', 1)
+        if not hmac.compare_digest(token, METRICS_TOKEN): return 'Unauthorized', 401
+    elif 'user' not in session:
+        return 'Unauthorized', 401
+    return render_prometheus_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+# ==========================================
+# [Rate Limit] คุมจังหวะการเรียก Google Sheets API (Token Bucket + Backoff + Circuit Breaker)
+# ==========================================
+# ทุกการเรียกผ่าน InstrumentedSheets ต้องได้ Token ก่อน (เติมตามโควตาต่อนาที) โดยแบ่งลำดับความสำคัญ
+#   write = Request แบบ POST (คนขับบันทึกงาน) และการเขียนทุกชนิด, read = หน้าจอทั่วไป, bulk = Export / งานเบื้องหลัง
+# Priority ต่ำต้องเหลือ Token ไว้ให้ Priority สูงตามสัดส่วน SHEETS_PRIORITY_RESERVE และต้องรอให้คิวที่สูงกว่าได้ก่อน
+# โดน 429 / 5xx -> Retry แบบ Exponential Backoff + Jitter (เคารพ Retry-After)
+# โดน 429 ติดกันหลายครั้ง -> Circuit Breaker เปิด: การอ่านไม่ยิง API แต่ใช้ Cache แทนจนพ้นช่วงพัก (การเขียนยังผ่าน)
+# หมายเหตุ: Bucket เป็นของ Process นี้ รันหลาย Worker ให้ตั้ง SHEETS_QUOTA_PER_MIN เป็นโควตาหารจำนวน Worker
+SHEETS_QUOTA_PER_MIN = int(os.environ.get('SHEETS_QUOTA_PER_MIN', '60'))
+SHEETS_MAX_RETRIES = int(os.environ.get('SHEETS_MAX_RETRIES', '4'))
+SHEETS_MAX_WAIT = float(os.environ.get('SHEETS_MAX_WAIT', '20'))  # รอ Token ได้นานสุด (วินาที)
+SHEETS_BACKOFF_BASE = 1.0
+SHEETS_BACKOFF_CAP = 32.0
+SHEETS_BREAKER_THRESHOLD = 3  # 429 ติดกันกี่ครั้งถึงเปิด Breaker
+SHEETS_BREAKER_COOLDOWN = 30  # วินาที (เปิดซ้ำจะพักนานขึ้นเท่าตัว สูงสุด 8 เท่า)
+SHEETS_PRIORITIES = ('write', 'read', 'bulk')
+SHEETS_PRIORITY_RESERVE = {'write': 0.0, 'read': 0.2, 'bulk': 0.5}
+SHEETS_WRITE_METHODS = frozenset(['append_row', 'append_rows', 'batch_update', 'update', 'update_cell', 'update_acell',
+                                  'delete_rows', 'insert_row', 'add_worksheet'])
+# เรียกซ้ำแล้วผลเปลี่ยน (เพิ่ม/ลบแถว) -> Retry เฉพาะ 429 ที่ Google ยืนยันว่ายังไม่ได้ทำ ไม่ Retry 5xx
+SHEETS_NON_IDEMPOTENT = frozenset(['append_row', 'append_rows', 'delete_rows', 'insert_row', 'add_worksheet'])
+SHEETS_RETRY_STATUS = frozenset([429, 500, 502, 503, 504])
+
+class SheetsThrottled(Exception):
+    """ไม่ได้เรียก API เพราะ Google กำลังจำกัดการใช้งาน (Breaker เปิด / รอ Token นานเกิน)"""
+
+def api_error_status(e):
+    return getattr(getattr(e, 'response', None), 'status_code', None)
+
+def is_sheets_throttle(e):
+    """Error ที่ควรใช้ Cache เดิมแทน (โดนจำกัด / Google ขัดข้องชั่วคราว)"""
+    return isinstance(e, SheetsThrottled) or api_error_status(e) in SHEETS_RETRY_STATUS
+
+class SheetsRateLimiter:
+    def __init__(self, per_minute):
+        self.capacity = max(1, per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.cond = threading.Condition()
+        self.waiting = Counter()
+        self.failures = 0       # 429 ติดกัน
+        self.open_until = 0.0   # Breaker เปิดถึงเวลานี้ (monotonic)
+        self.wait_seconds = Counter()  # priority -> วินาทีที่รอ Token
+        self.retries = Counter()       # (method, status) -> จำนวนครั้งที่ Retry
+        self.rejected = Counter()      # (priority, reason) -> ครั้งที่ไม่ได้ยิง API
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def breaker_open(self):
+        return time.monotonic() < self.open_until
+
+    def snapshot(self):
+        """สถานะ ณ ตอนนี้สำหรับ /metrics (Token ที่เหลือ, Breaker, ตัวนับทั้งหมด) อ่านใน Lock เดียวกัน"""
+        with self.cond:
+            self._refill(time.monotonic())
+            return {'tokens': self.tokens, 'breaker_open': self.breaker_open(), 'wait_seconds': dict(self.wait_seconds),
+                    'retries': dict(self.retries), 'rejected': dict(self.rejected)}
+
+    def acquire(self, priority):
+        """รอ Token (write > read > bulk) -> raise SheetsThrottled ถ้ารอเกิน SHEETS_MAX_WAIT"""
+        reserve = self.capacity * SHEETS_PRIORITY_RESERVE[priority]
+        higher = SHEETS_PRIORITIES[:SHEETS_PRIORITIES.index(priority)]
+        start = time.monotonic()
+        with self.cond:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if self.tokens - 1 >= reserve and not any(self.waiting[p] for p in higher):
+                        self.tokens -= 1
+                        self.wait_seconds[priority] += now - start
+                        return
+                    if now - start >= SHEETS_MAX_WAIT:
+                        self.wait_seconds[priority] += now - start
+                        self.rejected[(priority, 'quota')] += 1
+                        raise SheetsThrottled('โควตา Google Sheets เต็ม กรุณาลองใหม่ภายหลัง')
+                    need = (reserve + 1 - self.tokens) / self.rate
+                    self.cond.wait(min(max(need, 0.01), SHEETS_MAX_WAIT - (now - start)))
+            finally:
+                self.waiting[priority] -= 1
+                self.cond.notify_all()
+
+    def record_throttle(self):
+        with self.cond:
+            self.failures += 1
+            # ตัด Token ที่เหลือให้เหลือเฉพาะส่วนสำรองของการเขียน: อ่าน/Export ชะลอทันที คนขับยังบันทึกได้
+            self.tokens = min(self.tokens, self.capacity * SHEETS_PRIORITY_RESERVE['read'])
+            if self.failures >= SHEETS_BREAKER_THRESHOLD:
+                factor = 2 ** min(self.failures - SHEETS_BREAKER_THRESHOLD, 3)
+                self.open_until = time.monotonic() + SHEETS_BREAKER_COOLDOWN * factor
+
+    def record_success(self):
+        if self.failures:
+            with self.cond:
+                self.failures = 0
+                self.open_until = 0.0
+
+    def backoff(self, attempt, error):
+        """Full Jitter: สุ่ม 0..min(cap, base*2^attempt) แต่ไม่น้อยกว่า Retry-After ที่ Google ส่งมา"""
+        delay = random.uniform(0, min(SHEETS_BACKOFF_CAP, SHEETS_BACKOFF_BASE * 2 ** attempt))
+        try: retry_after = float(error.response.headers.get('Retry-After', 0))
+        except (AttributeError, TypeError, ValueError): retry_after = 0
+        return max(delay, min(retry_after, SHEETS_BACKOFF_CAP))
+
+    def call(self, func, method, priority, *args, **kwargs):
+        # Breaker เปิด: อ่านไม่ยิง API (ผู้เรียกใช้ Cache) / เขียนยังลองได้ และเป็นตัวทดสอบว่า Google หายจำกัดหรือยัง
+        if priority != 'write' and self.breaker_open():
+            with self.cond: self.rejected[(priority, 'breaker')] += 1
+            raise SheetsThrottled('Google Sheets จำกัดการใช้งานชั่วคราว')
+        for attempt in range(SHEETS_MAX_RETRIES + 1):
+            self.acquire(priority)
+            try:
+                result = func(*args, **kwargs)
+            except gspread.exceptions.APIError as e:
+                status = api_error_status(e)
+                if status == 429: self.record_throttle()
+                retryable = status == 429 or (status in SHEETS_RETRY_STATUS and method not in SHEETS_NON_IDEMPOTENT)
+                if not retryable or attempt == SHEETS_MAX_RETRIES: raise
+                if priority != 'write' and self.breaker_open(): raise
+                with self.cond: self.retries[(method, str(status))] += 1
+                time.sleep(self.backoff(attempt, e))
+                continue
+            self.record_success()
+            return result
+
+sheets_limiter = SheetsRateLimiter(SHEETS_QUOTA_PER_MIN)
+
+def sheets_priority(method):
+    """Method ที่เขียน = write / อย่างอื่นใช้ Priority ของ Request (POST = write, Export/เบื้องหลัง = bulk, ที่เหลือ = read)"""
+    if method in SHEETS_WRITE_METHODS: return 'write'
+    return current_metrics()['priority']
+
+# ==========================================
+# [Profiling] เก็บ Profile ของ Request (เฉพาะผู้จัดการที่ Login) แยกช่วง fetch / compute / render
+# ==========================================
+# เปิดด้วย ?profile=1 หรือ Header X-Profile: 1 / ตั้ง PROFILE_SAMPLE_RATE (0-1) = สุ่มเก็บอัตโนมัติ
+# ได้ 2 ไฟล์ต่อ Request: .folded (Stack ที่สุ่มทุก PROFILE_INTERVAL_MS, เปิดใน speedscope / flamegraph.pl ได้)
+# และ .prof (cProfile ใช้กับ pstats / snakeviz) ดาวน์โหลดที่ /profiles/<id>?format=folded|prof
+# Stack ใน .folded ขึ้นต้นด้วยชื่อช่วง (fetch / compute / render) จึงเห็นสัดส่วนของแต่ละช่วงบน Flame Graph ทันที
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', '5'))
+PROFILE_KEEP = 50
+PROFILE_DIR = os.path.join(tempfile.gettempdir(), 'lmt_profiles')
+PROFILE_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+# cProfile เปิดได้ทีละตัวต่อ Process -> Request ที่ชนกันจะไม่ถูกเก็บ
+profile_lock = threading.Lock()
+
+def begin_phase(name):
+    """เริ่มช่วง fetch / render ของ Request (ช่วงซ้อนกันนับที่ชั้นนอกสุด) -> True ถ้าเป็นชั้นนอกสุด"""
+    if getattr(metrics_local, 'phase', None) is not None: return False
+    metrics_local.phase = name
+    metrics_local.phase_started = time.perf_counter()
+    sampler = getattr(metrics_local, 'sampler', None)
+    if sampler is not None: sampler.phase = name
+    return True
+
+def end_phase():
+    name = getattr(metrics_local, 'phase', None)
+    if name is None: return
+    stats = getattr(metrics_local, 'stats', None)
+    if stats is not None: stats['phases'][name] += time.perf_counter() - metrics_local.phase_started
+    metrics_local.phase = None
+    sampler = getattr(metrics_local, 'sampler', None)
+    if sampler is not None: sampler.phase = 'compute'
+
+@contextmanager
+def request_phase(name):
+    outermost = begin_phase(name)
+    try:
+        yield
+    finally:
+        if outermost: end_phase()
+
+@before_render_template.connect_via(app)
+def start_render_phase(sender, template, context, **extra):
+    begin_phase('render')
+
+@template_rendered.connect_via(app)
+def stop_render_phase(sender, template, context, **extra):
+    if getattr(metrics_local, 'phase', None) == 'render': end_phase()
+
+class StackSampler(threading.Thread):
+    """สุ่มอ่าน Stack ของ Thread ที่กำลังทำ Request ทุก interval วินาที -> นับเป็น Folded Stacks"""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.phase = 'compute'
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(';', ','))
+                frame = frame.f_back
+            if names: self.stacks[';'.join([self.phase] + names[::-1])] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+def wants_profile():
+    if 'user' not in session or request.endpoint in (None, 'static', 'list_profiles', 'download_profile'): return False
+    if request.args.get('profile') == '1' or request.headers.get('X-Profile') == '1': return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+@app.before_request
+def start_request_profile():
+    metrics_local.profiler = metrics_local.sampler = None
+    if not wants_profile() or not profile_lock.acquire(blocking=False): return
+    sampler = StackSampler(threading.get_ident(), PROFILE_INTERVAL_MS / 1000)
+    profiler = cProfile.Profile()
+    metrics_local.sampler, metrics_local.profiler = sampler, profiler
+    metrics_local.profile_started = time.perf_counter()
+    sampler.start()
+    profiler.enable()
+
+def stop_request_profile():
+    """หยุด cProfile / Sampler แล้วคืน profile_lock (ครั้งเดียวต่อ Request) -> (profiler, sampler) หรือ None"""
+    profiler = getattr(metrics_local, 'profiler', None)
+    if profiler is None: return None
+    sampler = metrics_local.sampler
+    metrics_local.profiler = metrics_local.sampler = None
+    try:
+        profiler.disable()
+        sampler.stop()
+    finally:
+        profile_lock.release()
+    return profiler, sampler
+
+@app.after_request
+def finish_request_profile(response):
+    stopped = stop_request_profile()
+    if stopped is None: return response
+    profiler, sampler = stopped
+    try:
+        elapsed = time.perf_counter() - metrics_local.profile_started
+        stats = current_metrics()
+        fetch = stats['phases']['fetch']
+        render = stats['phases']['render']
+        meta = {
+            'id': uuid.uuid4().hex, 'method': request.method, 'path': request.full_path.rstrip('?'),
+            'route': stats['route'], 'status': response.status_code, 'user': session.get('user'),
+            'created_at': (datetime.now() + timedelta(hours=7)).strftime("%Y-%m-%d %H:%M:%S"),
+            'total_ms': round(elapsed * 1000, 1),
+            'phases_ms': {'fetch': round(fetch * 1000, 1), 'compute': round(max(elapsed - fetch - render, 0) * 1000, 1),
+                          'render': round(render * 1000, 1)},
+            'sheets_calls': sum(stats['api_calls'].values()), 'samples': sum(sampler.stacks.values())
+        }
+        save_profile(meta, profiler, sampler.stacks)
+        response.headers['X-Profile-Id'] = meta['id']
+        response.headers['X-Profile-Url'] = url_for('download_profile', profile_id=meta['id'])
+    except Exception as e:
+        print(f"Profile Error: {e}")
+    return response
+
+@app.teardown_request
+def release_request_profile(error=None):
+    # after_request ไม่ถูกเรียก (เช่น after_request ตัวอื่น Error) -> ต้องไม่ค้าง Lock / Sampler Thread
+    stop_request_profile()
+
+def profile_path(profile_id, extension):
+    return os.path.join(PROFILE_DIR, f"{profile_id}.{extension}")
+
+def save_profile(meta, profiler, stacks):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    profiler.dump_stats(profile_path(meta['id'], 'prof'))
+    with open(profile_path(meta['id'], 'folded'), 'w', encoding='utf-8') as f:
+        f.writelines(f"{stack} {count}\n" for stack, count in stacks.most_common())
+    with open(profile_path(meta['id'], 'json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    # เก็บแค่ PROFILE_KEEP ชุดล่าสุด
+    for old in list_profile_meta()[PROFILE_KEEP:]:
+        for extension in ('json', 'prof', 'folded'):
+            try: os.remove(profile_path(old['id'], extension))
+            except OSError: pass
+
+def list_profile_meta():
+    """Profile ที่เก็บไว้ (ใหม่สุดก่อน)"""
+    profiles = []
+    try: names = os.listdir(PROFILE_DIR)
+    except OSError: return profiles
+    for name in names:
+        if not name.endswith('.json'): continue
+        try:
+            with open(os.path.join(PROFILE_DIR, name), encoding='utf-8') as f: profiles.append(json.load(f))
+        except (OSError, ValueError): continue
+    return sorted(profiles, key=lambda p: (p['created_at'], p['id']), reverse=True)
+
+@app.route('/profiles')
+def list_profiles():
+    if 'user' not in session: return json.dumps({'status': 'error', 'message': 'Unauthorized'}), 401
+    return json.dumps({'status': 'success', 'profiles': list_profile_meta()}, ensure_ascii=False), 200, {'Content-Type': 'application/json'}
+
+@app.route('/profiles/<profile_id>')
+def download_profile(profile_id):
+    if 'user' not in session: return json.dumps({'status': 'error', 'message': 'Unauthorized'}), 401
+    fmt = request.args.get('format', 'folded')
+    if not PROFILE_ID_RE.match(profile_id) or fmt not in ('folded', 'prof', 'json'):
+        return json.dumps({'status': 'error', 'message': 'ไม่พบ Profile'}), 404
+    path = profile_path(profile_id, fmt)
+    if not os.path.exists(path): return json.dumps({'status': 'error', 'message': 'ไม่พบ Profile'}), 404
+    mimetype = 'application/octet-stream' if fmt == 'prof' else ('application/json' if fmt == 'json' else 'text/plain')
+    return send_file(path, mimetype=mimetype, as_attachment=fmt != 'json', download_name=f"profile_{profile_id}.{fmt}")
+
 # --- Caching System ---
+# 'version' จะเพิ่มขึ้นเฉพาะเมื่อข้อมูลเปลี่ยนจริง ใช้เป็น Key ของ Cache ชั้นถัดไป (รายงาน/ไฟล์ Export)
 cache_storage = {
-    'Jobs': {'data': None, 'timestamp': 0},
-    'Drivers': {'data': None, 'timestamp': 0},
-    'Users': {'data': None, 'timestamp': 0}
+    'Jobs': {'data': None, 'timestamp': 0, 'version': 0},
+    'Drivers': {'data': None, 'timestamp': 0, 'version': 0},
+    'Users': {'data': None, 'timestamp': 0, 'version': 0},
+    'PODetails': {'data': None, 'timestamp': 0, 'version': 0}
 }
+# PODetails เก็บเลข PO / Doc เป็น Text (ไม่ให้ gspread แปลงเป็นตัวเลขจนเลข 0 นำหน้าหาย)
+CACHE_READ_OPTIONS = {'PODetails': {'numericise_ignore': ['all']}}
 CACHE_DURATION = 60 
 
 def get_cached_records(sheet, worksheet_name):
     current_time = time.time()
     cache_entry = cache_storage.get(worksheet_name)
+    # Backend ที่บอก Version ได้ (Local Store / In-memory): Cache ใช้ได้ตราบที่ Version ยังไม่เปลี่ยน ไม่ต้องรอ TTL
+    store_version = sheet.data_version(worksheet_name) if hasattr(sheet, 'data_version') else None
     
     if cache_entry and cache_entry['data'] is not None:
-        if current_time - cache_entry['timestamp'] < CACHE_DURATION:
+        if store_version is not None:
+            if cache_entry.get('store_version') == store_version:
+                record_cache_lookup(worksheet_name, 'hit')
+                return cache_entry['data']
+        elif current_time - cache_entry['timestamp'] < CACHE_DURATION:
+            record_cache_lookup(worksheet_name, 'hit')
             return cache_entry['data']
     
+    record_cache_lookup(worksheet_name, 'miss')
     try:
-        data = sheet.worksheet(worksheet_name).get_all_records()
+        with request_phase('fetch'):
+            data = sheet.worksheet(worksheet_name).get_all_records(**CACHE_READ_OPTIONS.get(worksheet_name, {}))
+        version = cache_entry.get('version', 0) if cache_entry else 0
+        if not cache_entry or cache_entry['data'] != data: version += 1
         cache_storage[worksheet_name] = {
             'data': data,
-            'timestamp': current_time
+            'timestamp': current_time,
+            'version': version,
+            'store_version': store_version
         }
         return data
-    except gspread.exceptions.APIError as e:
-        if "429" in str(e) and cache_entry and cache_entry['data'] is not None:
-            return cache_entry['data']
+    except (gspread.exceptions.APIError, SheetsThrottled) as e:
+        # โดนจำกัด / Google ขัดข้อง -> ใช้ข้อมูลเดิม (รวมถึงชุดที่เพิ่งถูก invalidate หลังการเขียน)
+        stale = (cache_entry.get('data') or cache_entry.get('stale')) if cache_entry else None
+        if is_sheets_throttle(e) and stale is not None:
+            record_cache_lookup(worksheet_name, 'stale')
+            return stale
         raise e
 
+def get_data_version(worksheet_name):
+    """เลข Version ของข้อมูลใน Cache (เรียกหลัง get_cached_records)"""
+    cache_entry = cache_storage.get(worksheet_name)
+    return cache_entry.get('version', 0) if cache_entry else 0
+
 def invalidate_cache(worksheet_name):
     if worksheet_name in cache_storage:
-        cache_storage[worksheet_name] = {'data': None, 'timestamp': 0}
+        entry = cache_storage[worksheet_name]
+        # เก็บชุดเดิมไว้ใช้ตอน Google จำกัดการเรียก (get_cached_records)
+        stale = entry.get('data') if entry.get('data') is not None else entry.get('stale')
+        cache_storage[worksheet_name] = {'data': None, 'timestamp': 0, 'version': get_data_version(worksheet_name), 'stale': stale}
+
+def written_store_version(sheet, worksheet_name, cache_entry):
+    """
+    store_version ของ Cache หลังเขียนเอง 1 ครั้ง (Local Store / In-memory นับ Version +1 ต่อการเขียน)
+    มีการเขียนอื่นแทรก (Version ไม่ตรง +1) -> None ให้ get_cached_records โหลดใหม่
+    """
+    if not hasattr(sheet, 'data_version') or cache_entry.get('store_version') is None: return None
+    version = sheet.data_version(worksheet_name)
+    return version if version == cache_entry['store_version'] + 1 else None
+
+def patch_cached_rows(sheet, worksheet_name, cell_updates, sheet_rows, columns):
+    """
+    Write-through: แก้ข้อมูลใน Cache ตาม Cell ที่เพิ่งเขียนลง Sheet แทนการโหลดทั้ง Sheet ใหม่
+    cell_updates: [(row_id, field, value)] (เลขแถวแบบ Sheet เริ่มที่ 1, field = ชื่อหัวคอลัมน์)
+    sheet_rows: {row_id: ค่าแถวที่อ่านจาก Sheet} ใช้ตรวจว่าแถวใน Cache เป็นแถวเดียวกัน (ตำแหน่งแถวอาจเลื่อนจากการลบ)
+    columns: ColumnMap ของแถวใน sheet_rows
+    ถ้าไม่มี Cache หรือตรวจไม่ผ่าน จะ invalidate_cache แทน
+    """
+    cache_entry = cache_storage.get(worksheet_name)
+    data = cache_entry['data'] if cache_entry else None
+    if not data:
+        invalidate_cache(worksheet_name)
+        return False
+
+    new_data = list(data)
+    patched = {}
+    for row_id, field, value in cell_updates:
+        idx = row_id - 2
+        if idx < 0 or idx >= len(new_data) or field not in new_data[idx] or row_id not in sheet_rows:
+            invalidate_cache(worksheet_name)
+            return False
+        if idx not in patched:
+            # เทียบ PO_Date, Round, Car_No, Driver กับแถวจริงใน Sheet
+            cached_row = new_data[idx]
+            sheet_row = sheet_rows[row_id]
+            if any(str(cached_row.get(f)) != str(columns.value(sheet_row, f)) for f in JOB_IDENTITY_FIELDS):
+                invalidate_cache(worksheet_name)
+                return False
+            patched[idx] = dict(new_data[idx])
+            new_data[idx] = patched[idx]
+        patched[idx][field] = value
+
+    cache_storage[worksheet_name] = {'data': new_data, 'timestamp': cache_entry['timestamp'],
+                                     'version': cache_entry.get('version', 0) + 1,
+                                     'store_version': written_store_version(sheet, worksheet_name, cache_entry)}
+    return True
+
+# ==========================================
+# [Column Map] ตำแหน่งคอลัมน์ของ Jobs อ่านจากแถวหัวตาราง (ไม่ Hard-code เลขคอลัมน์)
+# ==========================================
+# โค้ดเขียนอ้าง "ชื่อหัวคอลัมน์" แล้ว ColumnMap แปลงเป็นเลขคอลัมน์ / A1 ให้ ย้ายหรือแทรกคอลัมน์ใน Sheet ได้โดยไม่ต้องแก้โค้ด
+STEP_TIME_FIELDS = {'1': 'T1_Enter', '2': 'T2_StartLoad', '3': 'T3_EndLoad', '4': 'T4_SubmitDoc',
+                    '5': 'T5_RecvDoc', '6': 'T6_Exit', '7': 'T7_ArriveBranch', '8': 'T8_EndJob'}
+STEP_LOC_FIELDS = {step: f'L{step}_Loc' for step in STEP_TIME_FIELDS}
+STEP_LABELS = {'1': 'เข้าโรงงาน', '2': 'เริ่มโหลด', '3': 'โหลดเสร็จ', '4': 'ยื่นเอกสาร',
+               '5': 'รับเอกสาร', '6': 'ออกโรงงาน', '7': 'ถึงสาขา', '8': 'จบงาน'}  # ชื่อปุ่มในหน้าคนขับ
+TRIP_KEY_FIELDS = ('PO_Date', 'Round', 'Car_No')
+JOB_IDENTITY_FIELDS = TRIP_KEY_FIELDS + ('Driver',)
+jobs_column_map = {'version': None, 'map': None}
+
+class ColumnMapError(ValueError):
+    """ชื่อคอลัมน์ไม่มีในหัวตาราง (ตรวจก่อนส่ง batch_update จะได้ไม่เขียนผิดช่อง)"""
+
+class ColumnMap:
+    """ชื่อหัวคอลัมน์ -> เลขคอลัมน์ (เริ่มที่ 1) ของแถวหัวตารางหนึ่งชุด"""
+
+    def __init__(self, header):
+        self.names = list(dict.fromkeys(header))  # หัวตารางตามลำดับใน Sheet (Key ของ Record แบบ gspread.utils.to_records)
+        self.cols = {}
+        for i, name in enumerate(header):
+            name = str(name).strip()
+            if name and name not in self.cols: self.cols[name] = i + 1
+        self.width = max(self.cols.values(), default=0)
+
+    def __eq__(self, other):
+        return isinstance(other, ColumnMap) and self.cols == other.cols
+
+    def col(self, field):
+        if field not in self.cols: raise ColumnMapError(f"ไม่พบคอลัมน์ '{field}' ในหัวตาราง")
+        return self.cols[field]
+
+    def a1(self, row_id, field):
+        return gspread.utils.rowcol_to_a1(row_id, self.col(field))
+
+    def value(self, row, field):
+        """ค่าในแถวดิบ (list จาก get_all_values / row_values) ช่องที่เกินความยาวแถว = ''"""
+        i = self.col(field) - 1
+        return row[i] if i < len(row) else ''
+
+    def values(self, row, fields):
+        return tuple(str(self.value(row, f)) for f in fields)
+
+    def has(self, row, field='Car_No'):
+        """แถวยาวถึงคอลัมน์ field หรือไม่ (row_values ตัดช่องว่างท้ายแถวทิ้ง)"""
+        return len(row) >= self.col(field)
+
+    def record(self, row):
+        """แถวดิบ -> Record แบบ get_all_records (แปลงตัวเลขเหมือนกัน Key ที่สร้างจาก Record จึงตรงกับของ Cache)"""
+        return grid_to_records([self.names, [self.value(row, f) for f in self.names]])[0]
+
+    def build_row(self, record):
+        """dict {ชื่อคอลัมน์: ค่า} -> list เรียงตามหัวตาราง (ชื่อที่ไม่มีในหัวตาราง raise ColumnMapError)"""
+        row = [''] * self.width
+        for field, value in record.items():
+            row[self.col(field) - 1] = value
+        return row
+
+def get_jobs_column_map(sheet, header=None):
+    """
+    ColumnMap ของ Jobs สร้างครั้งเดียวต่อ Cache Version (ใช้ Key ของ Record ที่ Cache ไว้)
+    ส่ง header ที่เพิ่งอ่านจาก Sheet มาด้วยเมื่อมี: ถ้าไม่ตรงกับที่ Cache ไว้ แปลว่ามีคนย้ายคอลัมน์ -> ล้าง Cache แล้วใช้ของใหม่
+    """
+    if header is not None:
+        fresh = ColumnMap(header)
+        if jobs_column_map['map'] != fresh:
+            invalidate_cache('Jobs')
+            jobs_column_map.update(version=None, map=fresh)
+        return fresh
+
+    records = get_cached_records(sheet, 'Jobs')
+    version = get_data_version('Jobs')
+    if jobs_column_map['map'] is None or jobs_column_map['version'] != version:
+        header = list(records[0].keys()) if records else sheet.worksheet('Jobs').row_values(1)
+        jobs_column_map.update(version=version, map=ColumnMap(header))
+    return jobs_column_map['map']
 
 # --- Helper Functions ---
 
@@ -122,43 +804,187 @@ def thai_date_filter(date_val):
     except:
         return str(date_val)
         
-def parse_po_data(po_str, doc_str, weight_str):
+THAI_MONTHS_SHORT = ['ม.ค.','ก.พ.','มี.ค.','เม.ย.','พ.ค.','มิ.ย.','ก.ค.','ส.ค.','ก.ย.','ต.ค.','พ.ย.','ธ.ค.']
+
+def thai_date_text(date_str):
+    """แปลงวันที่ YYYY-MM-DD เป็นข้อความไทย (1 ม.ค. 2568) สำหรับหัวรายงาน PDF"""
+    try:
+        d = datetime.strptime(date_str, "%Y-%m-%d")
+        return f"{d.day} {THAI_MONTHS_SHORT[d.month-1]} {d.year+543}"
+    except: return date_str
+
+# ==========================================
+# [PO Detail] ข้อมูลเลข Doc / น้ำหนัก ราย PO
+# ==========================================
+# รูปแบบเดิมใน Jobs: PO_Nos "PO1,PO2", Doc_Result "PO1:Doc1 | PO2:Doc2", Weight_Result "PO1:10 | PO2:20"
+# รูปแบบใหม่: Sheet PODetails เก็บ 1 แถวต่อการบันทึก 1 ช่อง (Job_Key, PO, Field, Value, Updated_At)
+#   บันทึกด้วย append_row อย่างเดียว ไม่ต้องอ่านค่าเดิมมารวม / ค่าล่าสุดของ (Job_Key, PO, Field) ทับค่าในรูปแบบเดิม
+#   หลังบันทึกเขียนค่ารวมกลับลง Doc_Result / Weight_Result ของแถวนั้นด้วย (คนที่ดู Spreadsheet เห็นค่าล่าสุด)
+#   ปิดยอดทุกคืน: รวม Log ที่เก่ากว่า PO_DETAIL_RETENTION_DAYS ลง Jobs แล้วลบออก (Log ไม่โตไปเรื่อย ๆ)
+# Version ของแถวงาน = จำนวนครั้งที่บันทึกใน PODetails (0 = ยังมีแต่ข้อมูลรูปแบบเดิม) ใช้ตรวจการแก้ไขชนกันจากหลายเครื่อง
+PO_DETAIL_FIELDS = {'doc': 'Doc_Result', 'weight': 'Weight_Result'}
+PO_DETAIL_RETENTION_DAYS = int(os.environ.get('PO_DETAIL_RETENTION_DAYS', '7'))  # เก็บ Log ไว้ตรวจการชนกี่วัน ก่อนรวมลง Jobs
+PO_DETAIL_HEADER = ['Job_Key', 'PO', 'Field', 'Value', 'Updated_At']
+# Job_Key -> {'version': n, 'pos': {PO: {'doc': ..., 'weight': ...}}, 'changed': {(PO, field): version ที่แก้ล่าสุด}}
+po_detail_index = {'version': None, 'index': {}}
+po_detail_lock = threading.Lock()
+
+@lru_cache(maxsize=4096)
+def parse_po_list(po_str):
+    """ "PO1,PO2" -> ('PO1', 'PO2') (จำผลตามค่าใน Cell ไม่ต้องแยกซ้ำทุก Request)"""
+    return tuple(p.strip() for p in str(po_str).split(',') if p.strip())
+
+@lru_cache(maxsize=4096)
+def parse_po_map(map_str):
+    """ "PO1:Doc1 | PO2:Doc2" -> (('PO1', 'Doc1'), ('PO2', 'Doc2')) (PO ซ้ำใช้ค่าหลังสุด)"""
+    val_map = {}
+    for p in str(map_str).split('|'):
+        if ':' in p:
+            k, v = p.split(':', 1)
+            val_map[k.strip()] = v.strip()
+    return tuple(val_map.items())
+
+def serialize_po_map(val_map):
+    """Dict -> "PO:Val | PO:Val" (เก็บเฉพาะที่มีค่า)"""
+    return " | ".join(f"{k}:{v}" for k, v in val_map.items() if v)
+
+def parse_po_data(po_str, doc_str, weight_str, overrides=None):
     """
     แปลง String จาก Database ให้เป็น List of Dict เพื่อแสดงผล
     Input: "PO1,PO2", "PO1:Doc1 | PO2:Doc2", "PO1:10 | PO2:20"
+    overrides: {PO: {'doc': ..., 'weight': ...}} จาก Sheet PODetails (ทับค่ารูปแบบเดิม)
     """
     if not po_str: return []
-    
-    # แปลง PO String เป็น List
-    po_list = [p.strip() for p in po_str.split(',') if p.strip()]
-    
-    # แปลง Doc และ Weight เป็น Dictionary
-    doc_map = {}
-    if doc_str:
-        parts = doc_str.split('|')
-        for p in parts:
-            if ':' in p:
-                k, v = p.split(':', 1)
-                doc_map[k.strip()] = v.strip()
-
-    weight_map = {}
-    if weight_str:
-        parts = weight_str.split('|')
-        for p in parts:
-            if ':' in p:
-                k, v = p.split(':', 1)
-                weight_map[k.strip()] = v.strip()
-
-    # รวมร่าง
+    doc_map = dict(parse_po_map(doc_str)) if doc_str else {}
+    weight_map = dict(parse_po_map(weight_str)) if weight_str else {}
+    overrides = overrides or {}
+
     result = []
-    for po in po_list:
-        result.append({
-            'name': po,
-            'doc': doc_map.get(po, ''),
-            'weight': weight_map.get(po, '')
-        })
+    for po in parse_po_list(po_str):
+        item = {'name': po, 'doc': doc_map.get(po, ''), 'weight': weight_map.get(po, '')}
+        item.update(overrides.get(po, {}))
+        result.append(item)
     return result
 
+def po_job_key(job):
+    """Key ของแถวงานใน PODetails (ไม่ใช้เลขแถว เพราะเลื่อนได้เมื่อมีการลบงาน)"""
+    return '|'.join(str(job.get(k, '')).strip() for k in ('PO_Date', 'Round', 'Car_No', 'Branch_Name'))
+
+def get_po_detail_index(sheet):
+    """รวมแถวใน PODetails เป็น {Job_Key: {PO: {field: value}}} (สร้างใหม่เมื่อ Version เปลี่ยน)"""
+    try:
+        records = get_cached_records(sheet, 'PODetails')
+    except gspread.exceptions.WorksheetNotFound:
+        # ยังไม่เคยบันทึกแบบใหม่: จำไว้ว่าว่าง จะได้ไม่ถาม Sheet ทุก Request
+        cache_storage['PODetails'] = {'data': [], 'timestamp': time.time(), 'version': get_data_version('PODetails')}
+        records = []
+    version = get_data_version('PODetails')
+    if po_detail_index['version'] != version:
+        index = {}
+        for r in records: apply_po_detail_record(index, r)
+        po_detail_index.update(version=version, index=index)
+    return po_detail_index['index']
+
+def apply_po_detail_record(index, record):
+    field = record.get('Field')
+    if field not in PO_DETAIL_FIELDS: return
+    entry = index.setdefault(record['Job_Key'], {'version': 0, 'pos': {}, 'changed': {}})
+    entry['version'] += 1
+    entry['pos'].setdefault(record['PO'], {})[field] = record['Value']
+    entry['changed'][(record['PO'], field)] = entry['version']
+
+def po_detail_version(po_index, job_key):
+    entry = po_index.get(job_key)
+    return entry['version'] if entry else 0
+
+def append_po_detail(sheet, job_key, po_name, field, value):
+    """บันทึกค่า 1 ช่องของ PO ลง PODetails (append อย่างเดียว) แล้วเขียนต่อท้าย Cache และ Index ทันที"""
+    timestamp = (datetime.now() + timedelta(hours=7)).strftime("%Y-%m-%d %H:%M:%S")
+    row = [job_key, po_name, field, value, timestamp]
+    LogRepository(sheet, 'PODetails', PO_DETAIL_HEADER).append([row])
+
+    record = dict(zip(PO_DETAIL_HEADER, row))
+    cache_entry = cache_storage.get('PODetails')
+    if cache_entry and cache_entry['data'] is not None:
+        old_version = cache_entry.get('version', 0)
+        cache_storage['PODetails'] = {'data': cache_entry['data'] + [record],
+                                      'timestamp': cache_entry['timestamp'], 'version': old_version + 1,
+                                      'store_version': written_store_version(sheet, 'PODetails', cache_entry)}
+        # Index ตรงกับ Cache ก่อนเขียน -> ต่อ Record เดียวแทนการสร้างใหม่ทั้งหมด
+        if po_detail_index['version'] == old_version:
+            apply_po_detail_record(po_detail_index['index'], record)
+            po_detail_index['version'] = old_version + 1
+    else:
+        invalidate_cache('PODetails')
+
+def merged_po_cell(job, po_index, field):
+    """ค่า Doc_Result / Weight_Result ที่รวมค่าใน PODetails แล้ว (รูปแบบเดิม) สำหรับเขียนกลับลง Jobs"""
+    val_map = dict(parse_po_map(str(job.get(PO_DETAIL_FIELDS[field], '')).strip()))
+    for po, values in po_index.get(po_job_key(job), {}).get('pos', {}).items():
+        if field in values: val_map[po] = values[field]
+    return serialize_po_map(val_map)
+
+def write_back_po_cell(sheet, row_id, job_key, field):
+    """
+    เขียนค่ารวมของช่องนี้กลับลง Jobs ให้คนที่ดูใน Spreadsheet เห็นค่าล่าสุด (PODetails ยังเป็นข้อมูลหลัก)
+    แถวเลื่อน / Job_Key ไม่ตรง -> ข้าม ค่าจะถูกรวมลง Jobs ตอนตัด PODetails (trim_po_detail_log)
+    """
+    jobs_repo = JobsRepository(sheet)
+    with jobs_repo.lock:
+        row = jobs_repo.row(row_id)
+        columns = jobs_repo.columns()
+        if not columns.has(row) or po_job_key(columns.record(row)) != job_key: return False
+        value = merged_po_cell(columns.record(row), get_po_detail_index(sheet), field)
+        jobs_repo.update_cells([(row_id, PO_DETAIL_FIELDS[field], value)], {row_id: row}, columns)
+    return True
+
+def trim_po_detail_log(sheet, before):
+    """
+    รวมค่าใน PODetails ที่บันทึกก่อนวันที่ before ลง Doc_Result / Weight_Result ของ Jobs แล้วลบออก (เรียกตอนปิดยอดทุกคืน)
+    Cache ของ PODetails ถูกโหลดใหม่ทุกครั้งที่ข้อมูลเปลี่ยน จึงต้องไม่ให้ Log โตไปเรื่อย ๆ
+    Log เขียนต่อท้ายตามเวลาเสมอ -> ลบเป็นช่วงเดียวจากบนสุด / งานที่ถูกลบไปแล้วทิ้งค่าไปด้วย
+    """
+    with po_detail_lock:
+        po_log = LogRepository(sheet, 'PODetails', PO_DETAIL_HEADER)
+        count = po_log.count_before('Updated_At', before)
+        if not count: return 0
+
+        invalidate_cache('PODetails')
+        po_index = get_po_detail_index(sheet)
+        job_keys = {r['Job_Key'] for r in get_cached_records(sheet, 'PODetails')[:count]}
+        jobs_repo = JobsRepository(sheet)
+        with jobs_repo.lock:
+            grid = jobs_repo.grid()
+            columns = jobs_repo.columns(grid)
+            cells, sheet_rows = [], {}
+            for row_id, row in enumerate(grid[1:], start=2):
+                if not columns.has(row): continue
+                job = columns.record(row)
+                if po_job_key(job) not in job_keys: continue
+                for field, column in PO_DETAIL_FIELDS.items():
+                    value = merged_po_cell(job, po_index, field)
+                    if value != str(job.get(column, '')).strip():
+                        cells.append((row_id, column, value))
+                        sheet_rows[row_id] = row
+            # เขียน Jobs ก่อนลบ Log: ถ้าลบไม่สำเร็จ รอบหน้ารวมซ้ำได้ค่าเดิม
+            if cells: jobs_repo.update_cells(cells, sheet_rows, columns)
+        po_log.delete_first(count)
+        invalidate_cache('PODetails')
+    return count
+
+def job_po_details(job, po_index):
+    """PO ของแถวงาน (รูปแบบเดิม + ค่าที่บันทึกใน PODetails)"""
+    return parse_po_data(str(job.get('PO_Nos', '')).strip(),       # Col Z
+                         str(job.get('Doc_Result', '')).strip(),    # Col AA
+                         str(job.get('Weight_Result', '')).strip(), # Col AB
+                         po_index.get(po_job_key(job), {}).get('pos'))
+
+def job_has_doc(job, po_index):
+    """มีเลข Doc อย่างน้อย 1 PO หรือไม่ (งานที่ไม่มี PO_Nos ดูจาก Doc_Result เดิม)"""
+    details = job_po_details(job, po_index)
+    if details: return any(d['doc'] for d in details)
+    return bool(str(job.get('Doc_Result', '')).strip())
+
 # Register Filters
 app.jinja_env.filters['comma_format'] = comma_format
 app.jinja_env.filters['thai_date'] = thai_date_filter
@@ -168,20 +994,16 @@ app.jinja_env.filters['thai_date'] = thai_date_filter
 # ==========================================
 def is_already_notified(sheet, key):
     try:
-        try:
-            ws_log = sheet.worksheet('NotifyLogs')
-        except:
-            ws_log = sheet.add_worksheet(title="NotifyLogs", rows=1000, cols=2)
-            ws_log.append_row(['Notify_Key', 'Timestamp'])
-            return False
+        notify_log = LogRepository(sheet, 'NotifyLogs', ['Notify_Key', 'Timestamp'])
+        if notify_log.open(): return False
 
-        existing_keys = ws_log.col_values(1)
+        existing_keys = notify_log.column('Notify_Key')
         
         if key in existing_keys:
             return True
         else:
             timestamp = (datetime.now() + timedelta(hours=7)).strftime("%Y-%m-%d %H:%M:%S")
-            ws_log.append_row([key, timestamp])
+            notify_log.append([[key, timestamp]])
             return False
             
     except Exception as e:
@@ -221,14 +1043,8 @@ def notify_individual_movement(sheet, job_data, step):
         
 def notify_car_completion(sheet, job_data):
     try:
-        all_jobs = sheet.worksheet('Jobs').get_all_records()
-        my_trip = [
-            j for j in all_jobs
-            if str(j['PO_Date']) == str(job_data['PO_Date'])
-            and str(j['Round']) == str(job_data['Round'])
-            and str(j['Car_No']) == str(job_data['Car_No'])
-            and str(j.get('Status', '')).lower() != 'cancel'
-        ]
+        trip_jobs = JobsRepository(sheet).find_trip(job_data['PO_Date'], job_data['Round'], job_data['Car_No'], fresh=True)
+        my_trip = [j for j in trip_jobs if str(j.get('Status', '')).lower() != 'cancel']
         
         if not my_trip: return
         if not all(j['Status'] == 'Done' for j in my_trip): return
@@ -253,8 +1069,7 @@ def notify_car_completion(sheet, job_data):
 def check_group_completion(sheet, target_po_date, target_round_time, trigger_step):
     try:
         target_is_day, shift_name = get_shift_info(target_round_time)
-        raw_jobs = sheet.worksheet('Jobs').get_all_records()
-        target_jobs = [j for j in raw_jobs if str(j['PO_Date']).strip() == str(target_po_date).strip()]
+        target_jobs = JobsRepository(sheet).find_by_date(target_po_date, fresh=True)
 
         stats = {'total': 0, 'in': 0, 'out': 0, 'done': 0}
         trips = {}
@@ -376,6 +1191,12 @@ def check_late_and_notify(sheet):
 # [FIXED] get_db Function with Retry Logic & ID Support
 # ======================================================
 def get_db():
+    """Spreadsheet ที่ Route ใช้: In-memory / Local Store (ถ้าตั้ง LOCAL_DB_PATH) / Google Sheets ตรง"""
+    if memory_backend_state['sheet'] is not None or MEMORY_DB_SEED: return get_memory_spreadsheet()
+    if LOCAL_DB_PATH: return get_local_spreadsheet()
+    return get_sheets_db()
+
+def get_sheets_db():
     scope = ["https://spreadsheets.google.com/feeds", 'https://www.googleapis.com/auth/spreadsheets', "https://www.googleapis.com/auth/drive.file", "https://www.googleapis.com/auth/drive"]
     creds_json = os.environ.get('GSPREAD_CREDENTIALS')
     
@@ -390,23 +1211,861 @@ def get_db():
     
     client = gspread.authorize(creds)
     
-    # Retry Logic for Google API 500/429 Errors
-    max_retries = 3
-    for attempt in range(max_retries):
+    # Retry 429/5xx ผ่าน sheets_limiter (Backoff + Jitter)
+    opened_at = time.perf_counter()
+    try:
+        if SPREADSHEET_ID and len(SPREADSHEET_ID) > 10:
+            spreadsheet = sheets_limiter.call(client.open_by_key, 'open', sheets_priority('open'), SPREADSHEET_ID)
+        else:
+            spreadsheet = sheets_limiter.call(client.open, 'open', sheets_priority('open'), "DriverLogApp")
+    except Exception as e:
+        record_api_call('open', '', time.perf_counter() - opened_at, api_error_status(e) or 'error')
+        print(f"Failed to connect to Google Sheet: {e}")
+        raise e
+    record_api_call('open', '', time.perf_counter() - opened_at)
+    return instrument_sheets(spreadsheet)
+
+# ==========================================
+# [Local Store] SQLite (WAL) เป็นฐานข้อมูลหลัก / Google Sheets เป็นสำเนา (เปิดด้วย LOCAL_DB_PATH)
+# ==========================================
+# - แต่ละ Worksheet เก็บเป็นตาราง sheet_<ชื่อ> ที่ตำแหน่งตรงกับ Sheet (row_no = เลขแถว, c1..cN = คอลัมน์ A..)
+#   โค้ดเดิมที่อ้าง row_id / เลขคอลัมน์จึงใช้ได้ทั้งหมด และสร้าง Index ตามชื่อหัวคอลัมน์ (LOCAL_STORE_INDEXES)
+# - เขียนลง SQLite ก่อนเสมอ แล้วต่อคิวใน outbox ให้ Replicator ส่งขึ้น Sheet เป็นชุด (batch_update / append_rows)
+# - Replicator ดึงทั้ง Spreadsheet กลับมาทุก LOCAL_PULL_INTERVAL วินาที (รับการแก้มือใน Sheet) เฉพาะตอนคิวว่าง
+# - Replicator ต่ออายุ Lease ก่อนส่งทุกกลุ่ม (หลุด = หยุด) / กลุ่มแรกหลัง Error หรือรับช่วงต่อ เช็กแถวบน Sheet ก่อน append/delete จึงไม่ส่งซ้ำ
+# - ไม่ตั้ง LOCAL_DB_PATH (เช่นบน Vercel ที่ไม่มี Disk ถาวร) = อ่าน/เขียน Google Sheets ตรงเหมือนเดิม
+LOCAL_DB_PATH = os.environ.get('LOCAL_DB_PATH', '')
+LOCAL_PUSH_INTERVAL = 2
+LOCAL_PULL_INTERVAL = 60
+LOCAL_CALL_TIMEOUT = 60  # วินาทีต่อ HTTP Request ของ Replicator
+# Lease ต้องนานกว่า API Call ที่ช้าที่สุด (รวม Retry ของ sheets_limiter) -> ตัวที่รับช่วงต่อไม่ส่งซ้อนกับ Call ที่ยังค้างอยู่
+LOCAL_LEASE_TTL = ((SHEETS_MAX_RETRIES + 1) * (SHEETS_MAX_WAIT + LOCAL_CALL_TIMEOUT)
+                   + SHEETS_MAX_RETRIES * SHEETS_BACKOFF_CAP + 30)
+LOCAL_PUSH_BATCH = 500
+LOCAL_STORE_INDEXES = {
+    'Jobs': [['PO_Date'], ['Driver'], ['PO_Date', 'Round', 'Car_No']],
+    'Drivers': [['Name']],
+    'Users': [['Username']],
+    'NotifyLogs': [['Notify_Key']],
+    'StepEvents': [['Event_Id']],
+    'PODetails': [['Job_Key']],
+}
+local_store_state = {'store': None, 'replicator': None}
+local_store_lock = threading.Lock()
+
+class LocalStore:
+    """ตารางแบบ Grid ของทุก Worksheet ใน SQLite + outbox สำหรับส่งขึ้น Google Sheets"""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        with self.tx() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS meta (sheet TEXT PRIMARY KEY, version INTEGER NOT NULL, width INTEGER NOT NULL)')
+            db.execute('CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, sheet TEXT NOT NULL, op TEXT NOT NULL, payload TEXT NOT NULL)')
+            db.execute('CREATE TABLE IF NOT EXISTS lease (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)')
+
+    def conn(self):
+        # 1 Connection ต่อ Thread ต่อ Process (Process ลูกของ Export Job ต้องเปิดใหม่ ห้ามใช้ของแม่ต่อ)
+        db = getattr(self.local, 'db', None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db, self.local.pid = db, os.getpid()
+        return db
+
+    @contextmanager
+    def tx(self):
+        db = self.conn()
+        db.execute('BEGIN IMMEDIATE')
         try:
-            if SPREADSHEET_ID and len(SPREADSHEET_ID) > 10:
-                return client.open_by_key(SPREADSHEET_ID)
+            yield db
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+    @staticmethod
+    def table(sheet_name):
+        return '"sheet_' + sheet_name.replace('"', '""') + '"'
+
+    def sheet_names(self):
+        return [r[0] for r in self.conn().execute('SELECT sheet FROM meta')]
+
+    def version(self, sheet_name):
+        row = self.conn().execute('SELECT version FROM meta WHERE sheet = ?', (sheet_name,)).fetchone()
+        return row[0] if row else None
+
+    def width(self, db, sheet_name):
+        row = db.execute('SELECT width FROM meta WHERE sheet = ?', (sheet_name,)).fetchone()
+        return row[0] if row else None
+
+    def ensure_sheet(self, db, sheet_name, width):
+        """สร้างตาราง / เพิ่มคอลัมน์ให้กว้างพอ (คืนความกว้างปัจจุบัน)"""
+        current = self.width(db, sheet_name)
+        if current is None:
+            cols = ''.join(f', c{i} TEXT' for i in range(1, width + 1))
+            db.execute(f'CREATE TABLE IF NOT EXISTS {self.table(sheet_name)} (row_no INTEGER PRIMARY KEY{cols})')
+            db.execute('INSERT INTO meta (sheet, version, width) VALUES (?, 0, ?)', (sheet_name, width))
+            return width
+        for i in range(current + 1, width + 1):
+            db.execute(f'ALTER TABLE {self.table(sheet_name)} ADD COLUMN c{i} TEXT')
+        if width > current:
+            db.execute('UPDATE meta SET width = ? WHERE sheet = ?', (width, sheet_name))
+        return max(width, current)
+
+    def ensure_indexes(self, db, sheet_name):
+        """Index ตามชื่อหัวคอลัมน์ (หัวคอลัมน์ย้ายที่ -> ลบ Index เก่าแล้วสร้างใหม่ตามตำแหน่งใหม่)"""
+        header = self.read_row(db, sheet_name, 1)
+        wanted = {}
+        for names in LOCAL_STORE_INDEXES.get(sheet_name, []):
+            if all(n in header for n in names):
+                cols = [f'c{header.index(n) + 1}' for n in names]
+                wanted[f'ix_{hashlib.md5((sheet_name + "|" + ",".join(cols)).encode()).hexdigest()[:12]}'] = cols
+        table_name = 'sheet_' + sheet_name
+        existing = [r[0] for r in db.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND name LIKE 'ix_%'", (table_name,))]
+        for name in existing:
+            if name not in wanted: db.execute(f'DROP INDEX "{name}"')
+        for name, cols in wanted.items():
+            if name not in existing: db.execute(f'CREATE INDEX "{name}" ON {self.table(sheet_name)} ({", ".join(cols)})')
+
+    def bump(self, db, sheet_name):
+        db.execute('UPDATE meta SET version = version + 1 WHERE sheet = ?', (sheet_name,))
+
+    def enqueue(self, db, sheet_name, op, payload):
+        db.execute('INSERT INTO outbox (sheet, op, payload) VALUES (?, ?, ?)', (sheet_name, op, json.dumps(payload, ensure_ascii=False)))
+
+    # --- อ่าน ---
+    @staticmethod
+    def trim(values):
+        values = list(values)
+        while values and values[-1] in ('', None): values.pop()
+        return ['' if v is None else v for v in values]
+
+    def read_row(self, db, sheet_name, row_no):
+        width = self.width(db, sheet_name) or 0
+        if not width: return []
+        row = db.execute(f'SELECT {", ".join(f"c{i}" for i in range(1, width + 1))} FROM {self.table(sheet_name)} WHERE row_no = ?', (row_no,)).fetchone()
+        return self.trim(row) if row else []
+
+    def values(self, sheet_name):
+        """เหมือน get_all_values: ทุกแถวยาวเท่ากัน ตัดคอลัมน์/แถวว่างท้ายตาราง"""
+        db = self.conn()
+        width = self.width(db, sheet_name) or 0
+        if not width: return []
+        rows = {}
+        for r in db.execute(f'SELECT row_no, {", ".join(f"c{i}" for i in range(1, width + 1))} FROM {self.table(sheet_name)} ORDER BY row_no'):
+            rows[r[0]] = self.trim(r[1:])
+        last_row = max((n for n, v in rows.items() if v), default=0)
+        grid = [rows.get(n, []) for n in range(1, last_row + 1)]
+        used = max((len(v) for v in grid), default=0)
+        return [v + [''] * (used - len(v)) for v in grid]
+
+    def row(self, sheet_name, row_no):
+        return self.read_row(self.conn(), sheet_name, row_no)
+
+    def column(self, sheet_name, col):
+        db = self.conn()
+        if col > (self.width(db, sheet_name) or 0): return []
+        rows = {n: ('' if v is None else v) for n, v in db.execute(f'SELECT row_no, c{col} FROM {self.table(sheet_name)}')}
+        return self.trim([rows.get(n, '') for n in range(1, max(rows, default=0) + 1)])
+
+    def select(self, sheet_name, filters):
+        """แถวที่ค่าตรงตาม filters {หัวคอลัมน์: ค่า} (ใช้ Index) -> [(row_no, [values])] เรียงตามแถว"""
+        db = self.conn()
+        header = self.read_row(db, sheet_name, 1)
+        width = self.width(db, sheet_name) or 0
+        if not header: return []
+        where, params = ['row_no > 1'], []
+        for name, value in filters.items():
+            if name not in header: return []
+            where.append(f'c{header.index(name) + 1} = ?')
+            params.append(str(value).strip())
+        cols = ', '.join(f'c{i}' for i in range(1, width + 1))
+        sql = f'SELECT row_no, {cols} FROM {self.table(sheet_name)} WHERE {" AND ".join(where)} ORDER BY row_no'
+        return [(r[0], ['' if v is None else v for v in r[1:len(header) + 1]]) for r in db.execute(sql, params)]
+
+    # --- เขียน (ต่อคิว outbox ในธุรกรรมเดียวกัน) ---
+    def set_cells(self, sheet_name, cells):
+        """cells: [(row_no, col, value)]"""
+        if not cells: return
+        with self.tx() as db:
+            self.ensure_sheet(db, sheet_name, max(c for _, c, _ in cells))
+            for row_no, col, value in cells:
+                value = '' if value is None else str(value)
+                cur = db.execute(f'UPDATE {self.table(sheet_name)} SET c{col} = ? WHERE row_no = ?', (value, row_no))
+                if cur.rowcount == 0:
+                    db.execute(f'INSERT INTO {self.table(sheet_name)} (row_no, c{col}) VALUES (?, ?)', (row_no, value))
+            if any(r == 1 for r, _, _ in cells): self.ensure_indexes(db, sheet_name)
+            self.bump(db, sheet_name)
+            self.enqueue(db, sheet_name, 'update', {'cells': [[r, c, '' if v is None else str(v)] for r, c, v in cells]})
+
+    def append(self, sheet_name, rows, value_input_option='RAW'):
+        if not rows: return
+        with self.tx() as db:
+            width = self.ensure_sheet(db, sheet_name, max(len(r) for r in rows))
+            last = db.execute(f'SELECT MAX(row_no) FROM {self.table(sheet_name)}').fetchone()[0] or 0
+            cols = ', '.join(f'c{i}' for i in range(1, width + 1))
+            marks = ', '.join('?' * (width + 1))
+            rows = [['' if v is None else str(v) for v in r] for r in rows]
+            db.executemany(f'INSERT INTO {self.table(sheet_name)} (row_no, {cols}) VALUES ({marks})',
+                           [[last + i + 1] + r + [''] * (width - len(r)) for i, r in enumerate(rows)])
+            if last == 0: self.ensure_indexes(db, sheet_name)
+            self.bump(db, sheet_name)
+            # start = แถวที่ต้องไปอยู่บน Sheet -> Replicator เช็กได้ว่าเคยส่งไปแล้วหรือยัง
+            self.enqueue(db, sheet_name, 'append', {'rows': rows, 'value_input_option': value_input_option, 'start': last + 1})
+
+    def delete_rows(self, sheet_name, start, end=None):
+        end = end or start
+        count = end - start + 1
+        with self.tx() as db:
+            if self.width(db, sheet_name) is None: return
+            t = self.table(sheet_name)
+            deleted = [self.read_row(db, sheet_name, r) for r in range(start, end + 1)]
+            db.execute(f'DELETE FROM {t} WHERE row_no BETWEEN ? AND ?', (start, end))
+            # เลื่อนแถวขึ้นแบบ 2 จังหวะ (กัน Primary Key ชนกันระหว่าง UPDATE)
+            db.execute(f'UPDATE {t} SET row_no = -(row_no - ?) WHERE row_no > ?', (count, end))
+            db.execute(f'UPDATE {t} SET row_no = -row_no WHERE row_no < 0')
+            if start == 1: self.ensure_indexes(db, sheet_name)
+            self.bump(db, sheet_name)
+            # rows = ค่าที่ลบ -> Replicator เช็กว่าแถวบน Sheet ยังเป็นแถวเดิมก่อนลบซ้ำ
+            self.enqueue(db, sheet_name, 'delete', {'start': start, 'end': end, 'rows': deleted})
+
+    def add_sheet(self, sheet_name, rows, cols):
+        with self.tx() as db:
+            if self.width(db, sheet_name) is not None: return False
+            self.ensure_sheet(db, sheet_name, cols)
+            self.enqueue(db, sheet_name, 'add_sheet', {'rows': rows, 'cols': cols})
+        return True
+
+    def replace(self, sheet_name, values, only_if_idle=True):
+        """แทนที่ทั้งตารางด้วยข้อมูลจาก Sheet (ข้ามถ้ามีงานค้างใน outbox หรือข้อมูลเหมือนเดิม) -> True ถ้าเปลี่ยน"""
+        values = [self.trim(r) for r in values]
+        while values and not values[-1]: values.pop()
+        with self.tx() as db:
+            if only_if_idle and db.execute('SELECT 1 FROM outbox LIMIT 1').fetchone(): return False
+            current = self.width(db, sheet_name)
+            if current is not None and [self.trim(r) for r in self.values(sheet_name)] == values: return False
+            width = self.ensure_sheet(db, sheet_name, max([len(r) for r in values] + [1]))
+            t = self.table(sheet_name)
+            db.execute(f'DELETE FROM {t}')
+            cols = ', '.join(f'c{i}' for i in range(1, width + 1))
+            marks = ', '.join('?' * (width + 1))
+            db.executemany(f'INSERT INTO {t} (row_no, {cols}) VALUES ({marks})',
+                           [[i + 1] + [str(v) for v in r] + [''] * (width - len(r)) for i, r in enumerate(values)])
+            self.ensure_indexes(db, sheet_name)
+            self.bump(db, sheet_name)
+        return True
+
+    # --- outbox / lease สำหรับ Replicator ---
+    def pending(self, limit):
+        return [(i, s, op, json.loads(p)) for i, s, op, p in
+                self.conn().execute('SELECT id, sheet, op, payload FROM outbox ORDER BY id LIMIT ?', (limit,))]
+
+    def ack(self, last_id):
+        with self.tx() as db: db.execute('DELETE FROM outbox WHERE id <= ?', (last_id,))
+
+    def acquire_lease(self, name, owner, ttl):
+        """ให้มี Replicator ทำงานแค่ตัวเดียว แม้ Gunicorn จะมีหลาย Worker"""
+        now = time.time()
+        with self.tx() as db:
+            row = db.execute('SELECT owner, expires FROM lease WHERE name = ?', (name,)).fetchone()
+            if row and row[0] != owner and row[1] > now: return False
+            db.execute('INSERT OR REPLACE INTO lease (name, owner, expires) VALUES (?, ?, ?)', (name, owner, now + ttl))
+        return True
+
+def grid_to_records(values, numericise_ignore=()):
+    """ค่าดิบ [header, *rows] -> Records แบบเดียวกับ get_all_records ของ gspread (แปลงตัวเลขอัตโนมัติ)"""
+    if not values: return []
+    keys, rows = values[0], values[1:]
+    if list(numericise_ignore) != ['all']:
+        rows = [gspread.utils.numericise_all(r, False, '', False, list(numericise_ignore)) for r in rows]
+    return gspread.utils.to_records(keys, rows)
+
+class GridRecordsMixin:
+    """get_all_records แบบเดียวกับ gspread (แปลงตัวเลขอัตโนมัติ) จาก get_all_values"""
+
+    def get_all_records(self, numericise_ignore=(), **kw):
+        return grid_to_records(self.get_all_values(), numericise_ignore)
+
+class LocalWorksheet(GridRecordsMixin):
+    """Worksheet ที่อ่าน/เขียน Local Store ด้วย Method ชุดเดียวกับ gspread ที่แอปใช้"""
+
+    def __init__(self, store, title):
+        self.store = store
+        self.title = title
+
+    def get_all_values(self):
+        return self.store.values(self.title)
+
+    def row_values(self, row):
+        return self.store.row(self.title, row)
+
+    def col_values(self, col):
+        return self.store.column(self.title, col)
+
+    def batch_update(self, updates, **kw):
+        cells = []
+        for u in updates:
+            if ':' in u['range']:
+                start, _ = u['range'].split(':', 1)
             else:
-                return client.open("DriverLogApp")
-        except Exception as e:
-            if attempt == max_retries - 1:
-                print(f"Failed to connect to Google Sheet after {max_retries} attempts: {e}")
-                raise e
-            print(f"Google Sheet API Error (Attempt {attempt+1}/{max_retries}). Retrying...")
-            time.sleep(2)
-            
+                start = u['range']
+            row0, col0 = gspread.utils.a1_to_rowcol(start)
+            for i, row in enumerate(u['values']):
+                for j, value in enumerate(row):
+                    cells.append((row0 + i, col0 + j, value))
+        self.store.set_cells(self.title, cells)
+
+    def update_cell(self, row, col, value):
+        self.store.set_cells(self.title, [(row, col, value)])
+
+    def append_row(self, values, value_input_option='RAW', **kw):
+        self.store.append(self.title, [values], value_input_option)
+
+    def append_rows(self, values, value_input_option='RAW', **kw):
+        self.store.append(self.title, values, value_input_option)
+
+    def delete_rows(self, start_index, end_index=None):
+        self.store.delete_rows(self.title, start_index, end_index)
+
+class LocalSpreadsheet:
+    def __init__(self, store):
+        self.store = store
+
+    def data_version(self, title):
+        return self.store.version(title)
+
+    def worksheet(self, title):
+        if self.store.version(title) is None: raise gspread.exceptions.WorksheetNotFound(title)
+        return LocalWorksheet(self.store, title)
+
+    def add_worksheet(self, title, rows, cols):
+        self.store.add_sheet(title, rows, cols)
+        return LocalWorksheet(self.store, title)
+
+class SheetsReplicator(threading.Thread):
+    """ส่งคิว outbox ขึ้น Google Sheets เป็นชุด และดึงการแก้ไขใน Sheet กลับลง Local Store"""
+
+    def __init__(self, store, connect):
+        super().__init__(daemon=True, name='sheets-replicator')
+        self.store = store
+        self.connect = connect
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.remote = None
+        self.remote_sheets = {}
+        self.last_pull = 0
+        self.lease_until = 0
+        # True = กลุ่มแรกในคิวอาจถูกส่งไปแล้วแต่ยังไม่ได้ ack (Call ก่อนหน้า Error / ตัวอื่นเพิ่งถือ Lease)
+        self.uncertain = True
+
+    def connect_remote(self):
+        if self.remote is None:
+            self.remote = self.connect()
+            client = getattr(self.remote, 'client', None)
+            if client is not None: client.set_timeout(LOCAL_CALL_TIMEOUT)
+        return self.remote
+
+    def remote_ws(self, title):
+        if title not in self.remote_sheets:
+            self.remote_sheets[title] = self.connect_remote().worksheet(title)
+        return self.remote_sheets[title]
+
+    def hold_lease(self):
+        """ต่ออายุ Lease ก่อนส่งทุกกลุ่ม (Fencing) -> False = ตัวอื่นถือแทนแล้ว ต้องหยุดส่ง"""
+        now = time.time()
+        if not self.store.acquire_lease('replicator', self.owner, LOCAL_LEASE_TTL):
+            self.lease_until = 0
+            return False
+        if now >= self.lease_until: self.uncertain = True
+        self.lease_until = now + LOCAL_LEASE_TTL
+        return True
+
+    def remote_rows(self, sheet_name):
+        return [LocalStore.trim(r) for r in self.remote_ws(sheet_name).get_all_values()]
+
+    def unsent_rows(self, sheet_name, start, rows):
+        """แถวที่ยังไม่ขึ้น Sheet: ตัดแถวต้นกลุ่มที่อยู่ที่ตำแหน่ง start.. บน Sheet แล้ว (ส่งสำเร็จแต่ไม่ได้ ack)"""
+        remote = self.remote_rows(sheet_name)[start - 1:]
+        sent = 0
+        while sent < len(rows) and sent < len(remote) and remote[sent] == LocalStore.trim(rows[sent]): sent += 1
+        return rows[sent:]
+
+    def push(self):
+        """รวม Op ที่ติดกันของ Sheet เดียวกันเป็น 1 API Call (ยืนยันทีละกลุ่ม ถ้าพังกลางทางจะส่งต่อจากจุดเดิม)"""
+        ops = self.store.pending(LOCAL_PUSH_BATCH)
+        i = 0
+        while i < len(ops):
+            if not self.hold_lease(): break
+            op_id, sheet_name, op, payload = ops[i]
+            if op == 'update':
+                cells, j = [], i
+                while j < len(ops) and ops[j][1] == sheet_name and ops[j][2] == 'update':
+                    cells.extend(ops[j][3]['cells']); j += 1
+                latest = {}
+                for r, c, v in cells: latest[(r, c)] = v
+                self.remote_ws(sheet_name).batch_update(
+                    [{'range': gspread.utils.rowcol_to_a1(r, c), 'values': [[v]]} for (r, c), v in latest.items()],
+                    value_input_option='RAW')
+            elif op == 'append':
+                rows, j = [], i
+                while (j < len(ops) and ops[j][1] == sheet_name and ops[j][2] == 'append'
+                       and ops[j][3]['value_input_option'] == payload['value_input_option']):
+                    rows.extend(ops[j][3]['rows']); j += 1
+                if self.uncertain and payload.get('start'): rows = self.unsent_rows(sheet_name, payload['start'], rows)
+                if rows: self.remote_ws(sheet_name).append_rows(rows, value_input_option=payload['value_input_option'])
+            elif op == 'delete':
+                j = i + 1
+                expected = payload.get('rows')
+                if (self.uncertain and expected is not None
+                        and self.remote_rows(sheet_name)[payload['start'] - 1:payload['end']] != expected):
+                    print(f"Replicator: skip delete {sheet_name} rows {payload['start']}-{payload['end']} (already deleted or changed)")
+                else:
+                    self.remote_ws(sheet_name).delete_rows(payload['start'], payload['end'])
+            else:  # add_sheet
+                j = i + 1
+                try: self.remote_sheets[sheet_name] = self.connect_remote().add_worksheet(title=sheet_name, rows=payload['rows'], cols=payload['cols'])
+                except gspread.exceptions.APIError: pass  # มี Sheet ชื่อนี้อยู่แล้ว
+            self.store.ack(ops[j - 1][0])
+            self.uncertain = False
+            i = j
+        return i
+
+    def pull(self):
+        """อ่านทุก Worksheet ใน 1 API Call (values_batch_get) แล้วแทนที่ตารางที่ข้อมูลไม่ตรง"""
+        remote = self.connect_remote()
+        titles = [ws.title for ws in remote.worksheets()]
+        result = remote.values_batch_get(["'" + t.replace("'", "''") + "'" for t in titles])
+        changed = []
+        for title, value_range in zip(titles, result.get('valueRanges', [])):
+            if self.store.replace(title, value_range.get('values', [])): changed.append(title)
+        self.last_pull = time.time()
+        return changed
+
+    def run(self):
+        while True:
+            try:
+                if self.hold_lease():
+                    self.push()
+                    if time.time() - self.last_pull >= LOCAL_PULL_INTERVAL and self.hold_lease(): self.pull()
+            except Exception as e:
+                print(f"Replicator Error: {e}")
+                self.remote, self.remote_sheets = None, {}
+                self.uncertain = True
+                time.sleep(LOCAL_PUSH_INTERVAL * 5)
+            time.sleep(LOCAL_PUSH_INTERVAL)
+
+def get_local_spreadsheet():
+    """เปิด Local Store (ครั้งแรกที่ยังว่างจะดึงข้อมูลจาก Google Sheets มาก่อน) และเริ่ม Replicator"""
+    with local_store_lock:
+        if local_store_state['store'] is None:
+            store = LocalStore(LOCAL_DB_PATH)
+            replicator = SheetsReplicator(store, get_sheets_db)
+            if not store.sheet_names(): replicator.pull()
+            replicator.start()
+            local_store_state.update(store=store, replicator=replicator)
+    return LocalSpreadsheet(local_store_state['store'])
+
+def find_jobs(sheet, fresh=False, **filters):
+    """
+    งานที่ค่าตรงตาม filters (เช่น PO_Date=..., Round=..., Car_No=...) เรียงตามแถว
+    Local Store ใช้ SQL + Index / Google Sheets ใช้ Cache (หรืออ่านใหม่ถ้า fresh=True) แล้วกรองเอง
+    """
+    if isinstance(sheet, LocalSpreadsheet):
+        header = sheet.store.row('Jobs', 1)
+        rows = [values for _, values in sheet.store.select('Jobs', filters)]
+        return gspread.utils.to_records(header, [gspread.utils.numericise_all(r, False, '', False, []) for r in rows])
+    raw_jobs = sheet.worksheet('Jobs').get_all_records() if fresh else get_cached_records(sheet, 'Jobs')
+    wanted = {k: str(v).strip() for k, v in filters.items()}
+    return [j for j in raw_jobs if all(str(j.get(k, '')).strip() == v for k, v in wanted.items())]
+
+# ==========================================
+# [Repository] ชั้นเข้าถึงข้อมูลที่ Route ใช้ (Route ไม่เรียก gspread ตรง)
+# ==========================================
+# Backend ที่ใช้ได้: Google Sheets (gspread), Local Store (SQLite) และ In-memory (MemorySpreadsheet)
+# ทุกตัวมี Method แบบ gspread ชุดเดียวกัน Repository จึงเขียนครั้งเดียวใช้ได้ทุก Backend
+# ตั้ง MEMORY_DB_SEED=ไฟล์ JSON {ชื่อ Sheet: [[แถว], ...]} หรือเรียก use_memory_backend() = ทำงานโดยไม่ต่อเน็ต
+MEMORY_DB_SEED = os.environ.get('MEMORY_DB_SEED', '')
+memory_backend_state = {'sheet': None}
+
+class MemoryWorksheet(GridRecordsMixin):
+    """Worksheet ใน Memory (ค่าทุกช่องเก็บเป็น String เหมือนค่าที่ Sheets แสดง)"""
+
+    def __init__(self, spreadsheet, title, rows=None):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.rows = [['' if v is None else str(v) for v in r] for r in (rows or [])]
+
+    def changed(self):
+        self.spreadsheet.versions[self.title] = self.spreadsheet.versions.get(self.title, 0) + 1
+
+    def get_all_values(self):
+        rows = [LocalStore.trim(r) for r in self.rows]
+        while rows and not rows[-1]: rows.pop()
+        width = max((len(r) for r in rows), default=0)
+        return [r + [''] * (width - len(r)) for r in rows]
+
+    def row_values(self, row):
+        return LocalStore.trim(self.rows[row - 1]) if 0 < row <= len(self.rows) else []
+
+    def col_values(self, col):
+        return LocalStore.trim([r[col - 1] if len(r) >= col else '' for r in self.rows])
+
+    def set_cell(self, row, col, value):
+        while len(self.rows) < row: self.rows.append([])
+        cells = self.rows[row - 1]
+        while len(cells) < col: cells.append('')
+        cells[col - 1] = '' if value is None else str(value)
+
+    def batch_update(self, updates, **kw):
+        for u in updates:
+            row0, col0 = gspread.utils.a1_to_rowcol(u['range'].split(':', 1)[0])
+            for i, row in enumerate(u['values']):
+                for j, value in enumerate(row): self.set_cell(row0 + i, col0 + j, value)
+        self.changed()
+
+    def update_cell(self, row, col, value):
+        self.set_cell(row, col, value)
+        self.changed()
+
+    def append_row(self, values, **kw):
+        self.append_rows([values])
+
+    def append_rows(self, values, **kw):
+        while self.rows and not LocalStore.trim(self.rows[-1]): self.rows.pop()
+        self.rows.extend(['' if v is None else str(v) for v in r] for r in values)
+        self.changed()
+
+    def delete_rows(self, start_index, end_index=None):
+        del self.rows[start_index - 1:end_index or start_index]
+        self.changed()
+
+class MemorySpreadsheet:
+    def __init__(self, sheets=None):
+        self.versions = {}
+        self.sheets = {title: MemoryWorksheet(self, title, rows) for title, rows in (sheets or {}).items()}
+
+    @classmethod
+    def from_json(cls, path):
+        with open(path, encoding='utf-8') as f: return cls(json.load(f))
+
+    def data_version(self, title):
+        return self.versions.get(title, 0) if title in self.sheets else None
+
+    def worksheet(self, title):
+        if title not in self.sheets: raise gspread.exceptions.WorksheetNotFound(title)
+        return self.sheets[title]
+
+    def worksheets(self):
+        return list(self.sheets.values())
+
+    def add_worksheet(self, title, rows, cols):
+        if title not in self.sheets: self.sheets[title] = MemoryWorksheet(self, title)
+        return self.sheets[title]
+
+    def values_batch_get(self, ranges, params=None):
+        return {'valueRanges': [{'range': r, 'values': [LocalStore.trim(v) for v in self.worksheet(r.strip("'").replace("''", "'")).get_all_values()]}
+                                for r in ranges]}
+
+def use_memory_backend(sheets=None):
+    """ใช้ In-memory Backend แทน Google Sheets (ทดสอบ/วัดประสิทธิภาพแบบไม่ต่อเน็ต) -> MemorySpreadsheet"""
+    sheet = sheets if isinstance(sheets, MemorySpreadsheet) else MemorySpreadsheet(sheets)
+    memory_backend_state['sheet'] = sheet
+    for name in list(cache_storage): invalidate_cache(name)
+    daily_rollups['days'] = None
+    return sheet
+
+def get_memory_spreadsheet():
+    if memory_backend_state['sheet'] is None:
+        use_memory_backend(MemorySpreadsheet.from_json(MEMORY_DB_SEED))
+    return memory_backend_state['sheet']
+
+def open_log_sheet(sheet, title, header):
+    """Worksheet สำหรับเก็บ Log (สร้างพร้อมหัวคอลัมน์ถ้ายังไม่มี) -> (ws, สร้างใหม่หรือไม่)"""
+    try:
+        return sheet.worksheet(title), False
+    except gspread.exceptions.WorksheetNotFound:
+        ws = sheet.add_worksheet(title=title, rows=1000, cols=len(header))
+        ws.append_row(header)
+        return ws, True
+
+# เลขแถวของ Sheet เลื่อนได้เมื่อมีการลบแถว -> งานที่อ่านเลขแถวแล้วเขียน/ลบตาม ถือ Lock นี้ตลอดช่วง (ภายใน Process)
+# RLock: Route ที่ตรวจแถวก่อนเขียนถือไว้ครอบ Method ของ Repository ได้
+jobs_write_lock = threading.RLock()
+
+class JobsRepository:
+    """งานขนส่ง (Worksheet Jobs) อ่านผ่าน Cache / เขียนแบบ Batch แล้วอัปเดต Cache ให้"""
+
+    lock = jobs_write_lock
+
+    def __init__(self, sheet):
+        self.sheet = sheet
+        self._ws = None
+
+    @property
+    def ws(self):
+        if self._ws is None: self._ws = self.sheet.worksheet('Jobs')
+        return self._ws
+
+    def all(self):
+        return get_cached_records(self.sheet, 'Jobs')
+
+    def find_by_date(self, po_date, fresh=False):
+        return find_jobs(self.sheet, fresh=fresh, PO_Date=po_date)
+
+    def find_trip(self, po_date, round_time, car_no, fresh=False):
+        return find_jobs(self.sheet, fresh=fresh, PO_Date=po_date, Round=round_time, Car_No=car_no)
+
+    def grid(self):
+        """ค่าล่าสุดทั้ง Sheet (แถวหัวตาราง = index 0) ใช้หาเลขแถวก่อนเขียน"""
+        with request_phase('fetch'): return self.ws.get_all_values()
+
+    def row(self, row_id):
+        with request_phase('fetch'): return self.ws.row_values(row_id)
+
+    def columns(self, grid=None):
+        """ColumnMap ของ Jobs (ส่ง grid ที่เพิ่งอ่านมาเพื่อใช้หัวตารางล่าสุด)"""
+        return get_jobs_column_map(self.sheet, grid[0] if grid else None)
+
+    @staticmethod
+    def trip_row_ids(grid, columns, po_date, round_time, car_no, min_field='Car_No'):
+        """เลขแถวของทุกสาขาในเที่ยว (เทียบ PO_Date, Round, Car_No แบบ String)"""
+        target = (str(po_date), str(round_time), str(car_no))
+        return [i + 1 for i, row in enumerate(grid)
+                if i > 0 and columns.has(row, min_field) and columns.values(row, TRIP_KEY_FIELDS) == target]
+
+    def update_steps(self, cells, sheet_rows, columns):
+        """เขียน เวลา / พิกัด / Status ใน batch_update เดียว แล้วเขียนตามลง Cache (Write-through)"""
+        self.update_cells(cells, sheet_rows, columns)
+
+    def update_cells(self, cells, sheet_rows, columns):
+        """cells: [(row_id, ชื่อคอลัมน์, ค่า)] เขียนใน batch_update เดียว แล้วเขียนตามลง Cache"""
+        if not cells:
+            invalidate_cache('Jobs')
+            return
+        with self.lock:
+            self.ws.batch_update(step_cells_to_batch(cells, columns))
+            patch_cached_rows(self.sheet, 'Jobs', cells, sheet_rows, columns)
+
+    def append_jobs(self, records):
+        """records: [{ชื่อคอลัมน์: ค่า}] เรียงลงช่องตามหัวตาราง"""
+        if not records: return
+        columns = self.columns()
+        with self.lock:
+            self.ws.append_rows([columns.build_row(r) for r in records])
+            invalidate_cache('Jobs')
+
+    def delete_trip(self, po_date, round_time, car_no):
+        with self.lock:
+            grid = self.grid()
+            row_ids = self.trip_row_ids(grid, self.columns(grid), po_date, round_time, car_no)
+            try:
+                for row_id in sorted(row_ids, reverse=True):
+                    self.ws.delete_rows(row_id)
+            finally:
+                invalidate_cache('Jobs')
+        return len(row_ids)
+
+    def delete_rows_matching(self, match, batch):
+        """
+        ลบทุกแถวที่ match(columns, row) เป็นจริง ทีละช่วงจากล่างขึ้นบน -> จำนวนแถวที่ลบ
+        อ่าน Sheet ใหม่ก่อนลบทุกช่วง (ระหว่างรอ Rate Limit แถวอาจเลื่อน) จึงไม่ลบแถวของงานอื่น
+        """
+        deleted, previous = 0, None
+        while True:
+            with self.lock:
+                grid = self.grid()
+                columns = self.columns(grid)
+                row_ids = [i + 1 for i, row in enumerate(grid) if i > 0 and match(columns, row)]
+                if not row_ids: return deleted
+                if row_ids == previous: raise RuntimeError(f'ลบแถว {row_ids[0]}-{row_ids[-1]} ไม่สำเร็จ')
+                start, end = row_ranges(row_ids, batch)[0]
+                try:
+                    self.ws.delete_rows(start, end)
+                finally:
+                    invalidate_cache('Jobs')
+                deleted += end - start + 1
+                previous = row_ids
+
+    def reassign_driver(self, po_date, round_time, car_no, driver, plate):
+        """เปลี่ยนคนขับ/ทะเบียนทั้งเที่ยว -> จำนวนแถวที่แก้"""
+        with self.lock:
+            grid = self.grid()
+            columns = self.columns(grid)
+            row_ids = self.trip_row_ids(grid, columns, po_date, round_time, car_no, min_field='Plate')
+            if row_ids:
+                cells = [(row_id, field, value) for row_id in row_ids for field, value in (('Driver', driver), ('Plate', plate))]
+                self.ws.batch_update(step_cells_to_batch(cells, columns))
+                invalidate_cache('Jobs')
+        return len(row_ids)
+
+class DriversRepository:
+    """รายชื่อคนขับ (Worksheet Drivers)"""
+
+    def __init__(self, sheet):
+        self.sheet = sheet
+
+    def all(self, fresh=False):
+        return self.sheet.worksheet('Drivers').get_all_records() if fresh else get_cached_records(self.sheet, 'Drivers')
+
+    def plate_of(self, name, fresh=False):
+        for d in self.all(fresh):
+            if d['Name'] == name: return d['Plate_License']
+        return ""
+
+class UsersRepository:
+    """บัญชีผู้จัดการ (Worksheet Users)"""
+
+    def __init__(self, sheet):
+        self.sheet = sheet
+
+    def all(self):
+        # อ่านเป็น Text ทั้งหมด (รหัสที่ขึ้นต้นด้วย 0 ไม่ถูกแปลงเป็นตัวเลข)
+        return self.sheet.worksheet('Users').get_all_records(numericise_ignore=['all'])
+
+class LogRepository:
+    """Worksheet ที่เขียนต่อท้ายอย่างเดียวตามเวลา (StepEvents / PODetails / NotifyLogs / DailyRollups)"""
+
+    def __init__(self, sheet, title, header):
+        self.sheet = sheet
+        self.title = title
+        self.header = header
+        self._ws = None
+        self.created = False
+
+    @property
+    def ws(self):
+        if self._ws is None: self.open()
+        return self._ws
+
+    def open(self):
+        """เปิด Worksheet (สร้างพร้อมหัวคอลัมน์ถ้ายังไม่มี) -> True ถ้าเพิ่งสร้าง"""
+        self._ws, self.created = open_log_sheet(self.sheet, self.title, self.header)
+        return self.created
+
+    def existing_ws(self):
+        """Worksheet ที่มีอยู่แล้ว / ยังไม่มี -> None (อ่านอย่างเดียวไม่ต้องสร้าง)"""
+        if self._ws is None:
+            try: self._ws = self.sheet.worksheet(self.title)
+            except gspread.exceptions.WorksheetNotFound: return None
+        return self._ws
+
+    def values(self):
+        ws = self.existing_ws()
+        if ws is None: return []
+        with request_phase('fetch'): return ws.get_all_values()
+
+    def column(self, name):
+        """ค่าทั้งคอลัมน์ (ไม่รวมหัวตาราง)"""
+        ws = self.existing_ws()
+        if ws is None: return []
+        with request_phase('fetch'): return ws.col_values(self.header.index(name) + 1)[1:]
+
+    def append(self, rows):
+        if rows: self.ws.append_rows(rows, value_input_option='RAW')
+
+    def count_before(self, name, before):
+        """จำนวนแถวบนสุดที่วันที่ในคอลัมน์ name เก่ากว่า before (Log เรียงตามเวลา -> หยุดที่แถวแรกที่ไม่เก่ากว่า)"""
+        count = 0
+        for value in self.column(name):
+            if not value or value[:10] >= before: break
+            count += 1
+        return count
+
+    def delete_first(self, count):
+        """ลบ count แถวแรกต่อจากหัวตารางในครั้งเดียว"""
+        if count: self.ws.delete_rows(2, count + 1)
+
+# ==========================================
+# [Login] ดัชนีรหัสผ่านผู้จัดการ: อ่าน Users ครั้งเดียวแล้วเก็บเป็น Hash ค้นด้วย Username
+# ==========================================
+# รหัสใน Sheet เป็นได้ทั้งข้อความธรรมดา (เก็บใน Memory เป็น HMAC-SHA256 ด้วย Key สุ่มของ Process)
+# และ Hash ของ werkzeug (pbkdf2:... / scrypt:...) ตรวจแบบเวลาคงที่ทั้งคู่
+# ดัชนีอยู่ได้ USERS_INDEX_TTL วินาที (Local / In-memory Backend โหลดใหม่ทันทีเมื่อ Users เปลี่ยน)
+# เพิ่มผู้ใช้/เปลี่ยนรหัสใน Sheet: กด /reload_users หรือรอ Login ที่ไม่ผ่านโหลดใหม่ให้ (ไม่เกิน 1 ครั้งต่อ USERS_MISS_REFRESH วินาที)
+USERS_INDEX_TTL = int(os.environ.get('USERS_INDEX_TTL', str(6 * 3600)))
+USERS_MISS_REFRESH = 60
+STORED_HASH_PREFIXES = ('pbkdf2:', 'scrypt:')
+CREDENTIALS_KEY = os.urandom(32)
+credentials_index = {'users': None, 'loaded_at': 0, 'store_version': None, 'versioned': False, 'miss_refresh_at': 0}
+credentials_lock = threading.Lock()
+
+def password_digest(password):
+    return hmac.new(CREDENTIALS_KEY, str(password).encode('utf-8'), hashlib.sha256).digest()
+
+def build_credentials_index(records):
+    """Username -> [('hash', werkzeug hash) | ('digest', HMAC)] (ชื่อซ้ำได้หลายรหัสเหมือนเดิม)"""
+    users = {}
+    for user in records:
+        username = str(user.get('Username', ''))
+        password = str(user.get('Password', ''))
+        if not username: continue
+        entry = ('hash', password) if password.startswith(STORED_HASH_PREFIXES) else ('digest', password_digest(password))
+        users.setdefault(username, []).append(entry)
+    return users
+
+def get_credentials_index(refresh=False):
+    index = credentials_index
+    with credentials_lock:
+        sheet = None
+        if not refresh and index['users'] is not None and time.time() - index['loaded_at'] < USERS_INDEX_TTL:
+            if not index['versioned']: return index['users']
+            sheet = get_db()  # Local / In-memory: เช็ค Version ไม่เสีย API
+            if sheet.data_version('Users') == index['store_version']: return index['users']
+        sheet = sheet or get_db()
+        records = UsersRepository(sheet).all()
+        versioned = hasattr(sheet, 'data_version')
+        index.update(users=build_credentials_index(records), loaded_at=time.time(), versioned=versioned,
+                     store_version=sheet.data_version('Users') if versioned else None)
+        dummy_password_hash(index['users'])  # สร้าง Hash สุ่มตอนโหลด ไม่ให้ Login แรกที่ไม่พบชื่อช้ากว่าปกติ
+        return index['users']
+
+def invalidate_credentials():
+    credentials_index['users'] = None
+
+dummy_password_hashes = {}  # method ของ Hash ใน Users -> Hash ของรหัสสุ่ม
+
+def dummy_password_hash(users):
+    """Hash แบบเดียวกับที่เก็บใน Users สำหรับตรวจตอนไม่พบชื่อ (ไม่มี Hash ใน Users -> None)"""
+    for entries in users.values():
+        for kind, secret in entries:
+            if kind != 'hash': continue
+            method = secret.split('$', 1)[0]
+            if method not in dummy_password_hashes:
+                try: dummy_password_hashes[method] = generate_password_hash(os.urandom(16).hex(), method=method)
+                except ValueError: dummy_password_hashes[method] = secret  # method ที่ werkzeug สร้างไม่ได้ -> ใช้ Hash เดิม (ไม่สนผล)
+            return dummy_password_hashes[method]
     return None
 
+def check_credentials(users, username, password):
+    digest = password_digest(password)
+    entries = users.get(username)
+    if not entries:
+        # ให้เวลาตอบใกล้เคียงกรณีมีชื่อผู้ใช้ (Users มี Hash pbkdf2/scrypt -> ตรวจกับ Hash สุ่มแบบเดียวกัน)
+        dummy = dummy_password_hash(users)
+        if dummy: check_password_hash(dummy, password)
+        hmac.compare_digest(digest, digest)
+        return False
+    matched = False
+    for kind, secret in entries:
+        matched |= check_password_hash(secret, password) if kind == 'hash' else hmac.compare_digest(digest, secret)
+    return matched
+
+def verify_login(username, password):
+    if check_credentials(get_credentials_index(), username, password): return True
+    now = time.time()
+    if now - credentials_index['miss_refresh_at'] < USERS_MISS_REFRESH: return False
+    credentials_index['miss_refresh_at'] = now
+    return check_credentials(get_credentials_index(refresh=True), username, password)
+
+@app.route('/reload_users', methods=['POST'])
+def reload_users():
+    """โหลดรายชื่อ/รหัสผู้จัดการจาก Sheet ใหม่ทันที (หลังแก้ Users)"""
+    if 'user' not in session: return json.dumps({'status': 'error', 'message': 'Unauthorized'}), 401
+    invalidate_credentials()
+    users = get_credentials_index()
+    return json.dumps({'status': 'success', 'count': len(users)})
+
 # [Updated Login Route with Better Error Handling]
 @app.route('/manager_login', methods=['GET', 'POST'])
 def manager_login():
@@ -414,12 +2073,9 @@ def manager_login():
         username = request.form['username']
         password = request.form['password']
         try:
-            sheet = get_db()
-            users = get_cached_records(sheet, 'Users')
-            for user in users:
-                if str(user['Username']) == username and str(user['Password']) == password:
-                    session['user'] = username
-                    return redirect(url_for('manager_dashboard'))
+            if verify_login(username, password):
+                session['user'] = username
+                return redirect(url_for('manager_dashboard'))
             return render_template('login.html', error="ชื่อผู้ใช้หรือรหัสผ่านไม่ถูกต้อง")
         except Exception as e: 
             err_msg = str(e)
@@ -441,15 +2097,19 @@ def manager_dashboard():
     today_date = now_thai.strftime("%Y-%m-%d")
     if not date_filter: date_filter = today_date
 
-    filtered_jobs = [j for j in raw_jobs if str(j['PO_Date']).strip() == str(date_filter).strip()]
+    filtered_jobs = JobsRepository(sheet).find_by_date(str(date_filter).strip()) or archived_jobs(str(date_filter).strip())
     def sort_key(j):
         try: c = int(str(j['Car_No']).strip())
         except: c = 99999
         return (str(j['PO_Date']), c, str(j['Round']))
-    filtered_jobs = sorted(filtered_jobs, key=sort_key)
+    # Copy ก่อนเติม doc_recorded / is_start_late / delay_msg / late_duration (ไม่แก้ Dict ใน Cache)
+    filtered_jobs = sorted((dict(j) for j in filtered_jobs), key=sort_key)
     
+    po_index = get_po_detail_index(sheet)
+
     # [UPDATED] Logic คำนวณเวลาเข้าสายแบบละเอียด (ชั่วโมง/นาที)
     for job in filtered_jobs:
+        job['doc_recorded'] = job_has_doc(job, po_index)
         job['is_start_late'] = False
         job['delay_msg'] = ""
         
@@ -615,7 +2275,7 @@ def manager_dashboard():
     line_data_day.sort(key=lambda x: x['round'])
     line_data_night.sort(key=lambda x: (int(x['round'].split(':')[0]) + 24 if int(x['round'].split(':')[0]) < 6 else int(x['round'].split(':')[0])))
 
-    all_dates = sorted(list(set([str(j['PO_Date']).strip() for j in raw_jobs])), reverse=True)
+    all_dates = analytics_po_dates(sheet)
     try:
         curr = datetime.strptime(date_filter, "%Y-%m-%d")
         prev = (curr - timedelta(days=1)).strftime("%Y-%m-%d")
@@ -633,7 +2293,7 @@ def manager_dashboard():
                            late_arrivals_by_po=late_arrivals_by_po, total_late_cars=total_late_cars,
                            driver_stats=driver_stats, idle_drivers_day=idle_drivers_day,
                            idle_drivers_night=idle_drivers_night, idle_drivers_hybrid=idle_drivers_hybrid,
-                           idle_drivers_new=idle_drivers_new, shift_status=shift_status)
+                           idle_drivers_new=idle_drivers_new, shift_status=shift_status, export_async=EXPORT_ASYNC)
                            
 # ==========================================
 # [UPDATED] Create Job Function
@@ -642,7 +2302,7 @@ def manager_dashboard():
 def create_job():
     if 'user' not in session: return redirect(url_for('manager_login'))
     sheet = get_db()
-    ws = sheet.worksheet('Jobs')
+    jobs_repo = JobsRepository(sheet)
     
     po_date = request.form['po_date']
     load_date = request.form['load_date']
@@ -661,31 +2321,19 @@ def create_job():
         po_str_to_save = ",".join(po_lines)
     # ---------------------------------------------
     
-    drivers_ws = sheet.worksheet('Drivers')
-    driver_list = drivers_ws.get_all_records()
-    plate = ""
-    for d in driver_list:
-        if d['Name'] == driver_name:
-            plate = d['Plate_License']
-            break
+    plate = DriversRepository(sheet).plate_of(driver_name, fresh=True)
             
     new_rows = []
     for branch in branches:
         if branch.strip(): 
-            # สร้างแถวข้อมูล โดยใส่ PO ลงใน Column Z (ลำดับที่ 26)
-            row = [
-                po_date, load_date, round_time, car_no, driver_name, plate, branch, weight, 
-                "", "", "", "", "", "", "", "", "New",  # ถึง Column Q (17)
-                "", "", "", "", "", "", "", "",         # Column R-Y (18-25)
-                po_str_to_save,                         # Column Z (26) : PO_Nos
-                "",                                     # Column AA (27) : Doc_Result
-                ""                                      # Column AB (28) : Weight_Result
-            ]
-            new_rows.append(row)
+            # ระบุตามชื่อคอลัมน์ ช่องที่ไม่ระบุ (T1-T8, L1-L8, Doc_Result, ...) เว้นว่าง
+            new_rows.append({
+                'PO_Date': po_date, 'Load_Date': load_date, 'Round': round_time, 'Car_No': car_no,
+                'Driver': driver_name, 'Plate': plate, 'Branch_Name': branch, 'Weight': weight,
+                'Status': 'New', 'PO_Nos': po_str_to_save
+            })
     
-    if new_rows: 
-        ws.append_rows(new_rows)
-        invalidate_cache('Jobs')
+    jobs_repo.append_jobs(new_rows)
     
     return redirect(url_for('manager_dashboard'))
 
@@ -693,442 +2341,1429 @@ def create_job():
 def delete_job():
     if 'user' not in session: return redirect(url_for('manager_login'))
     sheet = get_db()
-    ws = sheet.worksheet('Jobs')
     
     po_date = request.form['po_date']
     round_time = request.form['round_time']
     car_no = request.form['car_no']
     
     try:
-        all_values = ws.get_all_values()
-        rows_to_delete = []
-        
-        for i, row in enumerate(all_values):
-            if i > 0: 
-                if (row[0] == po_date and 
-                    str(row[2]) == str(round_time) and  
-                    str(row[3]) == str(car_no)):        
-                    rows_to_delete.append(i + 1)
-                    
-        for row_idx in sorted(rows_to_delete, reverse=True):
-            ws.delete_rows(row_idx)
-        
-        invalidate_cache('Jobs')
-            
+        JobsRepository(sheet).delete_trip(po_date, round_time, car_no)
         return redirect(url_for('manager_dashboard'))
     except Exception as e: return f"Error: {e}"
 
-@app.route('/export_excel')
-def export_excel():
-    sheet = get_db()
-    raw_jobs = get_cached_records(sheet, 'Jobs')
-    
-    date_filter = request.args.get('date_filter')
-    if date_filter:
-        jobs = [j for j in raw_jobs if str(j['PO_Date']).strip() == str(date_filter).strip()]
-    else:
-        jobs = raw_jobs
-        
-    def sort_key_func(job):
-        po_date = str(job['PO_Date'])
-        car_no_str = str(job['Car_No']).strip()
-        round_val = str(job['Round'])
-        try: car_no_int = int(car_no_str)
-        except ValueError: car_no_int = 99999 
-        return (po_date, car_no_int, round_val)
+# ==========================================
+# [Analytics] Jobs แบบ Columnar (pandas) สร้างครั้งเดียวต่อ Version ของข้อมูล Jobs
+# ==========================================
+# ใช้กับงานที่ต้องกวาดทั้งตาราง (รายชื่อวันที่, สรุปรายวัน, Fingerprint ของ Export, ปฏิทิน)
+# งานระดับวันเดียว (~1 พันแถว) ยังใช้ Loop เดิม เพราะ Overhead ของ DataFrame มากกว่าตัว Loop
+ANALYTICS_TEXT_COLS = ['PO_Date', 'Load_Date', 'Round', 'Car_No', 'Driver', 'Branch_Name', 'Status']
+jobs_frame_state = {'version': None, 'frame': None, 'records': None, 'derived': {}}
 
-    jobs = sorted(jobs, key=sort_key_func)
-    
-    export_data = []
-    prev_trip_key = None
-    
-    grouped_jobs_for_summary = []
-    current_group = []
-    
-    for job_index, job in enumerate(jobs):
-        current_trip_key = (str(job['PO_Date']), str(job['Car_No']), str(job['Round']), str(job['Driver']))
-        is_same = (current_trip_key == prev_trip_key)
-        
-        if current_trip_key != prev_trip_key and prev_trip_key is not None:
-            grouped_jobs_for_summary.append(current_group)
-            current_group = []
-        current_group.append(job)
-        
-        t2_display = job['T2_StartLoad']
-        if not is_same and job['T2_StartLoad']: 
-            try:
-                plan_time_str = str(job['Round']).strip()
-                actual_time_str = str(job['T2_StartLoad']).strip()
-                if plan_time_str and actual_time_str:
-                    fmt = "%H:%M" if len(plan_time_str) <= 5 else "%H:%M:%S"
-                    fmt_act = "%H:%M" if len(actual_time_str) <= 5 else "%H:%M:%S"
-                    t_plan = datetime.strptime(plan_time_str, fmt)
-                    t_act = datetime.strptime(actual_time_str, fmt_act)
-                    
-                    if (t_plan - t_act).total_seconds() > 12 * 3600:
-                        t_act = t_act + timedelta(days=1)
-                    
-                    if t_act > t_plan:
-                        diff = t_act - t_plan
-                        total_seconds = diff.total_seconds()
-                        hours = int(total_seconds // 3600)
-                        minutes = int((total_seconds % 3600) // 60)
-                        delay_msg = f" (ล่าช้า {hours} ชม. {minutes} น.)"
-                        t2_display = f"{actual_time_str}{delay_msg}"
-            except: pass 
+def text_column(values, strip=True):
+    """
+    คอลัมน์ Text -> Categorical (factorize ทั้งคอลัมน์ครั้งเดียว)
+    ไม่มี pyarrow ทำให้ .str ของ pandas วน Loop ทีละแถว แต่คอลัมน์ใน Jobs ซ้ำกันมาก (วันที่, รอบ, เวลา, ชื่อ)
+    จึงแปลง/คำนวณกับ categories (หลักพันค่า) แล้วกระจายกลับด้วย codes แทน
+    """
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object), use_na_sentinel=False)
+    text = pd.Series(uniques, dtype=object).fillna('').astype(str)
+    if strip: text = text.str.strip()
+    merged, categories = pd.factorize(text.to_numpy(dtype=object))
+    return pd.Categorical.from_codes(merged[codes], pd.Index(categories, dtype=object))
+
+def by_category(column, fn):
+    """ใช้ fn กับ categories ของ Categorical แล้วกระจายผลกลับทุกแถวตาม codes"""
+    return np.asarray(fn(pd.Series(column.categories, dtype=object)))[column.codes]
+
+def hhmm_minutes(text):
+    """Series 'HH:MM' / 'HH:MM:SS' -> นาทีนับจากเที่ยงคืน (ว่าง/ผิดรูปแบบ = NaN)"""
+    parts = text.str.extract(r'^(\d{1,2}):(\d{2})(?::\d{2})?$')
+    hour, minute = pd.to_numeric(parts[0], errors='coerce'), pd.to_numeric(parts[1], errors='coerce')
+    return (hour * 60 + minute).where((hour < 24) & (minute < 60))
+
+def build_jobs_frame(records, header):
+    """
+    Records ของ Jobs -> DataFrame ชนิดข้อมูลชัดเจน 1 แถวต่อ 1 สาขา
+    po_date/load_date/round/car_no/driver/branch/status (Category, strip แล้ว ยกเว้น driver/car_raw), po_dt/load_dt (datetime),
+    round_min และ t1..t8 (นาทีนับจากเที่ยงคืน), t1_set..t8_set (มีค่าหรือไม่), shift, trip (เลขเที่ยว), start_delay (นาที),
+    row_hash (Hash ของทุกคอลัมน์ในแถว ใช้ทำ Fingerprint) / frame.attrs['header'] = หัวตารางตามลำดับใน Sheet
+    header = หัวตารางจริง (ColumnMap.names) Key อื่นที่ติดมากับ Record ไม่นับ จึงไม่ทำให้ Fingerprint เปลี่ยน
+    ไม่เก็บ DataFrame ดิบไว้ (ทุกคอลัมน์เป็น Object ใช้หน่วยความจำมาก) ถ้าต้องการค่าดิบให้อ่านจาก Records ตาม Index แถว
+    """
+    # dtype=object: ไม่ให้ pandas แปลงเป็น str dtype (ช้ากว่ามากเมื่อไม่มี pyarrow)
+    raw = pd.DataFrame(records, columns=header, dtype=object) if records else pd.DataFrame(columns=ANALYTICS_TEXT_COLS, dtype=object)
+    for col in ANALYTICS_TEXT_COLS + list(STEP_TIME_FIELDS.values()):
+        if col not in raw: raw[col] = ''
+    to_date = lambda u: pd.to_datetime(u, format='%Y-%m-%d', errors='coerce')
+
+    po_date, load_date, round_ = text_column(raw['PO_Date']), text_column(raw['Load_Date']), text_column(raw['Round'])
+    status = text_column(raw['Status'], strip=False)
+    frame = pd.DataFrame({
+        'po_date': po_date, 'load_date': load_date, 'round': round_,
+        'car_no': text_column(raw['Car_No']),
+        'car_raw': text_column(raw['Car_No'], strip=False),
+        'driver': text_column(raw['Driver'], strip=False),
+        'branch': text_column(raw['Branch_Name']),
+        'status': text_column(raw['Status']),
+        'po_dt': by_category(po_date, to_date),
+        'load_dt': by_category(load_date, to_date),
+        'round_min': by_category(round_, hhmm_minutes),
+        # Done / Cancel เทียบกับค่าดิบ (ไม่ strip) ให้ตรงกับเงื่อนไขเดิมในหน้าผู้จัดการ / Export
+        'done': by_category(status, lambda u: u.eq('Done')),
+        'cancel': by_category(status, lambda u: u.str.lower().eq('cancel')),
+    })
+    # get_shift_info: ชั่วโมงก่อน 06:00 หรือตั้งแต่ 19:00 = กลางคืน (อ่านชั่วโมงไม่ได้ = กลางวัน)
+    night = by_category(round_, lambda u: pd.to_numeric(u.str.split(':').str[0], errors='coerce').pipe(lambda h: (h < 6) | (h >= 19)))
+    frame['shift'] = pd.Categorical.from_codes(night.astype(np.int8), ['day', 'night'])
+    for step, field in STEP_TIME_FIELDS.items():
+        value = text_column(raw[field])
+        frame[f't{step}'] = by_category(value, hhmm_minutes)
+        frame[f't{step}_set'] = by_category(value, lambda u: u.ne(''))
+
+    # เที่ยว = (PO_Date, Car_No, Round) เหมือน jobs_by_trip_key ในหน้าผู้จัดการ
+    frame['trip'] = frame.groupby(['po_date', 'car_no', 'round'], observed=True, sort=False).ngroup()
+    # เริ่มโหลดช้ากว่ารอบ (นาที) ตามกติกาหน้าผู้จัดการ: รอบ >= 18:00 แต่เริ่มหลังเที่ยงคืน = วันถัดไป และกลับกัน
+    plan, act = frame['round_min'], frame['t2']
+    delay = act - plan
+    delay = delay.where(~((plan >= 18 * 60) & (act < 6 * 60)), delay + 1440)
+    delay = delay.where(~((plan < 6 * 60) & (act >= 18 * 60)), delay - 1440)
+    frame['start_delay'] = delay
+    frame['row_hash'] = pd.util.hash_pandas_object(raw, index=False).to_numpy()
+    frame.attrs['header'] = [str(col) for col in raw.columns]
+    return frame
+
+def get_jobs_frame(sheet):
+    """Frame ของ Jobs ตาม Version ล่าสุด (Index แถว = ลำดับใน Records ของ get_cached_records)"""
+    records = get_cached_records(sheet, 'Jobs')
+    version = get_data_version('Jobs')
+    if jobs_frame_state['version'] != version or jobs_frame_state['frame'] is None:
+        header = get_jobs_column_map(sheet).names
+        jobs_frame_state.update(version=version, frame=build_jobs_frame(records, header), records=records, derived={})
+    return jobs_frame_state['frame']
+
+def jobs_frame_derived(sheet, name, build):
+    """ผลสรุปที่คำนวณจาก Frame (Cache ไว้จนกว่า Version จะเปลี่ยน) build(frame, records)"""
+    frame = get_jobs_frame(sheet)
+    derived = jobs_frame_state['derived']
+    if name not in derived: derived[name] = build(frame, jobs_frame_state['records'])
+    return derived[name]
+
+def analytics_po_dates(sheet):
+    """PO_Date ทั้งหมด (ใหม่สุดก่อน) สำหรับตัวเลือกวันที่ในหน้าผู้จัดการ"""
+    return jobs_frame_derived(sheet, 'po_dates', lambda frame, records: sorted(
+        set(frame['po_date'].cat.categories) | set(read_archive_manifest()), reverse=True))
+
+DAY_TOTAL_FIELDS = ['branches', 'done_branches', 'trips', 'completed_trips', 'day_trips', 'night_trips', 'late_start_trips']
+
+def date_fingerprints(frame):
+    """PO_Date -> Fingerprint: Hash ต่อแถวของทุกคอลัมน์ (เรียงตามลำดับใน Sheet) แล้ว SHA1 รวมต่อวัน"""
+    if frame.empty: return {}
+    header = '|'.join(frame.attrs['header']).encode('utf-8')
+    row_hash = frame['row_hash'].to_numpy()
+    codes = frame['po_date'].cat.codes.to_numpy()
+    order = np.argsort(codes, kind='stable')
+    bounds = np.flatnonzero(np.diff(codes[order])) + 1
+    categories = frame['po_date'].cat.categories
+    return {categories[codes[rows[0]]]: hashlib.sha1(header + row_hash[rows].tobytes()).hexdigest()
+            for rows in np.split(order, bounds)}
+
+def summarize_dates(frame, closed=None, fingerprints=None):
+    """
+    สรุปรายวัน (Index = PO_Date): branches, done_branches, trips, completed_trips, day_trips, night_trips,
+    late_start_trips, all_done (งานที่ไม่ Cancel เสร็จครบ) และ fingerprint ของข้อมูลดิบวันนั้น
+    closed = {PO_Date: สรุปที่ปิดแล้ว} ใช้ค่าจากสรุปแทนการนับจากแถว
+    """
+    closed = closed or {}
+    if fingerprints is None: fingerprints = date_fingerprints(frame)
+    rows = frame[~frame['po_date'].isin(list(closed))] if closed else frame
+    summary = pd.DataFrame(columns=DAY_TOTAL_FIELDS + ['all_done'])
+    if not rows.empty:
+        by_date = rows.groupby('po_date', observed=True, sort=False)
+        trips = rows.assign(late=rows['start_delay'] > 0, is_day=rows['shift'] == 'day').groupby('trip', sort=False).agg(
+            po_date=('po_date', 'first'), is_day=('is_day', 'first'), done=('done', 'all'), late=('late', 'first'))
+        by_trip_date = trips.groupby('po_date', observed=True, sort=False)
+        active = rows[~rows['cancel']]
+        summary = pd.DataFrame({
+            'branches': by_date.size(),
+            'done_branches': by_date['done'].sum(),
+            'trips': by_trip_date.size(),
+            'completed_trips': by_trip_date['done'].sum(),
+            'day_trips': by_trip_date['is_day'].sum(),
+            'late_start_trips': by_trip_date['late'].sum(),
+        })
+        summary.index = summary.index.astype(str)
+        summary['night_trips'] = summary['trips'] - summary['day_trips']
+        active_done = active.groupby('po_date', observed=True)['done'].agg(['all', 'size'])
+        active_done.index = active_done.index.astype(str)
+        summary['all_done'] = (active_done['all'] & (active_done['size'] > 0)).reindex(summary.index, fill_value=False).astype(bool)
+    if closed:
+        totals = pd.DataFrame.from_dict({d: c['totals'] for d, c in closed.items()}, orient='index')
+        summary = pd.concat([summary, totals.assign(all_done=True)])
+    summary['fingerprint'] = pd.Series({**{d: c['fingerprint'] for d, c in closed.items()}, **fingerprints}, dtype=object)
+    return summary
+
+def analytics_date_fingerprints(sheet):
+    return jobs_frame_derived(sheet, 'fingerprints', lambda frame, records: date_fingerprints(frame))
+
+def analytics_date_summary(sheet):
+    return jobs_frame_derived(sheet, 'date_summary', lambda frame, records: summarize_dates(
+        frame, closed_day_summaries(sheet), analytics_date_fingerprints(sheet)))
+
+def calendar_slot_counts(frame, records, closed=None):
+    """Counter ของช่องปฏิทิน (year, month, day, shift, driver, trip_id) แบบเดียวกับ calendar_slot ทีละแถว"""
+    closed = closed or {}
+    counts = Counter()
+    for summary in closed.values():
+        for year, month, day, shift, driver, trip_id, n in summary['calendar']:
+            counts[(year, month, day, shift, driver, trip_id)] += n
+    rows = frame[~frame['cancel'] & ~frame['po_date'].isin(list(closed))]
+    if rows.empty: return counts
+    load_dt = rows['load_dt'].where(rows['load_date'] != '', rows['po_dt'])
+    time_str = rows['round'].astype(object).where(rows['round'] != '', '12:00')
+    # รูปแบบ HH:MM ตรงตัว -> คำนวณแบบ Vector, นอกนั้นใช้ calendar_slot ตัวเดิม ผลจึงตรงกันทุกกรณี
+    minutes = rows['round_min'].where(rows['round'] != '', 12 * 60)
+    strict = by_category(rows['round'].cat, lambda u: u.str.fullmatch(r'\d{2}:\d{2}') | u.eq(''))
+    parsed = strict.astype(bool) & (load_dt.notna() & minutes.notna()).to_numpy()
+    hour = minutes // 60
+    job_day = load_dt - pd.to_timedelta((hour < 6).astype(int), unit='D')
+    slots = pd.DataFrame({
+        'year': job_day.dt.year, 'month': job_day.dt.month, 'day': job_day.dt.day,
+        'shift': np.where((hour < 6) | (hour >= 19), 'night', 'day'),
+        'driver': rows['driver'].astype(object),
+        'trip_id': time_str + '_' + rows['car_raw'].astype(object),
+    })[parsed]
+    grouped = slots.groupby(['year', 'month', 'day', 'shift', 'driver', 'trip_id'], sort=False).size()
+    for (year, month, day, shift, driver, trip_id), n in grouped.items():
+        counts[(int(year), int(month), int(day), shift, driver, trip_id)] += int(n)
+    for idx in rows.index[~parsed]:
+        slot = calendar_slot(records[idx])
+        if slot is not None: counts[slot] += 1
+    return counts
+
+def analytics_calendar_slots(sheet):
+    return jobs_frame_derived(sheet, 'calendar_slots', lambda frame, records: calendar_slot_counts(
+        frame, records, closed_day_summaries(sheet)))
 
-        formatted_date = job['PO_Date']
-        try:
-            date_obj = datetime.strptime(str(job['PO_Date']).strip(), "%Y-%m-%d")
-            formatted_date = date_obj.strftime("%d/%m/%Y")
-        except: pass
-            
-        row = {
-            'ลำดับรถ': "" if is_same else job['Car_No'],
-            'PO Date': "" if is_same else formatted_date,
-            'เวลาโหลด': "" if is_same else job['Round'], 
-            'คนขับ': "" if is_same else job['Driver'],
-            'ปลายทาง (สาขา)': job['Branch_Name'],
-            'น้ำหนัก': "" if is_same else comma_format(job.get('Weight', '')),
-            'ทะเบียนรถ': "" if is_same else job['Plate'],
-            'เข้าโรงงาน': "" if is_same else job['T1_Enter'],
-            'เริ่มโหลด': "" if is_same else t2_display, 
-            'โหลดเสร็จ': "" if is_same else job['T3_EndLoad'],
-            'ยื่นเอกสาร': "" if is_same else job['T4_SubmitDoc'],
-            'รับเอกสาร': "" if is_same else job['T5_RecvDoc'],
-            'ออกโรงงาน': "" if is_same else job['T6_Exit'],
-            'ถึงสาขา': job['T7_ArriveBranch'],
-            'จบงาน': job['T8_EndJob']
-        }
-        export_data.append(row)
-        prev_trip_key = current_trip_key
+# ==========================================
+# [KPI] ระยะเวลาแต่ละช่วงงาน / อัตราเริ่มโหลดตรงเวลา ย้อนหลัง (อ่านจาก Rollup รายวัน)
+# ==========================================
+# ช่วงเวลา (นาที) = Step ปลาย - Step ต้น (ข้ามเที่ยงคืน +1440) ไม่นับถ้า Step ใดยังว่าง
+# Step 1-6 เป็นของทั้งเที่ยว (ใช้แถวแรกของเที่ยว), Step 7-8 เป็นของแต่ละสาขา
+KPI_STAGES = {
+    'enter_to_load': ('1', '2'),  # เข้าโรงงาน -> เริ่มโหลด
+    'loading': ('2', '3'),        # เริ่มโหลด -> โหลดเสร็จ
+    'documents': ('4', '5'),      # ยื่นเอกสาร -> รับเอกสาร
+    'transit': ('6', '7'),        # ออกจากโรงงาน -> ถึงสาขา
+    'unloading': ('7', '8'),      # ถึงสาขา -> จบงาน
+}
+KPI_TRIP_STAGES = ('enter_to_load', 'loading', 'documents')
+KPI_GROUPS = ('date', 'month', 'shift', 'driver', 'branch')
+KPI_METRICS = ['trips', 'late_trips', 'delay_min', 'drops'] + [f'{s}_{part}' for s in KPI_STAGES for part in ('sum', 'n')]
 
-    if current_group: grouped_jobs_for_summary.append(current_group)
+KPI_ROLLUP_KEYS = {'drivers': ('shift', 'driver'), 'branches': ('shift', 'branch')}
 
-    df = pd.DataFrame(export_data)
-    
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Report')
-    
-    output.seek(0)
-    wb = load_workbook(output)
-    ws = wb.active
-    
-    font_header = Font(name='Cordia New', size=14, bold=True, color='FFFFFF') 
-    font_body = Font(name='Cordia New', size=14)
-    font_summary_head = Font(name='Cordia New', size=14, bold=True)
-    font_summary_body = Font(name='Cordia New', size=14)
-    
-    side_thin = Side(border_style="thin", color="000000")
-    side_none = Side(border_style=None) 
-    border_all = Border(top=side_thin, bottom=side_thin, left=side_thin, right=side_thin)
-    border_header = Border(top=side_thin, bottom=side_thin, left=side_thin, right=side_thin)
-    
-    align_center = Alignment(horizontal='center', vertical='center', wrap_text=True)
-    align_left = Alignment(horizontal='left', vertical='center', wrap_text=True)
-    
-    fill_header = PatternFill(start_color='2E4053', end_color='2E4053', fill_type='solid')
-    fill_white = PatternFill(start_color='FFFFFF', end_color='FFFFFF', fill_type='solid')
-    fill_blue_light = PatternFill(start_color='EBF5FB', end_color='EBF5FB', fill_type='solid')
-    fill_green_branch = PatternFill(start_color='D5F5E3', end_color='D5F5E3', fill_type='solid')
-    fill_red_end = PatternFill(start_color='FADBD8', end_color='FADBD8', fill_type='solid')
-    fill_sum_head = PatternFill(start_color='D6EAF8', end_color='D6EAF8', fill_type='solid') 
-    fill_sum_total = PatternFill(start_color='FFFF00', end_color='FFFF00', fill_type='solid') 
+def build_kpi_rollups(frame, closed=None):
+    """
+    Rollup จาก Frame ของ Jobs (ไม่นับงาน Cancel / PO_Date ผิดรูปแบบ) {'drivers' | 'branches': {'daily', 'monthly'}}
+    วันที่ปิดแล้ว (closed = {PO_Date: สรุป}) ใช้แถว Rollup ที่เก็บไว้ในสรุปแทนการคำนวณจากแถวดิบ
+    - drivers: ต่อ (date, shift, driver) ตัวชี้วัดระดับเที่ยวนับเที่ยวละ 1 ครั้ง
+    - branches: ต่อ (date, shift, branch) นับทุกเที่ยวที่ไปสาขานั้น
+    daily เรียงตาม date / monthly (รวมรายเดือน) เรียงตาม month
+    คอลัมน์ตัวเลขเป็นผลรวม (trips, late_trips, delay_min, drops, <stage>_sum, <stage>_n) จึงรวมข้ามวันได้ตรง ๆ
+    """
+    closed = closed or {}
+    rows = frame[~frame['cancel'] & frame['po_dt'].notna() & ~frame['po_date'].isin(list(closed))]
+    trip = rows['trip'].to_numpy()
+    lead = ~rows['trip'].duplicated().to_numpy()
+    first_pos = np.zeros(trip.max() + 1 if len(trip) else 0, dtype=np.int64)
+    first_pos[trip[lead]] = np.flatnonzero(lead)
+    first = first_pos[trip]  # ตำแหน่งแถวแรกของเที่ยว สำหรับทุกแถว
+
+    def minutes(col, trip_level):
+        values = rows[col].to_numpy()
+        return values[first] if trip_level else values
+
+    delay = minutes('start_delay', True)
+    metrics = {'trips': np.ones(len(rows)), 'late_trips': (delay > 0).astype(float),
+               'delay_min': np.where(delay > 0, delay, 0.0), 'drops': np.ones(len(rows))}
+    for stage, (begin, end) in KPI_STAGES.items():
+        trip_level = stage in KPI_TRIP_STAGES
+        span = minutes(f't{end}', trip_level) - minutes(f't{begin}', trip_level)
+        span = np.where(span < 0, span + 1440, span)
+        metrics[f'{stage}_sum'] = np.nan_to_num(span)
+        metrics[f'{stage}_n'] = (~np.isnan(span)).astype(float)
+    per_row = pd.DataFrame(metrics, index=rows.index)
+    keys = {'date': rows['po_date'], 'shift': rows['shift'], 'driver': rows['driver'], 'branch': rows['branch']}
+
+    # ราย driver: ตัวชี้วัดระดับเที่ยวนับเฉพาะแถวแรก (สาขาอื่นในเที่ยวเดียวกันไม่นับซ้ำ)
+    trip_cols = ['trips', 'late_trips', 'delay_min'] + [f'{s}_{part}' for s in KPI_TRIP_STAGES for part in ('sum', 'n')]
+    per_trip = per_row.copy()
+    per_trip[trip_cols] = per_trip[trip_cols].mul(lead, axis=0)
+
+    rollups = {}
+    for name, values in (('drivers', per_trip), ('branches', per_row)):
+        by = ['date', *KPI_ROLLUP_KEYS[name]]
+        daily = values.groupby([keys[k].rename(k) for k in by], observed=True).sum().reset_index()
+        for k in by: daily[k] = np.asarray(daily[k].astype(str), dtype=object)
+        stored = [[date, *row] for date, summary in closed.items() for row in summary[name]]
+        if stored: daily = pd.concat([daily, pd.DataFrame(stored, columns=by + KPI_METRICS)], ignore_index=True)
+        daily['month'] = by_category(pd.Categorical(daily['date']), lambda u: u.str[:7])
+        daily = daily.sort_values('date', kind='stable').reset_index(drop=True)
+        monthly = daily.groupby(['month', *KPI_ROLLUP_KEYS[name]], sort=True)[KPI_METRICS].sum().reset_index()
+        rollups[name] = {'daily': daily, 'monthly': monthly}
+    return rollups
+
+def get_kpi_rollups(sheet):
+    return jobs_frame_derived(sheet, 'kpi_rollups', lambda frame, records: build_kpi_rollups(frame, closed_day_summaries(sheet)))
+
+def kpi_result(sums):
+    """ผลรวมของกลุ่ม {metric: ค่า} -> ตัวชี้วัด (อัตราตรงเวลา, ค่าเฉลี่ยนาทีของแต่ละช่วง)"""
+    trips, late = int(sums['trips']), int(sums['late_trips'])
+    return {
+        'trips': trips, 'drops': int(sums['drops']), 'late_trips': late,
+        'on_time_rate': round(1 - late / trips, 4) if trips else None,
+        'avg_start_delay_min': round(sums['delay_min'] / late, 1) if late else None,
+        'stages': {stage: {'avg_min': round(sums[f'{stage}_sum'] / sums[f'{stage}_n'], 1) if sums[f'{stage}_n'] else None,
+                           'count': int(sums[f'{stage}_n'])} for stage in KPI_STAGES},
+    }
+
+def kpi_range_rows(rollup, start, end, by_date):
+    """
+    แถว Rollup ของช่วง start..end: เดือนที่อยู่ในช่วงครบทั้งเดือนอ่านจาก monthly, หัว/ท้ายช่วงอ่านจาก daily
+    (จัดกลุ่มตาม date ต้องใช้ daily ทั้งหมด)
+    """
+    daily, monthly = rollup['daily'], rollup['monthly']
+    dates = daily['date'].to_numpy()
+    day_slice = lambda lo, hi: daily.iloc[np.searchsorted(dates, lo, 'left'):np.searchsorted(dates, hi, 'left')]
+
+    d_start = datetime.strptime(start, "%Y-%m-%d")
+    after_end = datetime.strptime(end, "%Y-%m-%d") + timedelta(days=1)
+    full_from = d_start if d_start.day == 1 else (d_start.replace(day=1) + timedelta(days=32)).replace(day=1)
+    full_to = after_end.replace(day=1)  # ไม่รวม
+    if by_date or full_from >= full_to:
+        return day_slice(start, after_end.strftime("%Y-%m-%d"))
+
+    months = monthly['month'].to_numpy()
+    first_month, last_month = full_from.strftime("%Y-%m"), (full_to - timedelta(days=1)).strftime("%Y-%m")
+    return pd.concat([
+        day_slice(start, full_from.strftime("%Y-%m-%d")),
+        monthly.iloc[np.searchsorted(months, first_month, 'left'):np.searchsorted(months, last_month, 'right')],
+        day_slice(full_to.strftime("%Y-%m-%d"), after_end.strftime("%Y-%m-%d")),
+    ], ignore_index=True)
+
+def query_kpi(rollups, start, end, by=(), filters=None):
+    """
+    KPI ของช่วง start..end (PO_Date) จัดกลุ่มตาม by (ส่วนหนึ่งของ KPI_GROUPS) กรองด้วย filters {shift/driver/branch: ค่า}
+    คืนค่า (rows, total) / ValueError ถ้าขอ driver กับ branch พร้อมกัน (Rollup แยกตารางกัน)
+    """
+    filters = filters or {}
+    fields = set(by) | set(filters)
+    if {'driver', 'branch'} <= fields:
+        raise ValueError('จัดกลุ่ม/กรองตาม driver และ branch พร้อมกันไม่ได้')
+    selected = kpi_range_rows(rollups['branches' if 'branch' in fields else 'drivers'], start, end, 'date' in by)
+    for field, value in filters.items():
+        selected = selected[selected[field] == value]
+
+    total = kpi_result(dict(zip(KPI_METRICS, selected[KPI_METRICS].sum().tolist())))
+    rows = []
+    if by:
+        grouped = selected.groupby(list(by), sort=True)[KPI_METRICS].sum()
+        for key, sums in zip(grouped.index, grouped.to_numpy().tolist()):
+            key = key if isinstance(key, tuple) else (key,)
+            rows.append({**dict(zip(by, key)), **kpi_result(dict(zip(KPI_METRICS, sums)))})
+    return rows, total
+
+@app.route('/kpi')
+def kpi():
+    """
+    KPI ย้อนหลัง (JSON) เช่น /kpi?start=2025-01-01&end=2025-12-31&by=driver,month&shift=night
+    ไม่ระบุช่วงวันที่ = ตั้งแต่ต้นเดือนนี้ถึงวันนี้
+    """
+    if 'user' not in session: return json.dumps({'status': 'error', 'message': 'Unauthorized'}), 401
+    try:
+        date_range = parse_export_range(request.args)
+    except ValueError as e:
+        return json.dumps({'status': 'error', 'message': f'ช่วงวันที่ไม่ถูกต้อง: {e}'}), 400
+    if date_range is None:
+        today = (datetime.now() + timedelta(hours=7)).date()
+        date_range = (today.replace(day=1).strftime("%Y-%m-%d"), today.strftime("%Y-%m-%d"))
+
+    by = [k.strip() for k in request.args.get('by', '').split(',') if k.strip()]
+    unknown = [k for k in by if k not in KPI_GROUPS]
+    if unknown:
+        return json.dumps({'status': 'error', 'message': f"ไม่รู้จักการจัดกลุ่ม: {', '.join(unknown)} (ใช้ได้: {', '.join(KPI_GROUPS)})"}), 400
+    filters = {k: request.args[k].strip() for k in ('shift', 'driver', 'branch') if request.args.get(k, '').strip()}
+    if filters.get('shift') not in (None, 'day', 'night'):
+        return json.dumps({'status': 'error', 'message': "shift ต้องเป็น day หรือ night"}), 400
+
+    start, end = date_range
+    try:
+        rows, total = query_kpi(get_kpi_rollups(get_db()), start, end, by, filters)
+    except ValueError as e:
+        return json.dumps({'status': 'error', 'message': str(e)}), 400
+    payload = {'status': 'success', 'start': start, 'end': end, 'by': by, 'filters': filters, 'rows': rows, 'total': total}
+    return json.dumps(payload, ensure_ascii=False), 200, {'Content-Type': 'application/json'}
 
-    ws.freeze_panes = 'A2'
+# ==========================================
+# [Day Close] ปิดยอดรายวัน: เก็บสรุปของวันที่จบงานครบแล้วลง Worksheet DailyRollups
+# ==========================================
+# วันที่ปิดแล้ว Analytics / KPI / ปฏิทิน อ่านจากสรุปนี้แทนการคำนวณจากแถวดิบ
+# ปิดยอดผ่าน /close_days เท่านั้น (Cron ทุกคืน / ผู้จัดการ) ไม่ทำใน Request ของคนขับ (สร้าง Frame ทั้งตาราง + เขียน Sheet)
+# สรุปใช้ได้เฉพาะเมื่อ Fingerprint ตรงกับข้อมูลดิบปัจจุบัน (มีคนแก้แถวของวันนั้นภายหลัง = กลับไปคำนวณจากแถวดิบ แล้วปิดใหม่ได้)
+# Summary (JSON) = {'totals': {DAY_TOTAL_FIELDS}, 'drivers' / 'branches': [[shift, key, *KPI_METRICS]],
+#                   'calendar': [[year, month, day, shift, driver, trip_id, n]]}
+# JSON ยาวเกิน 1 ช่อง (Sheets รับได้ไม่เกิน 50,000 ตัวอักษร) -> แบ่งเป็นหลายแถว (Part / Parts)
+DAILY_ROLLUP_HEADER = ['PO_Date', 'Fingerprint', 'Closed_At', 'Part', 'Parts', 'Summary']
+DAILY_ROLLUP_CELL_CHARS = 45000
+DAILY_ROLLUP_TTL = int(os.environ.get('DAILY_ROLLUP_TTL', '3600'))
+DAY_CLOSE_TOKEN = os.environ.get('CRON_SECRET', '')  # Vercel Cron ส่งมาเป็น Bearer Token
+
+daily_rollups = {'days': None, 'loaded_at': 0, 'store_version': None, 'versioned': False}
+daily_rollups_lock = threading.Lock()
+
+def parse_daily_rollups(values):
+    """แถวของ DailyRollups -> {PO_Date: {'fingerprint', 'closed_at', 'summary'}} (ปิดซ้ำ = แถวหลังสุดชนะ)"""
+    parts = {}
+    for row in values[1:]:
+        row = list(row) + [''] * (len(DAILY_ROLLUP_HEADER) - len(row))
+        date, fingerprint, closed_at, part, n_parts, chunk = (str(v) for v in row[:len(DAILY_ROLLUP_HEADER)])
+        if not part.isdigit() or not n_parts.isdigit(): continue
+        entry = parts.get(date)
+        if entry is None or entry['closed_at'] != closed_at or entry['fingerprint'] != fingerprint:
+            entry = parts[date] = {'fingerprint': fingerprint, 'closed_at': closed_at, 'parts': int(n_parts), 'chunks': {}}
+        entry['chunks'][int(part)] = chunk
+    days = {}
+    for date, entry in parts.items():
+        if len(entry['chunks']) != entry['parts']: continue  # เขียนไม่ครบ (เช่น Timeout กลางคัน)
+        try:
+            summary = json.loads(''.join(entry['chunks'][i] for i in sorted(entry['chunks'])))
+        except ValueError:
+            continue
+        days[date] = {'fingerprint': entry['fingerprint'], 'closed_at': entry['closed_at'], 'summary': summary}
+    return days
+
+def get_daily_rollups(sheet, refresh=False):
+    index = daily_rollups
+    with daily_rollups_lock:
+        if not refresh and index['days'] is not None and time.time() - index['loaded_at'] < DAILY_ROLLUP_TTL:
+            if not index['versioned']: return index['days']
+            if sheet.data_version('DailyRollups') == index['store_version']: return index['days']
+        values = LogRepository(sheet, 'DailyRollups', DAILY_ROLLUP_HEADER).values()
+        versioned = hasattr(sheet, 'data_version')
+        index.update(days=parse_daily_rollups(values), loaded_at=time.time(), versioned=versioned,
+                     store_version=sheet.data_version('DailyRollups') if versioned else None)
+        return index['days']
+
+def closed_day_summaries(sheet):
+    """
+    {PO_Date: Summary} ของวันที่ปิดแล้วและข้อมูลดิบยังตรงกับตอนปิด (Cache ตาม Version ของ Jobs)
+    รวมวันที่ย้ายไปเก็บในไฟล์แล้ว (ดู [Archive]) ถ้าไม่มีสรุปที่ตรงกันจะคำนวณจากไฟล์
+    """
+    def build(frame, records):
+        fingerprints = analytics_date_fingerprints(sheet)
+        persisted = get_daily_rollups(sheet)
+        days = {date: {**day['summary'], 'fingerprint': day['fingerprint']}
+                for date, day in persisted.items() if fingerprints.get(date) == day['fingerprint']}
+        missing = []
+        for date, entry in read_archive_manifest().items():
+            if date in fingerprints: continue  # มีแถวของวันนี้ใน Sheet อีก -> ใช้ข้อมูลใน Sheet
+            day = persisted.get(date)
+            if day and day['fingerprint'] == entry['fingerprint']:
+                days[date] = {**day['summary'], 'fingerprint': day['fingerprint']}
+            else:
+                missing.append(date)
+        for date, (fingerprint, summary) in archived_day_summaries(missing).items():
+            days[date] = {**summary, 'fingerprint': fingerprint}
+        return days
+    return jobs_frame_derived(sheet, 'closed_days', build)
+
+def integral(value):
+    return int(value) if float(value).is_integer() else float(value)
+
+def build_day_summaries(frame, records, dates):
+    """คำนวณสรุปของแต่ละวันจากแถวดิบ (Frame ของ Jobs หรือของไฟล์ที่ย้ายไปเก็บ) -> {PO_Date: (fingerprint, summary)}"""
+    positions = frame.groupby('po_date', observed=True, sort=False).indices
+    result = {}
+    for date in dates:
+        day = frame.iloc[positions[date]]
+        fingerprints = date_fingerprints(day)
+        totals = summarize_dates(day, fingerprints=fingerprints).loc[date]
+        rollups = build_kpi_rollups(day)
+        summary = {'totals': {f: int(totals[f]) for f in DAY_TOTAL_FIELDS}}
+        for name, keys in KPI_ROLLUP_KEYS.items():
+            daily = rollups[name]['daily']
+            summary[name] = [[*key, *map(integral, values)] for key, values in
+                             zip(daily[list(keys)].to_numpy().tolist(), daily[KPI_METRICS].to_numpy().tolist())]
+        summary['calendar'] = [[*slot, n] for slot, n in calendar_slot_counts(day, records).items()]
+        result[date] = (fingerprints[date], summary)
+    return result
 
-    current_trip_id = None
-    is_zebra_active = False
+def close_po_dates(sheet, dates=None, before=None):
+    """
+    ปิดยอดวันที่ที่จบงานครบแล้ว (ไม่นับงาน Cancel) dates = ระบุวัน / before = ทุกวันก่อนวันที่นี้
+    ข้ามวันที่ปิดไว้แล้วด้วยข้อมูลชุดเดียวกัน -> คืนค่ารายการวันที่ที่เพิ่งปิด
+    """
+    summary = analytics_date_summary(sheet)
+    closed = get_daily_rollups(sheet)
+    candidates = summary.index if dates is None else [d for d in dates if d in summary.index]
+    targets = []
+    for date in candidates:
+        if not re.fullmatch(r'\d{4}-\d{2}-\d{2}', date) or (before and date >= before): continue
+        if not summary.at[date, 'all_done']: continue
+        if closed.get(date, {}).get('fingerprint') == summary.at[date, 'fingerprint']: continue
+        targets.append(date)
+    if not targets: return []
+    return save_day_summaries(sheet, build_day_summaries(get_jobs_frame(sheet), jobs_frame_state['records'], targets))
+
+def save_day_summaries(sheet, day_summaries):
+    """เขียนสรุป {PO_Date: (fingerprint, summary)} ต่อท้าย DailyRollups -> รายการวันที่"""
+    if not day_summaries: return []
+    closed_at = (datetime.now() + timedelta(hours=7)).strftime('%Y-%m-%d %H:%M:%S')
+    rows, days = [], {}
+    for date, (fingerprint, day) in sorted(day_summaries.items()):
+        text = json.dumps(day, ensure_ascii=False, separators=(',', ':'))
+        chunks = [text[i:i + DAILY_ROLLUP_CELL_CHARS] for i in range(0, len(text), DAILY_ROLLUP_CELL_CHARS)]
+        rows += [[date, fingerprint, closed_at, str(i), str(len(chunks)), chunk] for i, chunk in enumerate(chunks)]
+        days[date] = {'fingerprint': fingerprint, 'closed_at': closed_at, 'summary': day}
+    LogRepository(sheet, 'DailyRollups', DAILY_ROLLUP_HEADER).append(rows)
+    with daily_rollups_lock:
+        if daily_rollups['days'] is not None:
+            daily_rollups['days'] = {**daily_rollups['days'], **days}
+    return sorted(days)
+
+@app.route('/close_days', methods=['GET', 'POST'])
+def close_days():
+    """
+    ปิดยอดทุกวันก่อนวันนี้ที่จบงานครบแล้ว แล้วย้ายวันที่เก่าไปเก็บในไฟล์ (ถ้าตั้ง ARCHIVE_DIR) และตัด StepEvents / PODetails ที่เก่ากว่าช่วงที่เก็บไว้
+    เรียกจาก Cron ทุกคืน (GET + Bearer Token) / ผู้จัดการกดเอง (POST เท่านั้น) date=YYYY-MM-DD = ปิดยอดเฉพาะวันนั้น
+    GET จาก Session ไม่รับ: ลิงก์/รูปในหน้าอื่นจะสั่งเขียน DailyRollups หรือลบแถว Jobs แทนผู้จัดการได้
+    """
+    token = request.headers.get('Authorization', '').replace('Bearer ', '', 1)
+    if not (DAY_CLOSE_TOKEN and token and hmac.compare_digest(token, DAY_CLOSE_TOKEN)):
+        if 'user' not in session: return json.dumps({'status': 'error', 'message': 'Unauthorized'}), 401
+        if request.method != 'POST': return json.dumps({'status': 'error', 'message': 'ต้องเรียกด้วย POST'}), 405
+    today = (datetime.now() + timedelta(hours=7)).strftime('%Y-%m-%d')
+    date = request.values.get('date', '').strip()
+    try:
+        sheet = get_db()
+        closed = close_po_dates(sheet, [date]) if date else close_po_dates(sheet, before=today)
+        # ตั้ง ARCHIVE_DIR ไว้ -> ย้ายวันที่เก่ากว่า ARCHIVE_HORIZON_DAYS ออกจาก Sheet ในรอบเดียวกัน
+        archived = archive_jobs(sheet) if ARCHIVE_DIR and not date else []
+        keep_from = (datetime.now() + timedelta(hours=7) - timedelta(days=STEP_EVENT_RETENTION_DAYS)).strftime('%Y-%m-%d')
+        trimmed_events = trim_step_event_log(sheet, keep_from) if not date else 0
+        po_keep_from = (datetime.now() + timedelta(hours=7) - timedelta(days=PO_DETAIL_RETENTION_DAYS)).strftime('%Y-%m-%d')
+        trimmed_po_details = trim_po_detail_log(sheet, po_keep_from) if not date else 0
+    except Exception as e:
+        return json.dumps({'status': 'error', 'message': str(e)}), 500
+    payload = {'status': 'success', 'closed': closed, 'archived': archived,
+               'trimmed_events': trimmed_events, 'trimmed_po_details': trimmed_po_details}
+    return json.dumps(payload, ensure_ascii=False), 200, {'Content-Type': 'application/json'}
+
+# ==========================================
+# [Archive] ย้าย Jobs เก่าออกจาก Sheet ไปเก็บเป็นไฟล์บีบอัดรายเดือน
+# ==========================================
+# PO_Date ที่เก่ากว่า ARCHIVE_HORIZON_DAYS วันและจบงานครบแล้ว (ปิดยอดลง DailyRollups จากแถวที่จะย้ายก่อนเสมอ)
+#   -> ARCHIVE_DIR/jobs-YYYY-MM.parquet (มี pyarrow) หรือ jobs-YYYY-MM.csv.gz แล้วลบแถวออกจาก Jobs ทีละช่วง
+# เก็บค่าดิบแบบ get_all_values แปลงกลับเป็น Records ด้วย grid_to_records จึงได้ข้อมูล / Fingerprint เดิม
+# manifest.json = {PO_Date: {'month', 'file', 'rows', 'fingerprint'}} วันที่ย้ายและลบออกจาก Sheet เรียบร้อยแล้วเท่านั้น
+# pending.json = วันที่เขียนลงไฟล์แล้วแต่ยังลบแถวไม่ครบ (รอบหน้าลบต่อ) / ลบทีละช่วงโดยถือ jobs_write_lock และอ่าน Sheet ใหม่ทุกช่วง
+# อ่านไฟล์เฉพาะเมื่อต้องใช้แถวดิบ (Export / หน้าผู้จัดการของวันนั้น) และ Cache ไว้ ARCHIVE_CACHE_MONTHS เดือน
+# KPI / ปฏิทิน / สรุปรายวัน ใช้สรุปใน DailyRollups ตามเดิม
+# ไม่ตั้ง ARCHIVE_DIR (เช่นบน Vercel ที่ไม่มี Disk ถาวร) = ไม่ย้ายข้อมูล
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', '')
+ARCHIVE_HORIZON_DAYS = int(os.environ.get('ARCHIVE_HORIZON_DAYS', '180'))
+ARCHIVE_DELETE_BATCH = int(os.environ.get('ARCHIVE_DELETE_BATCH', '2000'))  # แถวสูงสุดต่อการลบ 1 ครั้ง
+ARCHIVE_CACHE_MONTHS = 3
+ARCHIVE_FORMAT = 'parquet' if importlib.util.find_spec('pyarrow') else 'csv.gz'
+
+archive_state = {'manifest': {}, 'manifest_mtime': None, 'months': OrderedDict()}
+archive_lock = threading.Lock()
+
+def archive_path(name):
+    return os.path.join(ARCHIVE_DIR, name)
+
+def write_file_atomic(path, write):
+    """เขียนไฟล์ชั่วคราวแล้วค่อยแทนที่ (ผู้อ่านไม่เห็นไฟล์ที่เขียนไม่ครบ)"""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f: write(f)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp): os.unlink(tmp)
+
+def read_archive_manifest():
+    """{PO_Date: {...}} ของวันที่ย้ายไปเก็บแล้ว (อ่านใหม่เมื่อไฟล์เปลี่ยน)"""
+    if not ARCHIVE_DIR: return {}
+    try:
+        mtime = os.stat(archive_path('manifest.json')).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    with archive_lock:
+        if archive_state['manifest_mtime'] != mtime:
+            with open(archive_path('manifest.json'), encoding='utf-8') as f: archive_state['manifest'] = json.load(f)
+            archive_state['manifest_mtime'] = mtime
+        return archive_state['manifest']
+
+def write_archive_manifest(manifest, name='manifest.json'):
+    text = json.dumps(manifest, ensure_ascii=False, sort_keys=True).encode('utf-8')
+    write_file_atomic(archive_path(name), lambda f: f.write(text))
+
+def read_archive_pending():
+    """{PO_Date: {...}} ที่เขียนลงไฟล์แล้วแต่ยังลบแถวออกจาก Sheet ไม่ครบ (ยังไม่นับว่าย้ายแล้ว)"""
+    try:
+        with open(archive_path('pending.json'), encoding='utf-8') as f: return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def archived_row_matcher(values, date):
+    """match(columns, row) สำหรับ delete_rows_matching: แถวของวันที่ date ที่ค่าทุกช่องตรงกับแถวในไฟล์ (values = read_partition)"""
+    stored = ColumnMap(values[0] if values else [])
+    keys = {tuple(str(stored.value(row, f)) for f in stored.names)
+            for row in values[1:] if str(stored.value(row, 'PO_Date')).strip() == date}
+    def match(columns, row):
+        if any(f not in columns.cols for f in stored.names): return False  # หัวตารางเปลี่ยนจนเทียบไม่ได้ -> ไม่ลบ
+        return str(columns.value(row, 'PO_Date')).strip() == date and tuple(str(columns.value(row, f)) for f in stored.names) in keys
+    return match
+
+def read_partition(name):
+    """ไฟล์ของเดือน -> ค่าดิบ [header, *rows] (Text ทั้งหมด)"""
+    path = archive_path(name)
+    if name.endswith('.parquet'):
+        frame = pd.read_parquet(path)
+        return [list(frame.columns)] + frame.to_numpy().tolist()
+    with gzip.open(path, 'rt', encoding='utf-8', newline='') as f:
+        return list(csv.reader(f))
+
+def write_partition(name, values):
+    if name.endswith('.parquet'):
+        width = len(values[0])
+        frame = pd.DataFrame([r + [''] * (width - len(r)) for r in values[1:]], columns=values[0], dtype=object)
+        write_file_atomic(archive_path(name), lambda f: frame.to_parquet(f, index=False))
+        return
+    def write(f):
+        with gzip.GzipFile(fileobj=f, mode='wb') as gz, io.TextIOWrapper(gz, encoding='utf-8', newline='') as text:
+            csv.writer(text).writerows(values)
+    write_file_atomic(archive_path(name), write)
+
+def load_archive_month(name):
+    """ไฟล์รายเดือน -> (หัวตาราง, {PO_Date: [job]})"""
+    key = (name, os.stat(archive_path(name)).st_mtime_ns)
+    months = archive_state['months']
+    with archive_lock:
+        cached = months.get(name)
+        if cached is not None and cached[0] == key:
+            months.move_to_end(name)
+            return cached[1]
+    values = read_partition(name)
+    by_date = {}
+    for job in grid_to_records(values):
+        by_date.setdefault(str(job['PO_Date']).strip(), []).append(job)
+    month = (ColumnMap(values[0] if values else []).names, by_date)
+    with archive_lock:
+        months[name] = (key, month)
+        while len(months) > ARCHIVE_CACHE_MONTHS: months.popitem(last=False)
+    return month
+
+def archived_jobs(date_key):
+    """งานของ PO_Date ที่ย้ายไปเก็บในไฟล์แล้ว ([] ถ้าไม่ได้ถูกย้าย)"""
+    entry = read_archive_manifest().get(date_key)
+    if not entry: return []
+    return load_archive_month(entry['file'])[1].get(date_key, [])
+
+def archived_day_summaries(dates):
+    """สรุปรายวันคำนวณจากไฟล์ (กรณี DailyRollups ไม่มีสรุปของวันที่ย้ายไปแล้ว) -> {PO_Date: (fingerprint, summary)}"""
+    manifest = read_archive_manifest()
+    by_file = {}
+    for date in dates: by_file.setdefault(manifest[date]['file'], []).append(date)
+    result = {}
+    for name, file_dates in by_file.items():
+        header, by_date = load_archive_month(name)
+        records = [job for date in file_dates for job in by_date.get(date, [])]
+        frame = build_jobs_frame(records, header)
+        present = set(frame['po_date'].cat.categories)
+        result.update(build_day_summaries(frame, records, [d for d in file_dates if d in present]))
+    return result
 
-    for row in ws.iter_rows(min_row=1, max_row=ws.max_row, min_col=1, max_col=ws.max_column):
-        ws.row_dimensions[row[0].row].height = 21
+def row_ranges(row_ids, batch):
+    """เลขแถว -> ช่วงต่อเนื่อง (start, end) ไม่เกิน batch แถว เรียงจากล่างขึ้นบน (ลบแล้วแถวที่เหลือไม่เลื่อน)"""
+    ranges = []
+    for row_id in sorted(row_ids, reverse=True):
+        if ranges and ranges[-1][0] == row_id + 1 and ranges[-1][1] - row_id < batch:
+            ranges[-1] = (row_id, ranges[-1][1])
+        else:
+            ranges.append((row_id, row_id))
+    return ranges
 
-        if row[0].row == 1:
-            for cell in row:
-                cell.font = font_header
-                cell.fill = fill_header
-                cell.alignment = align_center
-                cell.border = border_header
-            continue
+def archive_jobs(sheet, before=None):
+    """
+    ย้ายทุก PO_Date ก่อน before (ค่าเริ่มต้น = วันนี้ - ARCHIVE_HORIZON_DAYS) ที่จบงานครบแล้วไปเก็บในไฟล์รายเดือน
+    แล้วลบแถวออกจาก Jobs ทีละวัน -> รายการวันที่ที่ย้ายเสร็จ (รวมวันที่ค้างจากรอบก่อน)
+    เขียนไฟล์แล้วจด pending.json ก่อน / ลงชื่อใน manifest เมื่อแถวของวันนั้นหายจาก Sheet ครบแล้วเท่านั้น
+    ลบไม่สำเร็จกลางทาง -> รอบหน้าลบต่อจากที่ค้าง (วันที่ใน manifest ที่ยังเหลือแถวก็ลบต่อเช่นกัน)
+    """
+    if not ARCHIVE_DIR: raise RuntimeError('ยังไม่ได้ตั้ง ARCHIVE_DIR')
+    if before is None:
+        before = (datetime.now() + timedelta(hours=7) - timedelta(days=ARCHIVE_HORIZON_DAYS)).strftime('%Y-%m-%d')
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+
+    repo = JobsRepository(sheet)
+    manifest = dict(read_archive_manifest())
+    pending = read_archive_pending()
+
+    def select(grid):
+        """แถวของวันที่ก่อน before {PO_Date: [(row_id, row)]}"""
+        date_col = grid[0].index('PO_Date') if grid else -1
+        rows = {}
+        for row_id, row in enumerate(grid[1:], start=2):
+            date = str(row[date_col]).strip() if 0 <= date_col < len(row) else ''
+            if date < before and re.fullmatch(r'\d{4}-\d{2}-\d{2}', date):
+                rows.setdefault(date, []).append((row_id, row))
+        return rows
+
+    grid = repo.grid()
+    rows = select(grid)
+    new_rows = {d: r for d, r in rows.items() if d not in manifest and d not in pending}
+    if new_rows:
+        # ย้ายเฉพาะวันที่จบงานครบ โดยสรุปใน DailyRollups ต้องตรงกับแถวที่อ่านมาชุดนี้ (แถวที่จะถูกลบ)
+        # ยังไม่มีสรุป / สรุปไม่ตรง (ปิดจากข้อมูลชุดก่อน) -> ปิดยอดใหม่จากแถวชุดนี้ก่อน KPI / ปฏิทินจึงยังครบหลังลบแถว
+        header = grid[0]
+        records = grid_to_records([header] + [row for date in sorted(new_rows) for _, row in new_rows[date]])
+        frame = build_jobs_frame(records, ColumnMap(header).names)
+        summary = summarize_dates(frame)
+        dates = [d for d in sorted(new_rows) if d in summary.index and summary.at[d, 'all_done']]
+        fingerprints = {d: summary.at[d, 'fingerprint'] for d in dates}
+        closed = get_daily_rollups(sheet)
+        save_day_summaries(sheet, build_day_summaries(
+            frame, records, [d for d in dates if closed.get(d, {}).get('fingerprint') != fingerprints[d]]))
+
+        by_month = {}
+        for date in dates: by_month.setdefault(date[:7], []).append(date)
+        replaced = set()
+        for month, month_dates in by_month.items():
+            name = f'jobs-{month}.{ARCHIVE_FORMAT}'
+            old_files = {e['file'] for e in list(manifest.values()) + list(pending.values()) if e['month'] == month}
+            kept = []
+            for old in old_files:
+                old_values = read_partition(old)
+                # หัวตารางเปลี่ยนไปจากตอนย้ายครั้งก่อน -> จัดคอลัมน์ตามชื่อ (คอลัมน์ที่ไม่มี = ว่าง)
+                position = {col: i for i, col in enumerate(old_values[0])}
+                for row in old_values[1:]:
+                    date = str(row[position['PO_Date']]).strip()
+                    if date not in manifest and date not in pending: continue  # เศษจากรอบที่เลิกย้ายไปแล้ว
+                    kept.append(row if old_values[0] == header else
+                                [row[position[c]] if position.get(c, len(row)) < len(row) else '' for c in header])
+            write_partition(name, [header] + kept + [row for date in month_dates for _, row in new_rows[date]])
+            for entries in (manifest, pending):
+                for date, entry in entries.items():
+                    if entry['month'] == month: entries[date] = {**entry, 'file': name}
+            for date in month_dates:
+                pending[date] = {'month': month, 'file': name, 'rows': len(new_rows[date]), 'fingerprint': fingerprints[date]}
+            replaced |= old_files - {name}
+        write_archive_manifest(pending, 'pending.json')
+        write_archive_manifest(manifest)
+        for old in replaced: os.unlink(archive_path(old))
+
+    # ลบแถวทีละวัน แถวที่ลบต้องตรงกับแถวในไฟล์ทุกช่อง (แถวที่ถูกแก้หลังอ่านไปแล้วจะไม่ถูกลบ)
+    partitions = {}
+    def matcher(entry, date):
+        if entry['file'] not in partitions: partitions[entry['file']] = read_partition(entry['file'])
+        return archived_row_matcher(partitions[entry['file']], date)
+
+    archived = []
+    try:
+        for date in sorted(pending):
+            match = matcher(pending[date], date)
+            live = rows.get(date, [])
+            columns = repo.columns(grid)
+            if not pending[date].get('deleting') and any(not match(columns, row) for _, row in live):
+                # แถวถูกแก้ / เพิ่มก่อนเริ่มลบ -> เลิกย้ายวันนี้ รอบหน้าย้ายใหม่จากแถวล่าสุด
+                print(f"Archive Skipped: Jobs changed while archiving {date}")
+                del pending[date]
+                write_archive_manifest(pending, 'pending.json')
+                continue
+            pending[date] = {**pending[date], 'deleting': True}
+            write_archive_manifest(pending, 'pending.json')
+            repo.delete_rows_matching(match, ARCHIVE_DELETE_BATCH)
+            if any(not match(columns, row) for _, row in live):
+                print(f"Archive Incomplete: {date} has rows that are not in the archive file")
+                continue
+            entry = pending.pop(date)
+            manifest[date] = {k: v for k, v in entry.items() if k != 'deleting'}
+            write_archive_manifest(manifest)
+            write_archive_manifest(pending, 'pending.json')
+            archived.append(date)
+        # เศษของวันที่ย้ายไปแล้ว (รอบก่อนลบไม่ครบ)
+        for date in sorted(d for d in rows if d in manifest and d not in archived):
+            repo.delete_rows_matching(matcher(manifest[date], date), ARCHIVE_DELETE_BATCH)
+    finally:
+        invalidate_cache('Jobs')
+    return archived
 
-        job_index = row[0].row - 2
-        is_group_end = False
-        if 0 <= job_index < len(jobs):
-            job_data = jobs[job_index]
-            if job_index == len(jobs) - 1: is_group_end = True
-            else:
-                next_job = jobs[job_index + 1]
-                if (str(job_data['PO_Date']) != str(next_job['PO_Date'])) or (str(job_data['Car_No']) != str(next_job['Car_No'])) or (str(job_data['Round']) != str(next_job['Round'])):
-                    is_group_end = True
+# ==========================================
+# [Report Engine] จัดกลุ่ม Trip และสรุปยอดรายกะ (ใช้ร่วมกันทุก Export)
+# ==========================================
+REPORT_CACHE_SIZE = 16
+report_cache = OrderedDict()  # (date_filter, jobs_version) -> report
+jobs_date_index = {'version': None, 'index': {}}  # PO_Date -> {'jobs', 'fingerprint', 'all_done'}
+EXPORT_RANGE_MAX_DAYS = 366
+
+def create_shift_counter():
+    return {'count': 0, 't1': 0, 't2': 0, 't3': 0, 't4': 0, 't5': 0, 't6': 0, 't7': 0, 't8': 0}
+
+def report_sort_key(job):
+    """เรียงตาม PO Date > ลำดับรถ > รอบโหลด"""
+    car_no_str = str(job['Car_No']).strip()
+    try: car_no_int = int(car_no_str)
+    except ValueError: car_no_int = 99999
+    return (str(job['PO_Date']), car_no_int, str(job['Round']))
+
+def calc_start_delay(round_str, t2_str):
+    """คำนวณเวลาเริ่มโหลดช้ากว่ารอบโหลด คืนค่า (ชั่วโมง, นาที) หรือ None ถ้าไม่ช้า"""
+    plan_time_str = str(round_str).strip()
+    actual_time_str = str(t2_str).strip()
+    if not plan_time_str or not actual_time_str: return None
+    try:
+        fmt = "%H:%M" if len(plan_time_str) <= 5 else "%H:%M:%S"
+        fmt_act = "%H:%M" if len(actual_time_str) <= 5 else "%H:%M:%S"
+        t_plan = datetime.strptime(plan_time_str, fmt)
+        t_act = datetime.strptime(actual_time_str, fmt_act)
+        if (t_plan - t_act).total_seconds() > 12 * 3600:
+            t_act = t_act + timedelta(days=1)
+        if t_act > t_plan:
+            total_seconds = (t_act - t_plan).total_seconds()
+            return int(total_seconds // 3600), int((total_seconds % 3600) // 60)
+    except: pass
+    return None
 
-            this_trip_key = (str(job_data['PO_Date']), str(job_data['Car_No']), str(job_data['Round']))
-            if this_trip_key != current_trip_id:
-                is_zebra_active = not is_zebra_active
-                current_trip_id = this_trip_key
+def build_trip_report(jobs, fingerprint=None):
+    """
+    จัดกลุ่มงานเป็นเที่ยวรถ (PO_Date, Car_No, Round, Driver) และนับสถิติ T1-T8 แยกกะกลางวัน/กลางคืน
+    - T1-T6 นับจากสาขาแรกของเที่ยว
+    - T7 นับเมื่อถึงสาขาใดสาขาหนึ่งแล้ว, T8 นับเมื่อจบงานครบทุกสาขา
+    fingerprint = Key ของไฟล์ Export ที่ Cache ไว้ (มาจาก Date Index ไม่คำนวณจาก jobs ซ้ำ)
+    """
+    sorted_jobs = []
+    groups = []
+    current_group = []
+    prev_key = None
 
-        row_fill = fill_blue_light if is_zebra_active else fill_white
-        current_border = Border(left=side_thin, right=side_thin, top=side_none, bottom=side_thin if is_group_end else side_none)
+    for job in sorted(jobs, key=report_sort_key):
+        job = dict(job)  # ไม่แก้ไขข้อมูลใน Cache โดยตรง
+        delay = calc_start_delay(job['Round'], job['T2_StartLoad'])
+        job['is_late'] = delay is not None
+        job['delay_msg'] = f"(ล่าช้า {delay[0]} ชม. {delay[1]} น.)" if delay else ""
+        sorted_jobs.append(job)
 
-        for cell in row:
-            col_name = ws.cell(row=1, column=cell.column).value
-            f_bold = False
-            f_color = '000000'
-            if col_name in ['ถึงสาขา', 'จบงาน', 'เริ่มโหลด']: f_bold = True
-            
-            if col_name == 'เริ่มโหลด':
-                cell_val_str = str(cell.value) if cell.value else ""
-                if "(ล่าช้า" in cell_val_str: f_color = 'C0392B'
-                elif cell_val_str.strip() != "": f_color = '196F3D'
-
-            cell.font = Font(name='Cordia New', size=14, bold=f_bold, color=f_color)
-            cell.border = current_border 
-            cell.fill = row_fill
-            
-            if col_name == 'ถึงสาขา': cell.fill = fill_green_branch
-            elif col_name == 'จบงาน': cell.fill = fill_red_end
-            
-            if col_name in ['คนขับ', 'ปลายทาง (สาขา)', 'ทะเบียนรถ']: cell.alignment = align_left
-            else: cell.alignment = align_center
+        curr_key = (str(job['PO_Date']), str(job['Car_No']), str(job['Round']), str(job['Driver']))
+        if curr_key != prev_key and prev_key is not None:
+            groups.append(current_group)
+            current_group = []
+        current_group.append(job)
+        prev_key = curr_key
+    if current_group: groups.append(current_group)
 
-    def create_counter(): return {'count':0, 't1':0, 't2':0, 't3':0, 't4':0, 't5':0, 't6':0, 't7':0, 't8':0}
-    sum_day = create_counter()
-    sum_night = create_counter()
-    
-    for group in grouped_jobs_for_summary:
-        if not group: continue
+    sum_day = create_shift_counter()
+    sum_night = create_shift_counter()
+    for group in groups:
         first_job = group[0]
-        last_job = group[-1]
-        
-        round_time = str(first_job.get('Round', '')).strip()
-        is_day_shift = True
-        try:
-            hour = int(round_time.split(':')[0])
-            if not (6 <= hour <= 18): is_day_shift = False
-        except: pass
-
-        target = sum_day if is_day_shift else sum_night
-        target['count'] += 1 
+        is_day, _ = get_shift_info(str(first_job.get('Round', '')).strip())
+        target = sum_day if is_day else sum_night
+        target['count'] += 1
         if first_job.get('T1_Enter'): target['t1'] += 1
         if first_job.get('T2_StartLoad'): target['t2'] += 1
         if first_job.get('T3_EndLoad'): target['t3'] += 1
         if first_job.get('T4_SubmitDoc'): target['t4'] += 1
         if first_job.get('T5_RecvDoc'): target['t5'] += 1
         if first_job.get('T6_Exit'): target['t6'] += 1
-        if first_job.get('T7_ArriveBranch'): target['t7'] += 1 
-        if last_job.get('T8_EndJob'): target['t8'] += 1       
+        if any(str(j.get('T7_ArriveBranch', '')).strip() != '' for j in group): target['t7'] += 1
+        if all(str(j.get('T8_EndJob', '')).strip() != '' for j in group): target['t8'] += 1
 
-    sum_total = create_counter()
+    sum_total = create_shift_counter()
     for k in sum_total: sum_total[k] = sum_day[k] + sum_night[k]
 
-    start_row = ws.max_row + 2 
-    # Adjusted columns for summary (shifted by 1 due to weight)
-    summary_headers = ['รอบโหลด', 'จำนวนรถ', 'เข้าโรงงาน', 'เริ่มโหลด', 'โหลดเสร็จ', 'ยื่นเอกสาร', 'รับเอกสาร', 'ออกโรงงาน', 'ถึงสาขา', 'จบงาน']
-    col_map_idx = [6, 7, 8, 9, 10, 11, 12, 13, 14, 15] 
-    
-    ws.cell(row=start_row, column=6, value="รอบโหลด")
-    for i, label in enumerate(summary_headers[1:]):
-        ws.cell(row=start_row, column=col_map_idx[i+1], value=label)
-
-    rows_to_write = [
-        ('กลางวัน', sum_day),
-        ('กลางคืน', sum_night),
-        ('รวม', sum_total)
-    ]
-    
-    for idx, (label, data) in enumerate(rows_to_write):
-        curr_r = start_row + 1 + idx
-        ws.row_dimensions[curr_r].height = 21
-        ws.cell(row=curr_r, column=6, value=label)
-        vals = [data['count'], data['t1'], data['t2'], data['t3'], data['t4'], data['t5'], data['t6'], data['t7'], data['t8']]
-        for i, val in enumerate(vals):
-            ws.cell(row=curr_r, column=col_map_idx[i+1], value=val)
-
-    for r in range(start_row, start_row + 4):
-        for c in range(6, 16): 
-            cell = ws.cell(row=r, column=c)
-            cell.border = border_all
-            cell.alignment = align_center
-            cell.font = font_summary_body
-            if r == start_row:
-                cell.fill = fill_sum_head
-                cell.font = font_summary_head
-            elif r == start_row + 3:
-                cell.fill = fill_sum_total
-                cell.font = font_summary_head
-
-    for column_cells in ws.columns:
-        col_letter = get_column_letter(column_cells[0].column)
-        col_header = column_cells[0].value
-        if col_header == 'เริ่มโหลด': ws.column_dimensions[col_letter].width = 22.00 
-        else:
-            length = 0
-            for cell in column_cells:
-                if cell.row < start_row: 
-                    val = str(cell.value) if cell.value else ""
-                    lines = val.split('\n')
-                    longest = max(len(line) for line in lines) if lines else 0
-                    if longest > length: length = longest
-            ws.column_dimensions[col_letter].width = min(length + 5, 50)
+    return {'jobs': sorted_jobs, 'groups': groups,
+            'sum_day': sum_day, 'sum_night': sum_night, 'sum_total': sum_total,
+            'fingerprint': fingerprint, 'all_done': is_jobs_all_done(jobs)}
 
-    final_output = io.BytesIO()
-    wb.save(final_output)
-    final_output.seek(0)
-    filename = f"Report_{date_filter if date_filter else 'All'}.xlsx"
-    return send_file(final_output, download_name=filename, as_attachment=True)
-    
-@app.route('/export_pdf')
-def export_pdf():
-    # Helper Function สำหรับแปลงวันที่
-    def thai_date_filter(date_str):
-        try:
-            d = datetime.strptime(date_str, "%Y-%m-%d")
-            return f"{d.day} {['ม.ค.','ก.พ.','มี.ค.','เม.ย.','พ.ค.','มิ.ย.','ก.ค.','ส.ค.','ก.ย.','ต.ค.','พ.ย.','ธ.ค.'][d.month-1]} {d.year+543}"
-        except: return date_str
+def combine_fingerprints(days):
+    """[(PO_Date, entry)] -> Fingerprint เดียวของหลายวัน"""
+    return hashlib.sha1('|'.join(f"{d}:{e['fingerprint']}" for d, e in days).encode('utf-8')).hexdigest()
 
-    sheet = get_db()
+def is_jobs_all_done(jobs):
+    active_jobs = [j for j in jobs if str(j.get('Status', '')).lower() != 'cancel']
+    return bool(active_jobs) and all(j['Status'] == 'Done' for j in active_jobs)
+
+def add_shift_counter(target, source):
+    for k in target: target[k] += source[k]
+
+def get_jobs_date_index(sheet):
+    """
+    จัดกลุ่มงานตาม PO_Date (อ้างอิง Dict เดิมใน Cache ไม่ Copy ข้อมูล)
+    สร้างใหม่เฉพาะเมื่อ Version ของข้อมูล Jobs เปลี่ยน
+    """
     raw_jobs = get_cached_records(sheet, 'Jobs')
-    date_filter = request.args.get('date_filter')
-    
-    if date_filter:
-        jobs = [j for j in raw_jobs if str(j['PO_Date']).strip() == str(date_filter).strip()]
+    version = get_data_version('Jobs')
+    if jobs_date_index['version'] == version:
+        return jobs_date_index['index']
+
+    index = {}
+    for job in raw_jobs:
+        date_key = str(job['PO_Date']).strip()
+        index.setdefault(date_key, {'jobs': []})['jobs'].append(job)
+    # Fingerprint / all_done ของทุกวันคำนวณรวดเดียวจาก Frame (ไม่ต้อง json.dumps ทั้งตารางทุกครั้งที่ข้อมูลเปลี่ยน)
+    summary = analytics_date_summary(sheet)
+    for date_key, entry in index.items():
+        entry['fingerprint'] = summary.at[date_key, 'fingerprint']
+        entry['all_done'] = bool(summary.at[date_key, 'all_done'])
+    # วันที่ย้ายไปเก็บในไฟล์แล้ว: อ่านงานจากไฟล์เมื่อต้องใช้ (date_entry_jobs)
+    for date_key, archived in read_archive_manifest().items():
+        if date_key not in index:
+            index[date_key] = {'jobs': None, 'fingerprint': archived['fingerprint'], 'all_done': True}
+
+    jobs_date_index['version'] = version
+    jobs_date_index['index'] = index
+    return index
+
+def date_entry_jobs(date_key, entry):
+    return entry['jobs'] if entry['jobs'] is not None else archived_jobs(date_key)
+
+def get_trip_report(sheet, date_filter):
+    """ดึงรายงานของวันที่ (หรือทั้งหมด ถ้าไม่ระบุ) จาก Cache ตาม Version ของข้อมูล Jobs"""
+    raw_jobs = get_cached_records(sheet, 'Jobs')
+    date_key = str(date_filter).strip() if date_filter else ''
+    cache_key = (date_key, get_data_version('Jobs'))
+
+    report = report_cache.get(cache_key)
+    if report is not None:
+        report_cache.move_to_end(cache_key)
+        return report
+
+    index = get_jobs_date_index(sheet)
+    if date_key:
+        entry = index.get(date_key)
+        jobs = date_entry_jobs(date_key, entry) if entry else []
+        fingerprint = entry['fingerprint'] if entry else combine_fingerprints([])
     else:
         jobs = raw_jobs
-        
-    def sort_key_func(job):
-        po_date = str(job['PO_Date'])
-        car_no_str = str(job['Car_No']).strip()
-        round_val = str(job['Round'])
-        try: car_no_int = int(car_no_str)
-        except ValueError: car_no_int = 99999 
-        return (po_date, car_no_int, round_val)
+        fingerprint = combine_fingerprints((d, e) for d, e in sorted(index.items()) if e['jobs'] is not None)
 
-    jobs = sorted(jobs, key=sort_key_func)
+    report = build_trip_report(jobs, fingerprint)
+    report_cache[cache_key] = report
+    while len(report_cache) > REPORT_CACHE_SIZE:
+        report_cache.popitem(last=False)
+    return report
 
-    # [FIX 1] เพิ่ม t4 และ t5 ในตัวนับ
-    def create_counter(): return {'total': 0, 't1': 0, 't2': 0, 't3': 0, 't4': 0, 't5': 0, 't6': 0, 't7': 0, 't8': 0}
-    sum_day = create_counter()
-    sum_night = create_counter()
-    grouped_jobs = []
-    current_group = []
-    prev_key = None
-    
-    # Grouping Logic
-    for job in jobs:
-        curr_key = (str(job['PO_Date']), str(job['Car_No']), str(job['Round']), str(job['Driver']))
-        if curr_key != prev_key and prev_key is not None:
-            grouped_jobs.append(current_group)
-            current_group = []
-        current_group.append(job)
-        prev_key = curr_key
-        
-        job['is_late'] = False
-        job['delay_msg'] = ""
-        t_plan_str = str(job['Round']).strip()
-        t_act_str = str(job['T2_StartLoad']).strip()
-        
-        if t_plan_str and t_act_str:
-            try:
-                fmt_plan = "%H:%M" if len(t_plan_str) <= 5 else "%H:%M:%S"
-                fmt_act = "%H:%M" if len(t_act_str) <= 5 else "%H:%M:%S"
-                t_plan = datetime.strptime(t_plan_str, fmt_plan)
-                t_act = datetime.strptime(t_act_str, fmt_act)
-                if (t_plan - t_act).total_seconds() > 12 * 3600: t_act = t_act + timedelta(days=1)
-                if t_act > t_plan:
-                    job['is_late'] = True
-                    diff = t_act - t_plan
-                    total_seconds = diff.total_seconds()
-                    hours = int(total_seconds // 3600)
-                    minutes = int((total_seconds % 3600) // 60)
-                    job['delay_msg'] = f"(ล่าช้า {hours} ชม. {minutes} น.)"
-            except: pass
-            
-    if current_group: grouped_jobs.append(current_group)
+def parse_export_range(args):
+    """
+    อ่านช่วงวันที่ start/end จาก Query String
+    คืนค่า (start, end) หรือ None ถ้าไม่ได้ระบุ, ValueError ถ้ารูปแบบผิด/ช่วงยาวเกินไป
+    """
+    start = (args.get('start') or '').strip()
+    end = (args.get('end') or '').strip()
+    if not start and not end: return None
+    start = start or end
+    end = end or start
+    d_start = datetime.strptime(start, "%Y-%m-%d")
+    d_end = datetime.strptime(end, "%Y-%m-%d")
+    if d_end < d_start:
+        raise ValueError('end ต้องไม่น้อยกว่า start')
+    if (d_end - d_start).days + 1 > EXPORT_RANGE_MAX_DAYS:
+        raise ValueError(f'ช่วงวันที่ต้องไม่เกิน {EXPORT_RANGE_MAX_DAYS} วัน')
+    return d_start.strftime("%Y-%m-%d"), d_end.strftime("%Y-%m-%d")
+
+def get_range_report(sheet, start, end):
+    """
+    รายงานช่วงวันที่ (ยังไม่ประมวลผล) เก็บแค่ Reference ไปยัง Date Index
+    ตัว Render จะสร้างรายงานทีละวันผ่าน iter_range_reports
+    """
+    index = get_jobs_date_index(sheet)
+    days = [(date_key, index[date_key]) for date_key in sorted(index) if start <= date_key <= end]
+    return {'start': start, 'end': end, 'days': days, 'fingerprint': combine_fingerprints(days),
+            'all_done': bool(days) and all(e['all_done'] for _, e in days)}
+
+def iter_range_reports(range_report):
+    """Yield (date_key, report) ทีละวัน รายงานของวันก่อนหน้าถูกทิ้งได้ทันที (ไม่เก็บลง report_cache)"""
+    for date_key, entry in range_report['days']:
+        yield date_key, build_trip_report(date_entry_jobs(date_key, entry), entry['fingerprint'])
+
+def range_label(range_report):
+    start, end = range_report['start'], range_report['end']
+    if start == end: return thai_date_text(start)
+    return f"{thai_date_text(start)} - {thai_date_text(end)}"
+
+class RangeSummary:
+    """
+    สะสมยอดของรายงานช่วงวันที่ทีละวัน (ยอดรายวัน / รวมรายเดือน / รวมทั้งหมด)
+    add() และ finish() คืนค่าแถวสรุป (kind, label, data) ที่พร้อมเขียนต่อได้ทันที
+    kind: 'day' | 'month' | 'shift' | 'total'
+    """
 
-    # Counting Logic
-    for group in grouped_jobs:
-        if not group: continue
-        first_job = group[0]
-        round_time = str(first_job.get('Round', '')).strip()
-        is_day_shift = True
+    def __init__(self):
+        self.month_key = None
+        self.month = create_shift_counter()
+        self.sum_day = create_shift_counter()
+        self.sum_night = create_shift_counter()
+        self.sum_total = create_shift_counter()
+
+    def _close_month(self):
+        if self.month_key is None: return []
+        y, m = self.month_key
+        row = ('month', f"รวม {THAI_MONTHS_SHORT[m-1]} {y+543}", self.month)
+        self.month = create_shift_counter()
+        return [row]
+
+    def add(self, date_key, report):
+        rows = []
+        month_key = (int(date_key[:4]), int(date_key[5:7]))
+        if month_key != self.month_key:
+            rows += self._close_month()
+            self.month_key = month_key
+        add_shift_counter(self.month, report['sum_total'])
+        add_shift_counter(self.sum_day, report['sum_day'])
+        add_shift_counter(self.sum_night, report['sum_night'])
+        add_shift_counter(self.sum_total, report['sum_total'])
+        rows.append(('day', thai_date_filter(date_key), report['sum_total']))
+        return rows
+
+    def finish(self):
+        rows = self._close_month()
+        self.month_key = None
+        return rows + [('shift', 'กลางวัน', self.sum_day), ('shift', 'กลางคืน', self.sum_night),
+                       ('total', 'รวมทั้งหมด', self.sum_total)]
+
+# ==========================================
+# [Export Cache] เก็บไฟล์ Excel/PDF ที่สร้างแล้ว (LRU จำกัดขนาด + ETag)
+# ==========================================
+ARTIFACT_CACHE_MAX_BYTES = int(os.environ.get('EXPORT_CACHE_MAX_MB', '64')) * 1024 * 1024
+ARTIFACT_TTL_OPEN = 15 * 60              # วันที่ยังมีงานค้าง
+ARTIFACT_TTL_CLOSED = 7 * 24 * 3600      # วันที่ผ่านไปแล้วและจบงานครบทุกเที่ยว
+artifact_cache = OrderedDict()  # (format, date, fingerprint) -> entry
+artifact_cache_bytes = 0
+
+EXPORT_MAX_WORKERS = int(os.environ.get('EXPORT_MAX_WORKERS', '2'))   # สร้างไฟล์พร้อมกันได้กี่งาน
+EXPORT_SYNC_WAIT = 10  # วินาทีที่ Request แบบ Sync รอคิวได้ ก่อนตอบ 429
+export_render_slots = threading.BoundedSemaphore(EXPORT_MAX_WORKERS)
+
+def is_report_closed(report, date_key):
+    """วันที่ผ่านมาแล้ว และทุกเที่ยวสถานะ Done -> ข้อมูลจะไม่เปลี่ยนอีก (รายงานช่วงวันที่ดูจากวันสุดท้าย)"""
+    date_key = report.get('end', date_key)
+    if not date_key or not report['all_done']: return False
+    today = (datetime.now() + timedelta(hours=7)).strftime("%Y-%m-%d")
+    return date_key < today
+
+def _drop_artifact(key):
+    global artifact_cache_bytes
+    entry = artifact_cache.pop(key, None)
+    if entry: artifact_cache_bytes -= entry['size']
+
+def get_artifact(key):
+    entry = artifact_cache.get(key)
+    if entry is None: return None
+    if time.time() > entry['expires']:
+        _drop_artifact(key)
+        return None
+    artifact_cache.move_to_end(key)
+    return entry
+
+def put_artifact(key, data, closed=False):
+    """เก็บไฟล์ลง Cache ถ้าเกินขนาดจะลบไฟล์ของวันที่ยังไม่ปิดก่อน แล้วค่อยลบของวันที่ปิดแล้ว (เก่าสุดก่อน)"""
+    global artifact_cache_bytes
+    now = time.time()
+    entry = {
+        'data': data,
+        'size': len(data),
+        'etag': hashlib.sha256(data).hexdigest(),
+        'closed': closed,
+        'expires': now + (ARTIFACT_TTL_CLOSED if closed else ARTIFACT_TTL_OPEN)
+    }
+    if entry['size'] > ARTIFACT_CACHE_MAX_BYTES: return entry
+
+    _drop_artifact(key)
+    artifact_cache[key] = entry
+    artifact_cache_bytes += entry['size']
+
+    for keep_closed in (False, True):
+        for old_key in list(artifact_cache.keys()):
+            if artifact_cache_bytes <= ARTIFACT_CACHE_MAX_BYTES: return entry
+            old = artifact_cache[old_key]
+            if old_key == key or (old['closed'] and not keep_closed): continue
+            _drop_artifact(old_key)
+    return entry
+
+def send_report_artifact(fmt, date_filter, report, render_func, download_name, mimetype=None):
+    """ส่งไฟล์ Export จาก Cache (ถ้ามี) หรือสร้างใหม่ด้วย render_func(report, date_filter)"""
+    date_key = str(date_filter).strip() if date_filter else ''
+    key = (fmt, date_key, report['fingerprint'])
+    entry = get_artifact(key)
+    if entry is None:
+        # จำกัดจำนวนการสร้างไฟล์พร้อมกันใน Web Worker ไม่ให้แย่ง Worker ของหน้าคนขับ
+        if not export_render_slots.acquire(timeout=EXPORT_SYNC_WAIT):
+            return json.dumps({'status': 'busy', 'message': 'ระบบกำลังสร้างรายงานอื่นอยู่ กรุณาใช้ async=1 หรือลองใหม่อีกครั้ง'}), 429
         try:
-            hour = int(round_time.split(':')[0])
-            if not (6 <= hour <= 18): is_day_shift = False
+            entry = put_artifact(key, render_func(report, date_filter), closed=is_report_closed(report, date_key))
+        finally:
+            export_render_slots.release()
+
+    return send_file(io.BytesIO(entry['data']), mimetype=mimetype, as_attachment=True,
+                     download_name=download_name, etag=entry['etag'], conditional=True, max_age=0)
+
+# ==========================================
+# [Excel] Streaming Report Writer (write-only workbook)
+# ==========================================
+EXCEL_HEADERS = ['ลำดับรถ', 'PO Date', 'เวลาโหลด', 'คนขับ', 'ปลายทาง (สาขา)', 'น้ำหนัก', 'ทะเบียนรถ',
+                 'เข้าโรงงาน', 'เริ่มโหลด', 'โหลดเสร็จ', 'ยื่นเอกสาร', 'รับเอกสาร', 'ออกโรงงาน', 'ถึงสาขา', 'จบงาน']
+EXCEL_BOLD_COLS = {'ถึงสาขา', 'จบงาน', 'เริ่มโหลด'}
+EXCEL_LEFT_COLS = {'คนขับ', 'ปลายทาง (สาขา)', 'ทะเบียนรถ'}
+EXCEL_FILL_COLS = {'ถึงสาขา': 'D5F5E3', 'จบงาน': 'FADBD8'}
+EXCEL_SUMMARY_HEADERS = ['รอบโหลด', 'จำนวนรถ', 'เข้าโรงงาน', 'เริ่มโหลด', 'โหลดเสร็จ', 'ยื่นเอกสาร', 'รับเอกสาร', 'ออกโรงงาน', 'ถึงสาขา', 'จบงาน']
+EXCEL_SUMMARY_START_COL = 6  # Column F (ขยับ 1 ช่องเพราะมี Weight)
+EXCEL_ROW_HEIGHT = 21
+
+class ExcelStyleCache:
+    """เก็บ NamedStyle ที่สร้างแล้วไว้ใช้ซ้ำ แทนการสร้าง Font/Border ใหม่ทุก Cell"""
+
+    def __init__(self, wb):
+        self.wb = wb
+        self.styles = {}
+
+    def get(self, bold=False, color='000000', fill='FFFFFF', align='center', border='group', bottom=False):
+        key = (bold, color, fill, align, border, bottom)
+        style = self.styles.get(key)
+        if style is not None: return style
+
+        side_thin = Side(border_style="thin", color="000000")
+        side_none = Side(border_style=None)
+        if border == 'all':
+            cell_border = Border(top=side_thin, bottom=side_thin, left=side_thin, right=side_thin)
+        elif border is None:
+            cell_border = Border()
+        else:
+            cell_border = Border(left=side_thin, right=side_thin, top=side_none, bottom=side_thin if bottom else side_none)
+
+        name = f"lmt_{len(self.styles)}"
+        self.wb.add_named_style(NamedStyle(
+            name=name,
+            font=Font(name='Cordia New', size=14, bold=bold, color=color),
+            fill=PatternFill(start_color=fill, end_color=fill, fill_type='solid') if fill else PatternFill(),
+            border=cell_border,
+            alignment=Alignment(horizontal=align, vertical='center', wrap_text=True)
+        ))
+        self.styles[key] = name
+        return name
+
+    def cell(self, ws, value, style):
+        cell = WriteOnlyCell(ws, value=None if value == "" else value)
+        cell.style = style
+        return cell
+
+def iter_excel_detail_rows(jobs):
+    """
+    สร้างข้อมูลทีละแถวสำหรับตาราง Excel (jobs จาก build_trip_report)
+    Yield: (values, zebra_key, is_group_end)
+    """
+    prev_trip_key = None
+    for job_index, job in enumerate(jobs):
+        current_trip_key = (str(job['PO_Date']), str(job['Car_No']), str(job['Round']), str(job['Driver']))
+        is_same = (current_trip_key == prev_trip_key)
+        prev_trip_key = current_trip_key
+
+        zebra_key = current_trip_key[:3]
+        is_group_end = True
+        if job_index < len(jobs) - 1:
+            next_job = jobs[job_index + 1]
+            next_key = (str(next_job['PO_Date']), str(next_job['Car_No']), str(next_job['Round']))
+            is_group_end = (next_key != zebra_key)
+
+        if is_same:
+            values = ["", "", "", "", job['Branch_Name'], "", "", "", "", "", "", "", "",
+                      job['T7_ArriveBranch'], job['T8_EndJob']]
+            yield values, zebra_key, is_group_end
+            continue
+
+        t2_display = job['T2_StartLoad']
+        if t2_display and job['is_late']:
+            t2_display = f"{str(job['T2_StartLoad']).strip()} {job['delay_msg']}"
+
+        formatted_date = job['PO_Date']
+        try: formatted_date = datetime.strptime(str(job['PO_Date']).strip(), "%Y-%m-%d").strftime("%d/%m/%Y")
         except: pass
 
-        target_sum = sum_day if is_day_shift else sum_night
-        target_sum['total'] += 1
-        
-        # [FIX 2] เก็บสถิติให้ครบทุกช่อง T1-T8
-        if first_job.get('T1_Enter'): target_sum['t1'] += 1
-        if first_job.get('T2_StartLoad'): target_sum['t2'] += 1
-        if first_job.get('T3_EndLoad'): target_sum['t3'] += 1
-        if first_job.get('T4_SubmitDoc'): target_sum['t4'] += 1
-        if first_job.get('T5_RecvDoc'): target_sum['t5'] += 1
-        if first_job.get('T6_Exit'): target_sum['t6'] += 1
-        
-        if any(str(j.get('T7_ArriveBranch', '')).strip() != '' for j in group): target_sum['t7'] += 1
-        if all(str(j.get('T8_EndJob', '')).strip() != '' for j in group): target_sum['t8'] += 1
+        values = [
+            job['Car_No'], formatted_date, job['Round'], job['Driver'], job['Branch_Name'],
+            comma_format(job.get('Weight', '')), job['Plate'], job['T1_Enter'], t2_display,
+            job['T3_EndLoad'], job['T4_SubmitDoc'], job['T5_RecvDoc'], job['T6_Exit'],
+            job['T7_ArriveBranch'], job['T8_EndJob']
+        ]
+        yield values, zebra_key, is_group_end
+
+def calc_excel_widths(jobs):
+    """วัดความกว้างคอลัมน์จากข้อมูล (ต้องรู้ก่อนเขียนแถวแรกในโหมด write-only)"""
+    lengths = [len(h) for h in EXCEL_HEADERS]
+    for values, _, _ in iter_excel_detail_rows(jobs):
+        for i, val in enumerate(values):
+            if val == "" or val is None: continue
+            longest = max(len(line) for line in str(val).split('\n'))
+            if longest > lengths[i]: lengths[i] = longest
+
+    widths = []
+    for i, header in enumerate(EXCEL_HEADERS):
+        if header == 'เริ่มโหลด': widths.append(22.00)
+        else: widths.append(min(lengths[i] + 5, 50))
+    return widths
+
+def write_excel_sheet(wb, styles, title, jobs, summary_rows):
+    """เขียน Sheet รายงาน 1 แผ่นแบบ Streaming (ไม่เก็บ Cell ไว้ในหน่วยความจำ)"""
+    ws = wb.create_sheet(title)
+    ws.freeze_panes = 'A2'
+    ws.sheet_format.defaultRowHeight = EXCEL_ROW_HEIGHT
+    ws.sheet_format.customHeight = True
+    for i, width in enumerate(calc_excel_widths(jobs)):
+        ws.column_dimensions[get_column_letter(i + 1)].width = width
 
-    sum_total = create_counter()
-    for key in sum_total:
-        sum_total[key] = sum_day[key] + sum_night[key]
+    header_style = styles.get(bold=True, color='FFFFFF', fill='2E4053', border='all')
+    ws.append([styles.cell(ws, h, header_style) for h in EXCEL_HEADERS])
 
-    basedir = os.path.abspath(os.path.dirname(__file__))
-    font_path = os.path.join(basedir, 'static', 'fonts', 'Sarabun-Regular.ttf')
-    logo_path = os.path.join(basedir, 'static', 'mylogo.png') 
-    po_date_thai = thai_date_filter(date_filter) if date_filter else "ทั้งหมด"
-    print_date = (datetime.now() + timedelta(hours=7)).strftime("%d/%m/%Y %H:%M")
+    current_zebra_key = None
+    is_zebra_active = False
+    for values, zebra_key, is_group_end in iter_excel_detail_rows(jobs):
+        if zebra_key != current_zebra_key:
+            is_zebra_active = not is_zebra_active
+            current_zebra_key = zebra_key
+        row_fill = 'EBF5FB' if is_zebra_active else 'FFFFFF'
+
+        row = []
+        for col_name, value in zip(EXCEL_HEADERS, values):
+            f_color = '000000'
+            if col_name == 'เริ่มโหลด' and value:
+                f_color = 'C0392B' if "(ล่าช้า" in str(value) else '196F3D'
+            style = styles.get(
+                bold=col_name in EXCEL_BOLD_COLS, color=f_color,
+                fill=EXCEL_FILL_COLS.get(col_name, row_fill),
+                align='left' if col_name in EXCEL_LEFT_COLS else 'center',
+                bottom=is_group_end
+            )
+            row.append(styles.cell(ws, value, style))
+        ws.append(row)
+
+    # ตารางสรุปท้ายรายงาน (เว้น 1 แถว)
+    ws.append([])
+    pad = [None] * (EXCEL_SUMMARY_START_COL - 1)
+    head_style = styles.get(bold=True, fill='D6EAF8', border='all')
+    ws.append(pad + [styles.cell(ws, h, head_style) for h in EXCEL_SUMMARY_HEADERS])
+    for idx, (label, data) in enumerate(summary_rows):
+        is_total = (idx == len(summary_rows) - 1)
+        style = styles.get(bold=is_total, fill='FFFF00' if is_total else None, border='all')
+        vals = [label, data['count'], data['t1'], data['t2'], data['t3'], data['t4'], data['t5'], data['t6'], data['t7'], data['t8']]
+        ws.append(pad + [styles.cell(ws, v, style) for v in vals])
+    return ws
+
+def render_export_excel(report, date_filter):
+    """สร้างไฟล์ Excel (bytes) จากผลของ get_trip_report"""
+    wb = Workbook(write_only=True)
+    styles = ExcelStyleCache(wb)
+    write_excel_sheet(wb, styles, 'Report', report['jobs'],
+                      [('กลางวัน', report['sum_day']), ('กลางคืน', report['sum_night']), ('รวม', report['sum_total'])])
 
-    class PDF(FPDF):
-        def __init__(self, **kwargs):
-            super().__init__(**kwargs)
-            self.is_summary_page = False
-
-        def header(self):
-            self.add_font('Sarabun', '', font_path, uni=True)
-            if self.is_summary_page:
-                self.set_font('Sarabun', '', 18)
-                self.set_y(25)
-                self.cell(0, 15, f'สรุปภาพรวมการจัดส่งสินค้า ประจำวันที่ {po_date_thai}', align='C', new_x="LMARGIN", new_y="NEXT")
-                self.ln(5)
-            else:
-                if os.path.exists(logo_path):
-                    self.image(logo_path, x=7, y=8, w=18)
-                
-                self.set_font('Sarabun', '', 16) 
-                self.set_y(10)
-                self.cell(0, 8, 'รายงานสรุปการจัดส่งสินค้า (Daily Jobs Report)', align='C', new_x="LMARGIN", new_y="NEXT")
-                self.set_font_size(14)
-                self.cell(0, 8, 'บริษัท แอลเอ็มที. ทรานสปอร์ต จำกัด', align='C', new_x="LMARGIN", new_y="NEXT")
-                self.set_font_size(10)
-                self.cell(0, 6, f'วันที่เอกสาร: {po_date_thai} | พิมพ์เมื่อ: {print_date}', align='C', new_x="LMARGIN", new_y="NEXT")
-                self.ln(4)
-
-                cols = [12, 28, 40, 15, 55, 15, 15, 30, 15, 15, 20, 20]
-                headers = ['คันที่', 'ทะเบียน', 'คนขับ', 'เวลาโหลด', 'ปลายทาง', 'นน.', 'เข้าโรงงาน', 'เริ่มโหลด', 'โหลดเสร็จ', 'ออกโรงงาน', 'ถึงสาขา', 'จบงาน']
-                self.set_fill_color(44, 62, 80)
-                self.set_text_color(255, 255, 255)
-                self.set_font('Sarabun', '', 9) 
-                for i, h in enumerate(headers):
-                    self.cell(cols[i], 8, h, border=1, align='C', fill=True)
-                self.ln()
-                self.set_text_color(0, 0, 0)
-
-        def footer(self):
-            self.set_y(-15)
-            self.set_font('Sarabun', '', 8)
-            self.set_text_color(100, 100, 100)
-            self.cell(0, 10, 'ข้อมูลจาก: ระบบ LMT. Transport Driver App V.1.02', align='L')
-            self.set_x(-30)
-            self.cell(0, 10, f'หน้า {self.page_no()}/{{nb}}', align='R')
-
-    pdf = PDF(orientation='L', unit='mm', format='A4')
-    pdf.alias_nb_pages()
-    pdf.set_margins(7, 10, 7)
-    pdf.add_page()
-    
-    cols = [12, 28, 40, 15, 55, 15, 15, 30, 15, 15, 20, 20]
+    final_output = io.BytesIO()
+    wb.save(final_output)
+    return final_output.getvalue()
+
+EXCEL_RANGE_SUMMARY_HEADERS = ['วันที่'] + EXCEL_SUMMARY_HEADERS[1:]
+
+def render_export_excel_range(range_report, range_key):
+    """
+    สร้างไฟล์ Excel ช่วงวันที่: Sheet 'สรุป' (ยอดรายวัน/รายเดือน) + 1 Sheet ต่อวัน
+    ประมวลผลทีละวันและเขียนลง Write-only Sheet ทันที หน่วยความจำไม่โตตามจำนวนวัน
+    """
+    wb = Workbook(write_only=True)
+    styles = ExcelStyleCache(wb)
+
+    summary_ws = wb.create_sheet('สรุป')
+    summary_ws.sheet_format.defaultRowHeight = EXCEL_ROW_HEIGHT
+    summary_ws.sheet_format.customHeight = True
+    summary_ws.column_dimensions['A'].width = 22
+    for i in range(1, len(EXCEL_RANGE_SUMMARY_HEADERS)):
+        summary_ws.column_dimensions[get_column_letter(i + 1)].width = 13
+
+    title_style = styles.get(bold=True, fill=None, align='left', border=None)
+    head_style = styles.get(bold=True, color='FFFFFF', fill='2E4053', border='all')
+    row_styles = {
+        'day': styles.get(fill=None, border='all'),
+        'month': styles.get(bold=True, fill='D6EAF8', border='all'),
+        'shift': styles.get(fill=None, border='all'),
+        'total': styles.get(bold=True, fill='FFFF00', border='all'),
+    }
+    summary_ws.append([styles.cell(summary_ws, f"สรุปการจัดส่งสินค้า {range_label(range_report)}", title_style)])
+    summary_ws.append([styles.cell(summary_ws, h, head_style) for h in EXCEL_RANGE_SUMMARY_HEADERS])
+
+    def write_summary_rows(rows):
+        for kind, label, data in rows:
+            vals = [label, data['count'], data['t1'], data['t2'], data['t3'], data['t4'], data['t5'], data['t6'], data['t7'], data['t8']]
+            summary_ws.append([styles.cell(summary_ws, v, row_styles[kind]) for v in vals])
+
+    summary = RangeSummary()
+    for date_key, report in iter_range_reports(range_report):
+        write_excel_sheet(wb, styles, date_key, report['jobs'],
+                          [('กลางวัน', report['sum_day']), ('กลางคืน', report['sum_night']), ('รวม', report['sum_total'])])
+        write_summary_rows(summary.add(date_key, report))
+    write_summary_rows(summary.finish())
+
+    final_output = io.BytesIO()
+    wb.save(final_output)
+    return final_output.getvalue()
+
+def send_range_export(fmt, render_func, filename_prefix, extension, mimetype=None):
+    """ส่งไฟล์ Export แบบช่วงวันที่ (start/end) คืน None ถ้า Request ไม่ได้ระบุช่วงวันที่"""
+    try:
+        date_range = parse_export_range(request.args)
+    except ValueError as e:
+        return json.dumps({'status': 'error', 'message': f'ช่วงวันที่ไม่ถูกต้อง: {e}'}), 400
+    if date_range is None: return None
+
+    start, end = date_range
+    range_report = get_range_report(get_db(), start, end)
+    if is_async_export_request():
+        return submit_export_job(fmt, f"{start}_{end}", range_report)
+    filename = f"{filename_prefix}_{start}_to_{end}.{extension}"
+    return send_report_artifact(fmt, f"{start}_{end}", range_report, render_func, filename, mimetype=mimetype)
+
+@app.route('/export_excel')
+def export_excel():
+    range_response = send_range_export('xlsx', render_export_excel_range, 'Report', 'xlsx')
+    if range_response is not None: return range_response
+
+    sheet = get_db()
+    date_filter = request.args.get('date_filter')
+    report = get_trip_report(sheet, date_filter)
+    if is_async_export_request():
+        return submit_export_job('xlsx', date_filter, report)
+    filename = f"Report_{date_filter if date_filter else 'All'}.xlsx"
+    return send_report_artifact('xlsx', date_filter, report, render_export_excel, filename)
+
+# ==========================================
+# [PDF] Report Renderer (ลงทะเบียนฟอนต์/โลโก้ครั้งเดียว ไม่ทำซ้ำทุกหน้า)
+# ==========================================
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+PDF_FONT_PATH = os.path.join(BASE_DIR, 'static', 'fonts', 'Sarabun-Regular.ttf')
+PDF_LOGO_PATH = os.path.join(BASE_DIR, 'static', 'mylogo.png')
+pdf_logo_cache = {}  # image_filter -> RasterImageInfo ที่ decode แล้ว
+
+def get_pdf_logo_info(image_filter):
+    """Decode ไฟล์โลโก้ PNG ครั้งเดียวต่อ Process (คืน None ถ้าไม่มีไฟล์)"""
+    if image_filter not in pdf_logo_cache:
+        info = None
+        if os.path.exists(PDF_LOGO_PATH):
+            info = get_img_info(PDF_LOGO_PATH, image_filter=image_filter)
+        pdf_logo_cache[image_filter] = info
+    return pdf_logo_cache[image_filter]
+
+class ReportPDF(FPDF):
+    """
+    ฐานของ PDF รายงานทุกแบบ
+    - ลงทะเบียนฟอนต์ Sarabun ครั้งเดียวตอนสร้างเอกสาร (เดิมเรียก add_font ทุกหน้าใน header)
+    - ใช้โลโก้ที่ decode ไว้แล้วจาก get_pdf_logo_info แทนการอ่านไฟล์ใหม่ทุกเอกสาร
+    """
+
+    def __init__(self, po_date_thai='', print_date='', **kwargs):
+        super().__init__(**kwargs)
+        self.po_date_thai = po_date_thai
+        self.print_date = print_date
+        self.is_summary_page = False
+        self.add_font('Sarabun', '', PDF_FONT_PATH)
+        self.has_logo = self._attach_logo()
+        self.alias_nb_pages()
+
+    def _attach_logo(self):
+        # ใช้โครงสร้างภายในของ image_cache (i / usages / iccp_i) -> requirements.txt ตรึงรุ่น fpdf2 ไว้
+        info = get_pdf_logo_info(self.image_cache.image_filter)
+        if info is None: return False
+        if info.get('iccp') is None:
+            # สำเนาข้อมูลภาพให้เอกสารนี้ (ข้อมูลภาพที่บีบอัดแล้วใช้ร่วมกันได้)
+            doc_info = copy(info)
+            doc_info['i'] = len(self.image_cache.images) + 1
+            doc_info['usages'] = 0
+            doc_info['iccp_i'] = None
+            self.image_cache.images[PDF_LOGO_PATH] = doc_info
+        return True
+
+    def draw_logo(self, x, y, w):
+        if self.has_logo:
+            self.image(PDF_LOGO_PATH, x=x, y=y, w=w)
+
+class DailyReportPDF(ReportPDF):
+    """PDF รายงานประจำวัน (A4 แนวนอน) + หน้าสรุปท้ายเอกสาร"""
+    COLS = [12, 28, 40, 15, 55, 15, 15, 30, 15, 15, 20, 20]
+    HEADERS = ['คันที่', 'ทะเบียน', 'คนขับ', 'เวลาโหลด', 'ปลายทาง', 'นน.', 'เข้าโรงงาน', 'เริ่มโหลด', 'โหลดเสร็จ', 'ออกโรงงาน', 'ถึงสาขา', 'จบงาน']
+
+    def header(self):
+        if self.is_summary_page:
+            self.set_font('Sarabun', '', 18)
+            self.set_y(25)
+            self.cell(0, 15, f'สรุปภาพรวมการจัดส่งสินค้า ประจำวันที่ {self.po_date_thai}', align='C', new_x="LMARGIN", new_y="NEXT")
+            self.ln(5)
+            return
+
+        self.draw_logo(x=7, y=8, w=18)
+        self.set_font('Sarabun', '', 16) 
+        self.set_y(10)
+        self.cell(0, 8, 'รายงานสรุปการจัดส่งสินค้า (Daily Jobs Report)', align='C', new_x="LMARGIN", new_y="NEXT")
+        self.set_font_size(14)
+        self.cell(0, 8, 'บริษัท แอลเอ็มที. ทรานสปอร์ต จำกัด', align='C', new_x="LMARGIN", new_y="NEXT")
+        self.set_font_size(10)
+        self.cell(0, 6, f'วันที่เอกสาร: {self.po_date_thai} | พิมพ์เมื่อ: {self.print_date}', align='C', new_x="LMARGIN", new_y="NEXT")
+        self.ln(4)
+
+        self.set_fill_color(44, 62, 80)
+        self.set_text_color(255, 255, 255)
+        self.set_font('Sarabun', '', 9) 
+        for i, h in enumerate(self.HEADERS):
+            self.cell(self.COLS[i], 8, h, border=1, align='C', fill=True)
+        self.ln()
+        self.set_text_color(0, 0, 0)
+
+    def footer(self):
+        self.set_y(-15)
+        self.set_font('Sarabun', '', 8)
+        self.set_text_color(100, 100, 100)
+        self.cell(0, 10, 'ข้อมูลจาก: ระบบ LMT. Transport Driver App V.1.02', align='L')
+        self.set_x(-30)
+        self.cell(0, 10, f'หน้า {self.page_no()}/{{nb}}', align='R')
+
+class CompactReportPDF(ReportPDF):
+    """PDF รายงานแบบย่อ (A4 แนวตั้ง)"""
+    COLS = [10, 18, 27, 13, 50, 13, 13, 13, 13, 13, 13]
+    HEADERS = ['คันที่', 'ทะเบียน', 'คนขับ', 'เวลาโหลด', 'ปลายทาง', 'เข้าโรงงาน', 'เริ่มโหลด', 'โหลดเสร็จ', 'ออกโรงงาน', 'ถึงสาขา', 'จบงาน']
+
+    def header(self):
+        self.draw_logo(x=7, y=6, w=10)
+        self.set_font('Sarabun', '', 12) 
+        self.set_y(6)
+        self.cell(0, 8, 'สรุปรายงานการจัดส่งสินค้า (Compact View)', align='C', new_x="LMARGIN", new_y="NEXT")
+        self.set_font_size(10)
+        self.cell(0, 7, 'บริษัท แอลเอ็มที. ทรานสปอร์ต จำกัด', align='C', new_x="LMARGIN", new_y="NEXT")
+        self.set_font_size(8)
+        self.cell(0, 6, f'วันที่เอกสาร: {self.po_date_thai} | พิมพ์เมื่อ: {self.print_date}', align='C', new_x="LMARGIN", new_y="NEXT")
+        self.ln(3)
+        if self.is_summary_page: return
+        self.set_fill_color(44, 62, 80)
+        self.set_text_color(255, 255, 255)
+        self.set_draw_color(100, 100, 100)
+        self.set_font('Sarabun', '', 7)
+        for i, h in enumerate(self.HEADERS):
+            self.cell(self.COLS[i], 7, h, border=1, align='C', fill=True)
+        self.ln()
+        self.set_text_color(0, 0, 0)
+        self.set_draw_color(200, 200, 200)
+
+    def footer(self):
+        self.set_y(-10)
+        self.set_font('Sarabun', '', 6)
+        self.set_text_color(150)
+        self.cell(0, 10, f'หน้า {self.page_no()}/{{nb}}', align='R')
+
+def draw_daily_pdf_groups(pdf, grouped_jobs):
+    """วาดตารางรายละเอียดเที่ยวรถ (รายงานประจำวัน A4 แนวนอน)"""
+    cols = DailyReportPDF.COLS
     
     # Detail Table
     for group in grouped_jobs:
@@ -1225,6 +3860,8 @@ def export_pdf():
             pdf.set_draw_color(0, 0, 0)
             pdf.set_line_width(0.2)
 
+def draw_daily_pdf_summary(pdf, sum_day, sum_night, sum_total):
+    """หน้าสรุปท้ายรายงานประจำวัน"""
     # Summary Page Logic
     pdf.is_summary_page = True
     pdf.add_page()
@@ -1276,7 +3913,7 @@ def export_pdf():
         if row_type == 'header': vals = data
         else: 
             vals = [
-                str(data['total']), str(data['t1']), str(data['t2']), str(data['t3']), 
+                str(data['count']), str(data['t1']), str(data['t2']), str(data['t3']), 
                 str(data['t4']), str(data['t5']), str(data['t6']), str(data['t7']), str(data['t8'])
             ]
 
@@ -1295,137 +3932,93 @@ def export_pdf():
     pdf.set_font('Sarabun', '', 9)
     pdf.cell(0, 5, "* ข้อมูลนับจากจำนวนเที่ยวรถที่มีการบันทึกเวลาในแต่ละขั้นตอนจริง", align='L')
 
-    pdf_bytes = pdf.output()
-    filename = f"Summary_{date_filter if date_filter else 'All'}.pdf"
-    return send_file(io.BytesIO(pdf_bytes), mimetype='application/pdf', as_attachment=True, download_name=filename)
-
-@app.route('/export_pdf_summary')
-def export_pdf_summary():
-    # --- Helper function for PDF: thai_date_filter is missing from the provided code, mocking it to prevent crash ---
-    def thai_date_filter(date_str):
-        try:
-            d = datetime.strptime(date_str, "%Y-%m-%d")
-            return f"{d.day} {['ม.ค.','ก.พ.','มี.ค.','เม.ย.','พ.ค.','มิ.ย.','ก.ค.','ส.ค.','ก.ย.','ต.ค.','พ.ย.','ธ.ค.'][d.month-1]} {d.year+543}"
-        except: return date_str
-    # -----------------------------------------------------------------------------------------------------------------
+def render_export_pdf(report, date_filter):
+    """สร้างไฟล์ PDF รายงานประจำวัน (bytes) จากผลของ get_trip_report"""
+    po_date_thai = thai_date_text(date_filter) if date_filter else "ทั้งหมด"
+    print_date = (datetime.now() + timedelta(hours=7)).strftime("%d/%m/%Y %H:%M")
 
-    sheet = get_db()
-    raw_jobs = get_cached_records(sheet, 'Jobs')
-    
-    date_filter = request.args.get('date_filter')
-    if date_filter:
-        jobs = [j for j in raw_jobs if str(j['PO_Date']).strip() == str(date_filter).strip()]
-    else:
-        jobs = raw_jobs
-        
-    def sort_key_func(job):
-        po_date = str(job['PO_Date'])
-        car_no_str = str(job['Car_No']).strip()
-        round_val = str(job['Round'])
-        try: car_no_int = int(car_no_str)
-        except ValueError: car_no_int = 99999 
-        return (po_date, car_no_int, round_val)
+    pdf = DailyReportPDF(po_date_thai, print_date, orientation='L', unit='mm', format='A4')
+    pdf.set_margins(7, 10, 7)
+    pdf.add_page()
+    draw_daily_pdf_groups(pdf, report['groups'])
+    draw_daily_pdf_summary(pdf, report['sum_day'], report['sum_night'], report['sum_total'])
+    return bytes(pdf.output())
 
-    jobs = sorted(jobs, key=sort_key_func)
+def draw_pdf_range_summary(pdf, rows, cols, row_h, font_size, start_x=None):
+    """
+    ตารางสรุปรายงานช่วงวันที่ (ยอดรายวัน + รวมรายเดือน + รวมทั้งหมด) จากแถวของ RangeSummary
+    ขึ้นหน้าใหม่อัตโนมัติและวาดหัวตารางซ้ำ
+    """
+    headers = ['วันที่', 'จำนวน', 'เข้าโรงงาน', 'เริ่มโหลด', 'โหลดเสร็จ', 'ยื่นเอกสาร', 'รับเอกสาร', 'ออกโรงงาน', 'ถึงสาขา', 'จบงาน']
+    if start_x is None: start_x = pdf.l_margin
 
-    def create_counter(): return {'count':0, 't1':0, 't2':0, 't3':0, 't4':0, 't5':0, 't6':0, 't7':0, 't8':0}
-    sum_day = create_counter()
-    sum_night = create_counter()
-    grouped_jobs = []
-    current_group = []
-    prev_key = None
+    def draw_header():
+        pdf.set_x(start_x)
+        pdf.set_fill_color(44, 62, 80)
+        pdf.set_text_color(255, 255, 255)
+        pdf.set_draw_color(44, 62, 80)
+        pdf.set_font('Sarabun', '', font_size)
+        for i, h in enumerate(headers):
+            pdf.cell(cols[i], row_h, h, border=1, align='C', fill=True)
+        pdf.ln()
 
-    for job in jobs:
-        curr_key = (str(job['PO_Date']), str(job['Car_No']), str(job['Round']), str(job['Driver']))
-        if curr_key != prev_key and prev_key is not None:
-            grouped_jobs.append(current_group)
-            current_group = []
-        current_group.append(job)
-        prev_key = curr_key
-        
-        job['is_late'] = False
-        t_plan_str = str(job['Round']).strip()
-        t_act_str = str(job['T2_StartLoad']).strip()
-        if t_plan_str and t_act_str:
-            try:
-                fmt_plan = "%H:%M" if len(t_plan_str) <= 5 else "%H:%M:%S"
-                fmt_act = "%H:%M" if len(t_act_str) <= 5 else "%H:%M:%S"
-                t_plan = datetime.strptime(t_plan_str, fmt_plan)
-                t_act = datetime.strptime(t_act_str, fmt_act)
-                if (t_plan - t_act).total_seconds() > 12 * 3600: t_act += timedelta(days=1)
-                if t_act > t_plan: job['is_late'] = True
-            except: pass
-            
-    if current_group: grouped_jobs.append(current_group)
+    draw_header()
+    for kind, label, data in rows:
+        if pdf.get_y() + row_h > pdf.page_break_trigger:
+            pdf.add_page()
+            draw_header()
+        if kind == 'total': pdf.set_fill_color(255, 255, 0)
+        elif kind == 'month': pdf.set_fill_color(214, 234, 248)
+        elif kind == 'shift': pdf.set_fill_color(242, 243, 244)
+        else: pdf.set_fill_color(255, 255, 255)
+        pdf.set_text_color(0, 0, 0)
+        pdf.set_draw_color(189, 195, 199)
+        pdf.set_font('Sarabun', '', font_size)
+        pdf.set_x(start_x)
+        pdf.cell(cols[0], row_h, label, border=1, align='C', fill=True)
+        vals = [data['count'], data['t1'], data['t2'], data['t3'], data['t4'], data['t5'], data['t6'], data['t7'], data['t8']]
+        for i, v in enumerate(vals):
+            pdf.cell(cols[i+1], row_h, str(v), border=1, align='C', fill=True)
+        pdf.ln()
 
-    for group in grouped_jobs:
-        if not group: continue
-        first_job = group[0]
-        
-        round_time = str(first_job.get('Round', '')).strip()
-        is_day_shift = True
-        try:
-            hour = int(round_time.split(':')[0])
-            if not (6 <= hour <= 18): is_day_shift = False
-        except: pass
+def render_export_pdf_range(range_report, range_key):
+    """PDF รายงานประจำวันแบบช่วงวันที่: 1 ส่วนต่อวัน + ตารางสรุปรายวัน/รายเดือนท้ายเอกสาร"""
+    print_date = (datetime.now() + timedelta(hours=7)).strftime("%d/%m/%Y %H:%M")
+    pdf = DailyReportPDF(range_label(range_report), print_date, orientation='L', unit='mm', format='A4')
+    pdf.set_margins(7, 10, 7)
 
-        target = sum_day if is_day_shift else sum_night
-        target['count'] += 1 
-        if first_job.get('T1_Enter'): target['t1'] += 1
-        if first_job.get('T2_StartLoad'): target['t2'] += 1
-        if first_job.get('T3_EndLoad'): target['t3'] += 1
-        if first_job.get('T4_SubmitDoc'): target['t4'] += 1
-        if first_job.get('T5_RecvDoc'): target['t5'] += 1
-        if first_job.get('T6_Exit'): target['t6'] += 1
-        
-        if any(str(j.get('T7_ArriveBranch', '')).strip() != '' for j in group): target['t7'] += 1 
-        if all(str(j.get('T8_EndJob', '')).strip() != '' for j in group): target['t8'] += 1       
+    summary_rows = []
+    summary = RangeSummary()
+    for date_key, report in iter_range_reports(range_report):
+        pdf.po_date_thai = thai_date_text(date_key)
+        pdf.add_page()
+        draw_daily_pdf_groups(pdf, report['groups'])
+        summary_rows += summary.add(date_key, report)
+    summary_rows += summary.finish()
 
-    sum_total = create_counter()
-    for k in sum_total: sum_total[k] = sum_day[k] + sum_night[k]
+    pdf.po_date_thai = range_label(range_report)
+    pdf.is_summary_page = True
+    pdf.add_page()
+    cols = [40, 25, 25, 25, 25, 25, 25, 25, 30, 30]
+    draw_pdf_range_summary(pdf, summary_rows, cols, 8, 10, start_x=(297 - sum(cols)) / 2)
+    return bytes(pdf.output())
 
-    basedir = os.path.abspath(os.path.dirname(__file__))
-    font_path = os.path.join(basedir, 'static', 'fonts', 'Sarabun-Regular.ttf')
-    logo_path = os.path.join(basedir, 'static', 'mylogo.png') 
-    po_date_thai = thai_date_filter(date_filter) if date_filter else "ทั้งหมด"
-    print_date = (datetime.now() + timedelta(hours=7)).strftime("%d/%m/%Y %H:%M")
+@app.route('/export_pdf')
+def export_pdf():
+    range_response = send_range_export('pdf', render_export_pdf_range, 'Summary', 'pdf', mimetype='application/pdf')
+    if range_response is not None: return range_response
 
-    COLS = [10, 18, 27, 13, 50, 13, 13, 13, 13, 13, 13]
-    HEADERS = ['คันที่', 'ทะเบียน', 'คนขับ', 'เวลาโหลด', 'ปลายทาง', 'เข้าโรงงาน', 'เริ่มโหลด', 'โหลดเสร็จ', 'ออกโรงงาน', 'ถึงสาขา', 'จบงาน']
+    sheet = get_db()
+    date_filter = request.args.get('date_filter')
+    report = get_trip_report(sheet, date_filter)
+    if is_async_export_request():
+        return submit_export_job('pdf', date_filter, report)
+    filename = f"Summary_{date_filter if date_filter else 'All'}.pdf"
+    return send_report_artifact('pdf', date_filter, report, render_export_pdf, filename, mimetype='application/pdf')
 
-    class PDFSummary(FPDF):
-        def header(self):
-            self.add_font('Sarabun', '', font_path, uni=True)
-            if os.path.exists(logo_path):
-                self.image(logo_path, x=7, y=6, w=10)
-            self.set_font('Sarabun', '', 12) 
-            self.set_y(6)
-            self.cell(0, 8, 'สรุปรายงานการจัดส่งสินค้า (Compact View)', align='C', new_x="LMARGIN", new_y="NEXT")
-            self.set_font_size(10)
-            self.cell(0, 7, 'บริษัท แอลเอ็มที. ทรานสปอร์ต จำกัด', align='C', new_x="LMARGIN", new_y="NEXT")
-            self.set_font_size(8)
-            self.cell(0, 6, f'วันที่เอกสาร: {po_date_thai} | พิมพ์เมื่อ: {print_date}', align='C', new_x="LMARGIN", new_y="NEXT")
-            self.ln(3)
-            self.set_fill_color(44, 62, 80)
-            self.set_text_color(255, 255, 255)
-            self.set_draw_color(100, 100, 100)
-            self.set_font('Sarabun', '', 7)
-            for i, h in enumerate(HEADERS):
-                self.cell(COLS[i], 7, h, border=1, align='C', fill=True)
-            self.ln()
-            self.set_text_color(0, 0, 0)
-            self.set_draw_color(200, 200, 200)
-
-        def footer(self):
-            self.set_y(-10)
-            self.set_font('Sarabun', '', 6)
-            self.set_text_color(150)
-            self.cell(0, 10, f'หน้า {self.page_no()}/{{nb}}', align='R')
-
-    pdf = PDFSummary(orientation='P', unit='mm', format='A4')
-    pdf.alias_nb_pages()
-    pdf.set_margins(7, 7, 7)
-    pdf.add_page()
+def draw_compact_pdf_groups(pdf, grouped_jobs):
+    """วาดตารางเที่ยวรถแบบย่อ (A4 แนวตั้ง)"""
+    COLS = CompactReportPDF.COLS
     
     group_count = 0
     for group in grouped_jobs:
@@ -1506,6 +4099,8 @@ def export_pdf_summary():
                 pdf.set_line_width(0.2)
                 pdf.set_draw_color(180, 180, 180)
 
+def draw_compact_pdf_summary(pdf, sum_day, sum_night, sum_total):
+    """ตารางสรุปกลางวัน/กลางคืนท้ายรายงานแบบย่อ"""
     pdf.ln(5)
     if pdf.get_y() + 30 > pdf.page_break_trigger:
         pdf.add_page()
@@ -1535,21 +4130,234 @@ def export_pdf_summary():
     draw_sum_row('กลางคืน', sum_night)
     draw_sum_row('รวม', sum_total, is_total=True)
 
-    pdf_bytes = pdf.output()
+def render_export_pdf_summary(report, date_filter):
+    """สร้างไฟล์ PDF แบบย่อ (Compact View) จากผลของ get_trip_report"""
+    po_date_thai = thai_date_text(date_filter) if date_filter else "ทั้งหมด"
+    print_date = (datetime.now() + timedelta(hours=7)).strftime("%d/%m/%Y %H:%M")
+
+    pdf = CompactReportPDF(po_date_thai, print_date, orientation='P', unit='mm', format='A4')
+    pdf.set_margins(7, 7, 7)
+    pdf.add_page()
+    draw_compact_pdf_groups(pdf, report['groups'])
+    draw_compact_pdf_summary(pdf, report['sum_day'], report['sum_night'], report['sum_total'])
+    return bytes(pdf.output())
+
+def render_export_pdf_summary_range(range_report, range_key):
+    """PDF แบบย่อช่วงวันที่: ขึ้นหน้าใหม่ทุกวัน + ตารางสรุปรายวัน/รายเดือนท้ายเอกสาร"""
+    print_date = (datetime.now() + timedelta(hours=7)).strftime("%d/%m/%Y %H:%M")
+    pdf = CompactReportPDF(range_label(range_report), print_date, orientation='P', unit='mm', format='A4')
+    pdf.set_margins(7, 7, 7)
+
+    summary_rows = []
+    summary = RangeSummary()
+    for date_key, report in iter_range_reports(range_report):
+        pdf.po_date_thai = thai_date_text(date_key)
+        pdf.add_page()
+        draw_compact_pdf_groups(pdf, report['groups'])
+        summary_rows += summary.add(date_key, report)
+    summary_rows += summary.finish()
+
+    pdf.po_date_thai = range_label(range_report)
+    pdf.is_summary_page = True
+    pdf.add_page()
+    draw_pdf_range_summary(pdf, summary_rows, [24, 16, 19, 19, 19, 19, 19, 19, 21, 21], 6, 7)
+    return bytes(pdf.output())
+
+@app.route('/export_pdf_summary')
+def export_pdf_summary():
+    range_response = send_range_export('pdf_summary', render_export_pdf_summary_range, 'Summary', 'pdf', mimetype='application/pdf')
+    if range_response is not None: return range_response
+
+    sheet = get_db()
+    date_filter = request.args.get('date_filter')
+    report = get_trip_report(sheet, date_filter)
+    if is_async_export_request():
+        return submit_export_job('pdf_summary', date_filter, report)
     filename = f"Summary_{date_filter if date_filter else 'All'}.pdf"
-    return send_file(io.BytesIO(pdf_bytes), mimetype='application/pdf', as_attachment=True, download_name=filename)
-    
+    return send_report_artifact('pdf_summary', date_filter, report, render_export_pdf_summary, filename, mimetype='application/pdf')
+
+
+# ==========================================
+# [Export Jobs] คิวสร้างรายงานเบื้องหลัง (Process Pool / Thread สำรองบน Vercel)
+# ==========================================
+# เรียก Export เดิมพร้อม ?async=1 -> ได้ job_id กลับไปทันที (202)
+# แล้ว Poll ที่ /export_jobs/<job_id> จนสถานะเป็น done จึงดาวน์โหลดที่ /export_jobs/<job_id>/download
+# บน Vercel ปุ่ม Export ในหน้าผู้จัดการดาวน์โหลดตรง (Function อาจถูกหยุดหลังตอบกลับ และไฟล์งานอยู่ใน /tmp ของแต่ละ Instance)
+# ตั้ง EXPORT_ASYNC=1/0 เพื่อบังคับเปิด/ปิด / หน้าเว็บกลับไปดาวน์โหลดตรงเองถ้าคิวเบื้องหลังใช้ไม่ได้
+EXPORT_ASYNC = os.environ.get('EXPORT_ASYNC', '0' if os.environ.get('VERCEL') else '1') == '1'
+EXPORT_MAX_PENDING = int(os.environ.get('EXPORT_MAX_PENDING', '8'))   # งานที่รอคิวได้สูงสุด
+EXPORT_JOB_TTL = 60 * 60
+EXPORT_JOB_DIR = os.path.join(tempfile.gettempdir(), 'lmt_export_jobs')
+EXPORT_FORMATS = {
+    # fmt: (render วันเดียว, render ช่วงวันที่, ชื่อไฟล์, นามสกุล, mimetype)
+    'xlsx': (render_export_excel, render_export_excel_range, 'Report', 'xlsx',
+             'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    'pdf': (render_export_pdf, render_export_pdf_range, 'Summary', 'pdf', 'application/pdf'),
+    'pdf_summary': (render_export_pdf_summary, render_export_pdf_summary_range, 'Summary', 'pdf', 'application/pdf'),
+}
+export_jobs = {}  # job_id -> job (ของ Process นี้ ส่วน Worker อื่นอ่านจากไฟล์ .json)
+export_jobs_lock = threading.Lock()  # ครอบทั้ง export_jobs และการแก้ dict ของแต่ละงาน (Callback ของ Pool แก้จากอีก Thread)
+export_executor = None
+
+def get_export_executor():
+    """
+    สร้าง Pool ครั้งแรกที่ใช้งาน: Process Pool เพื่อไม่ให้การสร้างไฟล์แย่ง CPU/GIL ของ Web Worker
+    บน Vercel (หรือระบบที่ไม่มี SemLock) ใช้ Thread แทน
+    """
+    global export_executor
+    if export_executor is None:
+        use_thread = os.environ.get('VERCEL') or os.environ.get('EXPORT_EXECUTOR') == 'thread'
+        if not use_thread:
+            try: export_executor = ProcessPoolExecutor(max_workers=EXPORT_MAX_WORKERS)
+            except (OSError, ImportError, NotImplementedError) as e:
+                print(f"Export Pool Fallback to Thread: {e}")
+        if export_executor is None:
+            export_executor = ThreadPoolExecutor(max_workers=EXPORT_MAX_WORKERS, thread_name_prefix='export')
+    return export_executor
+
+def run_export_job(fmt, date_key, report):
+    """ทำงานใน Worker Process: สร้างไฟล์จากรายงานที่เตรียมไว้แล้ว (ไม่แตะ Google Sheet)"""
+    render_single, render_range = EXPORT_FORMATS[fmt][:2]
+    render_func = render_range if 'start' in report else render_single
+    return render_func(report, date_key or None)
+
+def export_job_path(job_id, suffix):
+    return os.path.join(EXPORT_JOB_DIR, f"{job_id}.{suffix}")
+
+def export_job_snapshot(job):
+    """สำเนาสถานะงาน ณ ตอนนี้ (ห้ามเรียกขณะถือ export_jobs_lock)"""
+    with export_jobs_lock: return dict(job)
+
+def save_export_job(job):
+    """เขียนสถานะงานลงไฟล์ เพื่อให้ Worker อื่นของ gunicorn ตอบ Poll/Download ได้"""
+    try:
+        os.makedirs(EXPORT_JOB_DIR, exist_ok=True)
+        public = {k: v for k, v in export_job_snapshot(job).items() if k != 'future'}
+        tmp_path = export_job_path(job['id'], 'json.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(public, f)
+        os.replace(tmp_path, export_job_path(job['id'], 'json'))
+    except Exception as e:
+        print(f"Export Job Save Error: {e}")
+
+def load_export_job(job_id):
+    with export_jobs_lock:
+        job = export_jobs.get(job_id)
+        if job is not None: return dict(job)
+    if not all(c in '0123456789abcdef' for c in job_id): return None
+    try:
+        with open(export_job_path(job_id, 'json'), encoding='utf-8') as f: return json.load(f)
+    except: return None
+
+def purge_export_jobs():
+    """ลบงาน/ไฟล์ที่เก่ากว่า EXPORT_JOB_TTL"""
+    cutoff = time.time() - EXPORT_JOB_TTL
+    with export_jobs_lock:
+        for job_id in [k for k, j in export_jobs.items() if j['finished_at'] and j['finished_at'] < cutoff]:
+            del export_jobs[job_id]
+    try:
+        for name in os.listdir(EXPORT_JOB_DIR):
+            path = os.path.join(EXPORT_JOB_DIR, name)
+            if os.path.getmtime(path) < cutoff: os.remove(path)
+    except: pass
+
+def finish_export_job(job, future):
+    """Callback เมื่อ Worker ทำงานเสร็จ: เก็บไฟล์ลง Export Cache + Disk แล้วอัปเดตสถานะ"""
+    try:
+        data = future.result()
+        put_artifact(job['artifact_key'], data, closed=job['closed'])
+        with open(export_job_path(job['id'], job['extension']), 'wb') as f: f.write(data)
+        result = {'status': 'done', 'size': len(data)}
+    except Exception as e:
+        print(f"Export Job Error ({job['id']}): {e}")
+        result = {'status': 'error', 'message': str(e)}
+    with export_jobs_lock:
+        job.update(result, finished_at=time.time())
+        job.pop('future', None)
+    save_export_job(job)
+
+def is_async_export_request():
+    return request.args.get('async') in ('1', 'true')
+
+def submit_export_job(fmt, date_filter, report):
+    """รับงาน Export เข้าคิว คืนค่า 202 + job_id (ถ้ามีไฟล์ใน Cache หรือมีงานเดียวกันอยู่แล้ว ใช้ของเดิม)"""
+    purge_export_jobs()
+    date_key = str(date_filter).strip() if date_filter else ''
+    artifact_key = (fmt, date_key, report['fingerprint'])
+    _, _, prefix, extension, mimetype = EXPORT_FORMATS[fmt]
+    label = date_key.replace('_', '_to_') if date_key else 'All'
+
+    with export_jobs_lock:
+        for job in export_jobs.values():
+            if job['artifact_key'] == artifact_key and job['status'] in ('queued', 'running', 'done'):
+                return export_job_response(job, 202)
+
+        active = sum(1 for j in export_jobs.values() if j['status'] in ('queued', 'running'))
+        if active >= EXPORT_MAX_WORKERS + EXPORT_MAX_PENDING:
+            return json.dumps({'status': 'busy', 'message': 'คิวสร้างรายงานเต็ม กรุณาลองใหม่ภายหลัง'}), 429
+
+        job = {
+            'id': uuid.uuid4().hex, 'format': fmt, 'date': date_key, 'status': 'queued',
+            'artifact_key': artifact_key, 'closed': is_report_closed(report, date_key),
+            'download_name': f"{prefix}_{label}.{extension}", 'extension': extension, 'mimetype': mimetype,
+            'created_at': time.time(), 'finished_at': None, 'size': None, 'message': ''
+        }
+        export_jobs[job['id']] = job
+
+    cached = get_artifact(artifact_key)
+    if cached is not None:
+        os.makedirs(EXPORT_JOB_DIR, exist_ok=True)
+        with open(export_job_path(job['id'], extension), 'wb') as f: f.write(cached['data'])
+        with export_jobs_lock: job.update(status='done', size=cached['size'], finished_at=time.time())
+        save_export_job(job)
+        return export_job_response(export_job_snapshot(job), 202)
+
+    save_export_job(job)
+    future = get_export_executor().submit(run_export_job, fmt, date_key, report)
+    with export_jobs_lock: job['future'] = future
+    # Callback อาจทำงานทันทีใน Thread นี้ (งานเสร็จแล้ว) -> ต้องไม่ถือ Lock ตอนเรียก
+    future.add_done_callback(lambda f: finish_export_job(job, f))
+    return export_job_response(export_job_snapshot(job), 202)
+
+def export_job_response(job, code=200):
+    status = job['status']
+    future = job.get('future')
+    if status == 'queued' and future is not None and future.running(): status = 'running'
+    payload = {
+        'status': status, 'job_id': job['id'], 'format': job['format'], 'date': job['date'],
+        'size': job['size'], 'message': job['message'],
+        'status_url': url_for('export_job_status', job_id=job['id']),
+        'download_url': url_for('export_job_download', job_id=job['id']) if status == 'done' else None
+    }
+    return json.dumps(payload), code, {'Content-Type': 'application/json'}
+
+@app.route('/export_jobs/<job_id>')
+def export_job_status(job_id):
+    job = load_export_job(job_id)
+    if job is None: return json.dumps({'status': 'error', 'message': 'ไม่พบงาน Export'}), 404
+    return export_job_response(job)
+
+@app.route('/export_jobs/<job_id>/download')
+def export_job_download(job_id):
+    job = load_export_job(job_id)
+    if job is None or job['status'] != 'done':
+        return json.dumps({'status': 'error', 'message': 'ไฟล์ยังไม่พร้อม'}), 404
+    path = export_job_path(job['id'], job['extension'])
+    if not os.path.exists(path):
+        return json.dumps({'status': 'error', 'message': 'ไฟล์หมดอายุแล้ว กรุณาสร้างใหม่'}), 410
+    return send_file(path, mimetype=job['mimetype'], as_attachment=True, download_name=job['download_name'], max_age=0)
+
 @app.route('/tracking')
 def customer_view():
     sheet = get_db()
     raw_jobs = get_cached_records(sheet, 'Jobs')
-    all_dates = sorted(list(set([str(j['PO_Date']).strip() for j in raw_jobs])), reverse=True)
+    all_dates = analytics_po_dates(sheet)
     
     date_filter = request.args.get('date_filter')
     now_thai = datetime.now() + timedelta(hours=7)
     if not date_filter: date_filter = now_thai.strftime("%Y-%m-%d")
 
-    jobs = [j for j in raw_jobs if str(j['PO_Date']).strip() == str(date_filter).strip()]
+    jobs = [j for j in raw_jobs if str(j['PO_Date']).strip() == str(date_filter).strip()] or archived_jobs(str(date_filter).strip())
+    jobs = [dict(j) for j in jobs]  # ไม่แก้ Dict ใน Cache (เติม is_start_late / delay_msg ด้านล่าง)
     
     try:
         current_date_obj = datetime.strptime(date_filter, "%Y-%m-%d")
@@ -1620,6 +4428,89 @@ def customer_view():
                            total_running_jobs=total_running_jobs,
                            prev_date=prev_date, next_date=next_date)
 
+# ==========================================
+# [Driver Board] สรุปงานค้างรายคนขับ (คำนวณใหม่เฉพาะคนขับที่งานเปลี่ยน)
+# ==========================================
+# ส่วนที่ขึ้นกับเวลาปัจจุบัน (ป้ายเร่งด่วน / Active-Hidden) เท่านั้นที่คำนวณตอน Request
+driver_board = {'version': None, 'rows': {}, 'entries': {}}
+
+def build_driver_board_entry(rows):
+    """
+    rows: งานค้าง (ยังไม่ Done/Cancel) ของคนขับ 1 คน เรียงตามลำดับแถวใน Sheet
+    คืนค่า จำนวนเที่ยวค้าง, เที่ยวแรกสุด (dt, ลำดับรถ) และเวลาโหลดตามแผนทั้งหมด (เรียงตามเวลา)
+    """
+    pending_set = set()
+    earliest = (datetime.max, 99999)
+    planned = []  # [(job_dt, ลำดับแถว)]
+    for order, (po_date, load_date, round_str, car_no) in enumerate(rows):
+        pending_set.add(f"{po_date}_{round_str}_{car_no}")
+        try:
+            load_date_val = str(load_date).strip()
+            if not load_date_val: load_date_val = str(po_date).strip()
+            job_dt = datetime.strptime(f"{load_date_val} {str(round_str).strip()}", "%Y-%m-%d %H:%M")
+        except: continue
+
+        try: car_n = int(str(car_no).strip())
+        except: car_n = 99999
+        if job_dt < earliest[0]: earliest = (job_dt, car_n)
+        planned.append((job_dt, order))
+
+    planned.sort()
+    return {'pending_count': len(pending_set), 'earliest': earliest,
+            'planned_dt': [p[0] for p in planned], 'planned': planned}
+
+def refresh_driver_board(sheet):
+    """จัดกลุ่มงานค้างตามคนขับ แล้วสร้าง Entry ใหม่เฉพาะคนขับที่รายการงานเปลี่ยนจากรอบก่อน"""
+    all_jobs = get_cached_records(sheet, 'Jobs')
+    version = get_data_version('Jobs')
+    if driver_board['version'] == version: return driver_board['entries']
+
+    rows_by_driver = {}
+    for job in all_jobs:
+        status = str(job.get('Status', '')).lower()
+        if status == 'done' or status == 'cancel': continue
+        rows_by_driver.setdefault(job.get('Driver'), []).append(
+            (job['PO_Date'], job.get('Load_Date', ''), job.get('Round', ''), job.get('Car_No', '')))
+
+    old_rows, old_entries = driver_board['rows'], driver_board['entries']
+    entries = {}
+    for name, rows in rows_by_driver.items():
+        if old_rows.get(name) == rows: entries[name] = old_entries[name]
+        else: entries[name] = build_driver_board_entry(rows)
+
+    driver_board.update(version=version, rows=rows_by_driver, entries=entries)
+    return entries
+
+def driver_urgency(job_dt, now_thai):
+    """ป้ายความเร่งด่วนของเที่ยวตามเวลาปัจจุบัน คืนค่า (ข้อความ, สี, น้ำหนักการเรียง)"""
+    hours_diff = (job_dt - now_thai).total_seconds() / 3600
+    delta_days = (job_dt.date() - now_thai.date()).days
+    h = job_dt.hour
+    if hours_diff <= 0:
+        if hours_diff > -12: return "❗ โหลดตอนนี้", "bg-red-500 text-white border-red-600 animate-pulse", 1
+    elif 0 < hours_diff <= 16:
+        if 6 <= h <= 12: return "☀️ โหลดเช้านี้", "bg-yellow-100 text-yellow-700", 2
+        elif 13 <= h <= 18: return "⛅ โหลดบ่ายนี้", "bg-orange-100 text-orange-700", 2
+        else: return "🌙 โหลดคืนนี้", "bg-indigo-100 text-indigo-700", 2
+    elif delta_days == 1:
+        return "⏩ เตรียมพรุ่งนี้", "bg-gray-100 text-gray-500", 3
+    return "", "", 999
+
+def pick_driver_urgency(entry, now_thai):
+    """
+    เลือกเที่ยวที่เร่งด่วนที่สุดของคนขับ (น้ำหนักเท่ากันใช้แถวที่อยู่ก่อนใน Sheet)
+    ดูเฉพาะเที่ยวในช่วง 12 ชม. ที่แล้ว ถึงสิ้นวันพรุ่งนี้ ส่วนเที่ยวอื่นไม่มีป้าย
+    """
+    best = None  # (weight, order, msg, color, job_dt)
+    lo = bisect.bisect_right(entry['planned_dt'], now_thai - timedelta(hours=12))
+    window_end = datetime.combine(now_thai.date() + timedelta(days=2), datetime.min.time())
+    for job_dt, order in entry['planned'][lo:]:
+        if job_dt >= window_end: break
+        msg, color, weight = driver_urgency(job_dt, now_thai)
+        if weight < 999 and (best is None or (weight, order) < best[:2]):
+            best = (weight, order, msg, color, job_dt)
+    return best
+
 @app.route('/driver')
 def driver_select():
     # [FIXED] Use Cached Data instead of API Call
@@ -1628,70 +4519,29 @@ def driver_select():
     # Extract names from cached list (assuming 'Name' is the key)
     drivers_list_raw = [d['Name'] for d in cached_drivers if d.get('Name')]
     
-    all_jobs = get_cached_records(sheet, 'Jobs')
+    board = refresh_driver_board(sheet)
     now_thai = datetime.now() + timedelta(hours=7)
     limit_time = now_thai + timedelta(hours=48)
+    empty_entry = {'pending_count': 0, 'earliest': (datetime.max, 99999), 'planned_dt': [], 'planned': []}
     
     driver_info = {} 
     driver_sort_data = {}
 
     for name in drivers_list_raw:
+        entry = board.get(name, empty_entry)
         driver_info[name] = {
-            'pending_set': set(), 
-            'pending_count': 0, 
+            'pending_count': entry['pending_count'], 
             'urgent_msg': '', 'urgent_color': '', 'urgent_time': '', 'sort_weight': 999
         }
-        driver_sort_data[name] = {'dt': datetime.max, 'car': 99999}
+        driver_sort_data[name] = {'dt': entry['earliest'][0], 'car': entry['earliest'][1]}
 
-    for job in all_jobs:
-        d_name = job.get('Driver')
-        if d_name not in driver_info: continue
-        status = str(job.get('Status', '')).lower()
-        if status != 'done' and status != 'cancel':
-            trip_key = f"{job['PO_Date']}_{job['Round']}_{job['Car_No']}"
-            driver_info[d_name]['pending_set'].add(trip_key)
-            try:
-                load_date_val = str(job.get('Load_Date', '')).strip()
-                if not load_date_val: load_date_val = str(job['PO_Date']).strip()
-                round_str = str(job['Round']).strip()
-                job_dt_str = f"{load_date_val} {round_str}"
-                try: job_dt = datetime.strptime(job_dt_str, "%Y-%m-%d %H:%M")
-                except: continue
-                
-                try: car_n = int(str(job['Car_No']).strip())
-                except: car_n = 99999
-
-                if job_dt < driver_sort_data[d_name]['dt']:
-                    driver_sort_data[d_name]['dt'] = job_dt
-                    driver_sort_data[d_name]['car'] = car_n
-
-                diff = job_dt - now_thai
-                hours_diff = diff.total_seconds() / 3600
-                delta_days = (job_dt.date() - now_thai.date()).days
-                h = job_dt.hour
-                m = job_dt.minute
-                msg, color, weight = "", "", 999
-                
-                if hours_diff <= 0:
-                    if hours_diff > -12: msg, color, weight = "❗ โหลดตอนนี้", "bg-red-500 text-white border-red-600 animate-pulse", 1
-                elif 0 < hours_diff <= 16:
-                    if 6 <= h <= 12: msg, color = "☀️ โหลดเช้านี้", "bg-yellow-100 text-yellow-700"
-                    elif 13 <= h <= 18: msg, color = "⛅ โหลดบ่ายนี้", "bg-orange-100 text-orange-700"
-                    else: msg, color = "🌙 โหลดคืนนี้", "bg-indigo-100 text-indigo-700"
-                    weight = 2
-                elif delta_days == 1:
-                    if driver_info[d_name]['sort_weight'] > 3:
-                        msg, color, weight = "⏩ เตรียมพรุ่งนี้", "bg-gray-100 text-gray-500", 3
-
-                if weight < driver_info[d_name]['sort_weight']:
-                    driver_info[d_name]['urgent_msg'] = msg
-                    driver_info[d_name]['urgent_color'] = color
-                    driver_info[d_name]['urgent_time'] = f"{h:02}:{m:02} น."
-                    driver_info[d_name]['sort_weight'] = weight
-            except: pass
-    
-    for name in drivers_list_raw:
-        driver_info[name]['pending_count'] = len(driver_info[name]['pending_set'])
+        best = pick_driver_urgency(entry, now_thai)
+        if best:
+            weight, _, msg, color, job_dt = best
+            driver_info[name]['urgent_msg'] = msg
+            driver_info[name]['urgent_color'] = color
+            driver_info[name]['urgent_time'] = f"{job_dt.hour:02}:{job_dt.minute:02} น."
+            driver_info[name]['sort_weight'] = weight
 
     active_drivers = []
     hidden_drivers = []
@@ -1706,162 +4556,246 @@ def driver_select():
 
     return render_template('driver_select.html', active_drivers=active_drivers, hidden_drivers=hidden_drivers, driver_info=driver_info)
 
+# ==========================================
+# [Driver Tasks] รายการงานของคนขับแบบเตรียมไว้ล่วงหน้า (Materialized View ต่อคนขับ)
+# ==========================================
+# สร้างใหม่เฉพาะเมื่อแถวงานของคนขับคนนั้นเปลี่ยน ตอน Request คำนวณแค่ป้ายเวลา (smart_title) ที่ขึ้นกับเวลาปัจจุบัน
+jobs_driver_index = {'version': None, 'index': {}}  # Driver -> [(row_id, job)]
+driver_task_views = {}  # Driver -> {'rows', 'jobs', 'trips'}
+
+def get_jobs_driver_index(sheet):
+    raw_data = get_cached_records(sheet, 'Jobs')
+    version = get_data_version('Jobs')
+    if jobs_driver_index['version'] != version:
+        index = {}
+        for idx, job in enumerate(raw_data):
+            index.setdefault(job['Driver'], []).append((idx + 2, job))  # row_id = เลขแถวใน Sheet ใช้ Update
+        jobs_driver_index.update(version=version, index=index)
+    return jobs_driver_index['index']
+
+def prepare_driver_task(job, row_id, po_index):
+    """ข้อมูลส่วนที่ไม่ขึ้นกับเวลาปัจจุบัน: PO ที่แปลงแล้ว, เวลาโหลดตามแผน, วันที่ภาษาไทย, ป้าย PO"""
+    job_copy = job.copy()
+    job_copy['row_id'] = row_id
+    job_copy['po_job_key'] = po_job_key(job)
+    job_copy['po_version'] = po_detail_version(po_index, job_copy['po_job_key'])
+    job_copy['parsed_po_details'] = job_po_details(job, po_index)
+
+    task = {'job': job_copy, 'job_dt': None, 'round_str': '', 'real_date_str': '', 'po_label': None}
+    try:
+        load_date_str = job.get('Load_Date', job['PO_Date'])
+        round_str = str(job['Round']).strip()
+        job_dt_str = f"{load_date_str} {round_str}"
+        
+        try: job_dt = datetime.strptime(job_dt_str, "%Y-%m-%d %H:%M")
+        except: job_dt = datetime.strptime(f"{job['PO_Date']} {round_str}", "%Y-%m-%d %H:%M")
+
+        th_year = job_dt.year + 543
+        task.update(job_dt=job_dt, round_str=round_str, real_date_str=f"{job_dt.day}/{job_dt.month}/{str(th_year)[2:]}")
+
+        # PO Label
+        po_d = datetime.strptime(job['PO_Date'], "%Y-%m-%d")
+        po_th = f"{po_d.day}/{po_d.month}/{str(po_d.year+543)[2:]}"
+        task['po_label'] = f"(เอกสาร PO วันที่ {po_th})"
+    except Exception: 
+        pass
+    return task
+
+def build_driver_task_view(rows, po_index):
+    """จัดกลุ่มงานเป็น Trip (1 Trip มีหลายสาขาได้) และเรียงลำดับงานไว้ล่วงหน้า"""
+    trips = {}
+    for row_id, job in rows:
+        trip_key = (str(job['PO_Date']), str(job['Round']), str(job['Car_No']))
+        trips.setdefault(trip_key, []).append(prepare_driver_task(job, row_id, po_index))
+
+    trip_info = {}
+    ordered = []
+    for key, task_list in trips.items():
+        first = task_list[0]['job']
+        trip_date = None  # None = แปลงวันที่ไม่ได้ ให้โชว์เสมอ
+        try: trip_date = datetime.strptime(first.get('Load_Date', first['PO_Date']), "%Y-%m-%d").date()
+        except: pass
+        trip_info[key] = {'fully_done': all(t['job']['Status'] == 'Done' for t in task_list), 'date': trip_date}
+        ordered.extend((key, t) for t in task_list)
+
+    # เรียงลำดับงาน (sort แบบ stable: กรองทีหลังได้ผลเหมือนกรองก่อนเรียง)
+    def sort_key_func(item):
+        job = item[1]['job']
+        return (str(job['PO_Date']), str(job.get('Load_Date', '')), str(job['Round']))
+    ordered.sort(key=sort_key_func)
+    return {'rows': rows, 'tasks': ordered, 'trips': trip_info}
+
+def get_driver_task_view(sheet, driver_name):
+    rows = get_jobs_driver_index(sheet).get(driver_name, [])
+    po_index = get_po_detail_index(sheet)
+    po_version = get_data_version('PODetails')
+    view = driver_task_views.get(driver_name)
+    if view is None or view['rows'] != rows or view['po_version'] != po_version:
+        view = build_driver_task_view(rows, po_index)
+        view['po_version'] = po_version
+        driver_task_views[driver_name] = view
+    return view
+
+def decorate_driver_task(task, now_thai):
+    """Smart Title & UI Decoration (คำนวณสีและสถานะตามเวลาปัจจุบัน)"""
+    job = dict(task['job'])
+    job_dt = task['job_dt']
+    if job_dt is None: return job
+
+    round_str = task['round_str']
+    real_date_str = task['real_date_str']
+    diff = job_dt - now_thai
+    hours_diff = diff.total_seconds() / 3600
+    delta_days = (job_dt.date() - now_thai.date()).days
+    h = job_dt.hour
+
+    # ค่า Default
+    job['smart_title'] = f"เวลา {round_str}"
+    job['smart_detail'] = f"วันที่ {real_date_str}"
+    job['ui_class'] = {'bg': 'bg-gray-50', 'text': 'text-gray-500', 'icon': 'fa-clock'}
+
+    # 1. งานเร่งด่วน/ค้างส่ง (น้อยกว่า 0 ชม.)
+    if hours_diff <= 0:
+        if hours_diff > -12:
+            job['smart_title'] = f"❗ เข้าโหลดงานตอนนี้"
+            job['ui_class'] = {'bg': 'bg-red-50 border-red-100 ring-2 ring-red-200 animate-pulse', 'text': 'text-red-600', 'icon': 'fa-truck-ramp-box'}
+        else:
+            job['smart_title'] = f"🔥 งานค้างส่ง"
+            job['ui_class'] = {'bg': 'bg-red-50 border-red-100', 'text': 'text-red-500', 'icon': 'fa-triangle-exclamation'}
+        job['smart_detail'] = f"กำหนด: {round_str} น. ({real_date_str})"
+    
+    # 2. งานภายใน 16 ชม. (โหลดวันนี้/คืนนี้)
+    elif 0 < hours_diff <= 16:
+        if 6 <= h <= 12:    p, i, t = "เช้านี้", "fa-sun", "yellow"
+        elif 13 <= h <= 18: p, i, t = "บ่ายนี้", "fa-cloud-sun", "orange"
+        else:               p, i, t = "คืนนี้", "fa-moon", "indigo"
+        job['smart_title'] = f"โหลดสินค้า{p}"
+        job['smart_detail'] = f"เวลา {round_str} น. ของวันที่ {real_date_str}"
+        job['ui_class'] = {'bg': f'bg-{t}-50 border-{t}-100 ring-1 ring-{t}-50', 'text': f'text-{t}-600', 'icon': i}
+    
+    # 3. งานวันพรุ่งนี้
+    elif delta_days == 1:
+        period = "คืนพรุ่งนี้" if (h >= 19 or h <= 5) else "วันพรุ่งนี้"
+        job['smart_title'] = f"⏩ เตรียมโหลด{period}"
+        job['smart_detail'] = f"เวลา {round_str} น. ของวันที่ {real_date_str}"
+        job['ui_class'] = {'bg': 'bg-blue-50 border-blue-100', 'text': 'text-blue-600', 'icon': 'fa-calendar-day'}
+    
+    # 4. งานล่วงหน้า
+    else:
+        job['smart_title'] = f"📅 งานล่วงหน้า"
+        job['smart_detail'] = f"วันที่ {real_date_str} เวลา {round_str} น."
+        job['ui_class'] = {'bg': 'bg-gray-50 border-gray-100', 'text': 'text-gray-500', 'icon': 'fa-calendar-days'}
+
+    if task['po_label']: job['po_label'] = task['po_label']
+    return job
+
 @app.route('/driver/tasks', methods=['GET'])
 def driver_tasks():
     driver_name = request.args.get('name')
     if not driver_name: return redirect(url_for('driver_select'))
         
     sheet = get_db()
-    # ดึงข้อมูลทั้งหมด (ต้องมั่นใจว่าใน Sheet มี Header: PO_Nos, Doc_Result, Weight_Result แล้ว)
-    raw_data = get_cached_records(sheet, 'Jobs')
-    
-    driver_jobs_with_id = []
-    for idx, job in enumerate(raw_data):
-        if job['Driver'] == driver_name:
-            job_copy = job.copy()
-            job_copy['row_id'] = idx + 2 # เก็บเลขแถวเพื่อใช้ Update
-            driver_jobs_with_id.append(job_copy)
-
-    # จัดกลุ่มงานเป็น Trip (1 Trip มีหลายสาขาได้)
-    trips = {}
-    for job in driver_jobs_with_id:
-        trip_key = (str(job['PO_Date']), str(job['Round']), str(job['Car_No']))
-        if trip_key not in trips: trips[trip_key] = []
-        trips[trip_key].append(job)
+    view = get_driver_task_view(sheet, driver_name)
 
-    final_jobs_list = []
     now_thai = datetime.now() + timedelta(hours=7)
     today_date = now_thai.date()
-    
+    today_date_str = now_thai.strftime("%Y-%m-%d")
+
     # Logic การเลือกโชว์งาน: โชว์งานที่ยังไม่เสร็จ หรือ งานเสร็จแล้วที่เป็นของวันนี้/อนาคต
-    for key, job_list in trips.items():
-        is_trip_fully_done = all(j['Status'] == 'Done' for j in job_list)
-        show_this_trip = False
-        
-        if not is_trip_fully_done:
-            show_this_trip = True
-        else:
-            try:
-                job_date_str = job_list[0].get('Load_Date', job_list[0]['PO_Date'])
-                pd = datetime.strptime(job_date_str, "%Y-%m-%d").date()
-                if pd >= today_date:
-                    show_this_trip = True
-            except: 
-                show_this_trip = True
-            
-        if show_this_trip:
-            final_jobs_list.extend(job_list)
+    my_jobs = []
+    for trip_key, task in view['tasks']:
+        trip = view['trips'][trip_key]
+        if trip['fully_done'] and trip['date'] is not None and trip['date'] < today_date: continue
+        my_jobs.append(decorate_driver_task(task, now_thai))
+
+    stale_step = request.args.get('stale_step')
+    stale_message = stale_step_message(stale_step) if stale_step in STEP_TIME_FIELDS else ''
+    return render_template('driver_tasks.html', name=driver_name, jobs=my_jobs, today_date=today_date_str,
+                           stale_message=stale_message)
+
+def wants_json_response():
+    """Request จาก fetch() ที่ขอผลเป็น JSON (แทน Redirect กลับหน้า driver_tasks)"""
+    return 'application/json' in request.headers.get('Accept', '')
+
+def build_trip_state(sheet, driver_name, target_row_data, columns):
+    """
+    สถานะล่าสุดของเที่ยว (หลังบันทึก) สำหรับ Patch การ์ดในหน้า driver_tasks
+    คืนค่า rows (เวลา T1-T8/Status ต่อสาขา), done และ card_html ที่ Render จาก Macro เดียวกับหน้าเต็ม
+    """
+    trip_key = columns.values(target_row_data, TRIP_KEY_FIELDS)
+    view = get_driver_task_view(sheet, driver_name)
+    trip_jobs = [task['job'] for key, task in view['tasks'] if key == trip_key]
+    if not trip_jobs:
+        return {'key': '|'.join(trip_key), 'rows': [], 'done': False, 'card_html': None}
+
+    rows = [dict({'row_id': j['row_id'], 'Status': j['Status']}, **{k: j.get(k, '') for k in STEP_TIME_FIELDS.values()}) for j in trip_jobs]
+    is_done = all(j['Status'] == 'Done' for j in trip_jobs)
+    render_trip_card = get_template_attribute('driver_task_card.html', 'render_trip_card')
+    return {'key': '|'.join(trip_key), 'rows': rows, 'done': is_done,
+            'card_html': str(render_trip_card(trip_jobs, driver_name, not is_done))}
+
+def collect_step_cells(step, mode, time_val, location_str, row_id_target, target_row_data, columns, all_values=None):
+    """
+    เซลล์ที่ต้องเขียนเมื่อกด Step หนึ่งครั้ง -> (cells [(row_id, field, value)], sheet_rows {row_id: row})
+    Step 1-6 เขียนทุกสาขาในเที่ยวเดียวกัน (ต้องส่ง all_values มาด้วย), Step 7-8 เขียนเฉพาะแถวนั้น
+    """
+    time_col = STEP_TIME_FIELDS.get(step)
+    loc_col = STEP_LOC_FIELDS.get(step)
+    val_to_save = time_val if mode == 'update' else ""
+    loc_to_save = location_str if mode == 'update' else ""
+    cells = []
+    sheet_rows = {}
 
-    # เรียงลำดับงาน
-    def sort_key_func(job):
-        return (str(job['PO_Date']), str(job.get('Load_Date', '')), str(job['Round']))
-    
-    my_jobs = sorted(final_jobs_list, key=sort_key_func)
-    today_date_str = now_thai.strftime("%Y-%m-%d")
+    if step in ['1', '2', '3', '4', '5', '6']:
+        target_key = columns.values(target_row_data, TRIP_KEY_FIELDS)
+        for i, row in enumerate(all_values[1:]):
+            current_row_id = i + 2
+            if columns.has(row) and columns.values(row, TRIP_KEY_FIELDS) == target_key:
+                cells.append((current_row_id, time_col, val_to_save))
+                if location_str or mode == 'cancel':
+                    cells.append((current_row_id, loc_col, loc_to_save))
+                sheet_rows[current_row_id] = row
 
-    # Loop เพื่อเตรียมข้อมูลสำหรับแสดงผล
-    for job in my_jobs:
-        # =========================================================
-        # [ส่วนที่ 1] Parsing PO Data (สำหรับแสดงช่องกรอกข้อมูล)
-        # =========================================================
-        po_str = str(job.get('PO_Nos', '')).strip()       # Col Z
-        doc_str = str(job.get('Doc_Result', '')).strip()  # Col AA
-        weight_str = str(job.get('Weight_Result', '')).strip() # Col AB
-        
-        job['parsed_po_details'] = []
-
-        if po_str:
-            # แปลง Doc String "PO1:Doc1 | PO2:Doc2" เป็น Dict
-            doc_map = {}
-            if doc_str:
-                for p in doc_str.split('|'):
-                    if ':' in p:
-                        k, v = p.split(':', 1)
-                        doc_map[k.strip()] = v.strip()
-
-            # แปลง Weight String "PO1:10.5 | PO2:20" เป็น Dict
-            weight_map = {}
-            if weight_str:
-                for p in weight_str.split('|'):
-                    if ':' in p:
-                        k, v = p.split(':', 1)
-                        weight_map[k.strip()] = v.strip()
-
-            # สร้าง List Object เพื่อส่งไปวนลูปสร้าง Input Field ใน HTML
-            for po_item in po_str.split(','):
-                po_name = po_item.strip()
-                if po_name:
-                    job['parsed_po_details'].append({
-                        'name': po_name,
-                        'doc': doc_map.get(po_name, ''),
-                        'weight': weight_map.get(po_name, '')
-                    })
-
-        # =========================================================
-        # [ส่วนที่ 2] Smart Title & UI Decoration (คำนวณสีและสถานะ)
-        # =========================================================
-        try:
-            load_date_str = job.get('Load_Date', job['PO_Date'])
-            round_str = str(job['Round']).strip()
-            job_dt_str = f"{load_date_str} {round_str}"
-            
-            try: job_dt = datetime.strptime(job_dt_str, "%Y-%m-%d %H:%M")
-            except: job_dt = datetime.strptime(f"{job['PO_Date']} {round_str}", "%Y-%m-%d %H:%M")
-            
-            diff = job_dt - now_thai
-            hours_diff = diff.total_seconds() / 3600
-            delta_days = (job_dt.date() - now_thai.date()).days
-
-            th_year = job_dt.year + 543
-            real_date_str = f"{job_dt.day}/{job_dt.month}/{str(th_year)[2:]}"
-            h = job_dt.hour
-
-            # ค่า Default
-            job['smart_title'] = f"เวลา {round_str}"
-            job['smart_detail'] = f"วันที่ {real_date_str}"
-            job['ui_class'] = {'bg': 'bg-gray-50', 'text': 'text-gray-500', 'icon': 'fa-clock'}
-
-            # 1. งานเร่งด่วน/ค้างส่ง (น้อยกว่า 0 ชม.)
-            if hours_diff <= 0:
-                if hours_diff > -12:
-                    job['smart_title'] = f"❗ เข้าโหลดงานตอนนี้"
-                    job['ui_class'] = {'bg': 'bg-red-50 border-red-100 ring-2 ring-red-200 animate-pulse', 'text': 'text-red-600', 'icon': 'fa-truck-ramp-box'}
-                else:
-                    job['smart_title'] = f"🔥 งานค้างส่ง"
-                    job['ui_class'] = {'bg': 'bg-red-50 border-red-100', 'text': 'text-red-500', 'icon': 'fa-triangle-exclamation'}
-                job['smart_detail'] = f"กำหนด: {round_str} น. ({real_date_str})"
-            
-            # 2. งานภายใน 16 ชม. (โหลดวันนี้/คืนนี้)
-            elif 0 < hours_diff <= 16:
-                if 6 <= h <= 12:    p, i, t = "เช้านี้", "fa-sun", "yellow"
-                elif 13 <= h <= 18: p, i, t = "บ่ายนี้", "fa-cloud-sun", "orange"
-                else:               p, i, t = "คืนนี้", "fa-moon", "indigo"
-                job['smart_title'] = f"โหลดสินค้า{p}"
-                job['smart_detail'] = f"เวลา {round_str} น. ของวันที่ {real_date_str}"
-                job['ui_class'] = {'bg': f'bg-{t}-50 border-{t}-100 ring-1 ring-{t}-50', 'text': f'text-{t}-600', 'icon': i}
-            
-            # 3. งานวันพรุ่งนี้
-            elif delta_days == 1:
-                period = "คืนพรุ่งนี้" if (h >= 19 or h <= 5) else "วันพรุ่งนี้"
-                job['smart_title'] = f"⏩ เตรียมโหลด{period}"
-                job['smart_detail'] = f"เวลา {round_str} น. ของวันที่ {real_date_str}"
-                job['ui_class'] = {'bg': 'bg-blue-50 border-blue-100', 'text': 'text-blue-600', 'icon': 'fa-calendar-day'}
-            
-            # 4. งานล่วงหน้า
-            else:
-                job['smart_title'] = f"📅 งานล่วงหน้า"
-                job['smart_detail'] = f"วันที่ {real_date_str} เวลา {round_str} น."
-                job['ui_class'] = {'bg': 'bg-gray-50 border-gray-100', 'text': 'text-gray-500', 'icon': 'fa-calendar-days'}
-            
-            # PO Label
-            po_d = datetime.strptime(job['PO_Date'], "%Y-%m-%d")
-            po_th = f"{po_d.day}/{po_d.month}/{str(po_d.year+543)[2:]}"
-            job['po_label'] = f"(เอกสาร PO วันที่ {po_th})"
-            
-        except Exception as e: 
-            pass
+    elif step in ['7', '8']:
+        cells.append((row_id_target, time_col, val_to_save))
+        if location_str or mode == 'cancel':
+            cells.append((row_id_target, loc_col, loc_to_save))
+        sheet_rows[row_id_target] = target_row_data
+
+    if step == '8':
+        cells.append((row_id_target, 'Status', "Done" if mode == 'update' else ""))
+    return cells, sheet_rows
 
-    return render_template('driver_tasks.html', name=driver_name, jobs=my_jobs, today_date=today_date_str)
+def step_cells_to_batch(cells, columns):
+    """
+    แปลง [(row_id, field, value)] เป็น Payload ของ ws.batch_update (เซลล์ซ้ำใช้ค่าล่าสุด)
+    ชื่อคอลัมน์ที่ไม่มีในหัวตาราง raise ColumnMapError ก่อนส่ง (ไม่มีเซลล์ไหนถูกเขียน)
+    """
+    latest = {}
+    for row_id, field, value in cells:
+        latest[(row_id, field)] = value
+    return [{'range': columns.a1(row_id, field), 'values': [[value]]}
+            for (row_id, field), value in latest.items()]
+
+def notify_step_update(sheet, step, target_row_data, columns, check_late=True):
+    """แจ้งเตือนหลังบันทึก Step (เข้า/ออก/จบงาน + เช็คกลุ่ม + เช็ค Late)"""
+    if not columns.has(target_row_data, 'Plate'): return
+    # เตรียมข้อมูลสำหรับส่งแจ้งเตือน
+    job_info_for_notify = {f: columns.value(target_row_data, f) for f in JOB_IDENTITY_FIELDS + ('Plate',)}
+
+    # 1. แจ้งเตือนรายคัน (เข้า Step 1 / ออก Step 6)
+    if step == '1' or step == '6':
+        notify_individual_movement(sheet, job_info_for_notify, step)
+    # [NEW] แจ้งเตือนรายคัน (จบงานครบทุกสาขา Step 8)
+    if step == '8':
+        notify_car_completion(sheet, job_info_for_notify)
+    # 2. ตรวจสอบกลุ่ม (เข้าครบ / ออกครบ / จบครบ)
+    # เช็คทุกครั้งที่มีการ update Step 1, 6 หรือ 8
+    if step in ['1', '6', '8']:
+        check_group_completion(sheet, job_info_for_notify['PO_Date'], job_info_for_notify['Round'], step)
+
+    # 3. เช็ค Late (ฝากเช็คทุกครั้งที่มีการกด Update)
+    if check_late: check_late_and_notify(sheet)
 
 @app.route('/update_status', methods=['POST'])
 def update_status():
@@ -1876,86 +4810,185 @@ def update_status():
     current_time = (datetime.now() + timedelta(hours=7)).strftime("%H:%M")
     
     sheet = get_db()
-    ws = sheet.worksheet('Jobs')
-    
-    # ปรับ Col Index ขยับไปทางขวา 1 ช่อง (เดิม 8 -> 9 เพราะแทรก Weight ที่ 8)
-    time_col_map = {'1': 9, '2': 10, '3': 11, '4': 12, '5': 13, '6': 14, '7': 15, '8': 16}
-    # Location ก็ขยับตาม (เดิม 17 -> 18)
-    loc_col_map = {'1': 18, '2': 19, '3': 20, '4': 21, '5': 22, '6': 23, '7': 24, '8': 25}
-    
-    time_col = time_col_map.get(step)
-    loc_col = loc_col_map.get(step)
-    updates = []
-
+    jobs_repo = JobsRepository(sheet)
     val_to_save = current_time if mode == 'update' else ""
-    loc_to_save = location_str if mode == 'update' else ""
 
-    target_row_data = ws.row_values(row_id_target)
-
-    if step in ['1', '2', '3', '4', '5', '6']:
-        if len(target_row_data) < 4: return redirect(url_for('driver_tasks', name=driver_name))
-        target_po = target_row_data[0] 
-        target_round = target_row_data[2]
-        target_car = target_row_data[3]
+    # ตรวจแถวจนถึงเขียนเสร็จไม่ให้การลบแถว (ลบงาน / Archive) แทรกกลางทาง
+    with jobs_repo.lock:
+        target_row_data = jobs_repo.row(row_id_target)
+        columns = jobs_repo.columns()
+
+        if not columns.has(target_row_data):
+            if wants_json_response(): return json.dumps({'status': 'error', 'message': 'ไม่พบข้อมูลงานในแถวนี้'}), 404
+            return redirect(url_for('driver_tasks', name=driver_name))
+        if not step_target_matches(request.form.get('trip_key', ''), driver_name, target_row_data, columns):
+            if wants_json_response(): return json.dumps({'status': 'error', 'message': stale_step_message(step)}), 409
+            return redirect(url_for('driver_tasks', name=driver_name, stale_step=step))
+
+        all_values = None
+        if step in ['1', '2', '3', '4', '5', '6']:
+            all_values = jobs_repo.grid()
+            columns = jobs_repo.columns(all_values)
+
+        # รวม เวลา / พิกัด / Status ไว้ใน batch_update เดียว แล้วเขียนค่าลง Cache ตรง ๆ
+        # (หน้า driver_tasks ที่ Redirect ไปจะไม่ต้องโหลดทั้ง Sheet ใหม่)
+        cache_updates, sheet_rows = collect_step_cells(step, mode, current_time, location_str, row_id_target, target_row_data, columns, all_values)
+        jobs_repo.update_steps(cache_updates, sheet_rows, columns)
+
+    if mode == 'update':
+        notify_step_update(sheet, step, target_row_data, columns)
+
+    if wants_json_response():
+        result = {'status': 'success', 'step': step, 'mode': mode, 'value': val_to_save}
+        result['trip'] = build_trip_state(sheet, driver_name, target_row_data, columns) if columns.has(target_row_data) else None
+        return json.dumps(result), 200, {'Content-Type': 'application/json'}
         
-        all_values = ws.get_all_values()
-        for i, row in enumerate(all_values[1:]): 
-            current_row_id = i + 2 
-            if (len(row) > 3 and row[0] == target_po and row[2] == target_round and row[3] == target_car):      
-                cell_coord_time = gspread.utils.rowcol_to_a1(current_row_id, time_col)
-                updates.append({'range': cell_coord_time, 'values': [[val_to_save]]})
-                if location_str or mode == 'cancel':
-                    cell_coord_loc = gspread.utils.rowcol_to_a1(current_row_id, loc_col)
-                    updates.append({'range': cell_coord_loc, 'values': [[loc_to_save]]})
-        if updates: ws.batch_update(updates)
+    return redirect(url_for('driver_tasks', name=driver_name))
 
-    elif step in ['7', '8']:
-        cell_coord_time = gspread.utils.rowcol_to_a1(row_id_target, time_col)
-        updates.append({'range': cell_coord_time, 'values': [[val_to_save]]})
-        if location_str or mode == 'cancel':
-            cell_coord_loc = gspread.utils.rowcol_to_a1(row_id_target, loc_col)
-            updates.append({'range': cell_coord_loc, 'values': [[loc_to_save]]})
-        if updates: ws.batch_update(updates)
-
-    if step == '8': 
-        # Status column ขยับจาก 16 -> 17
-        status_val = "Done" if mode == 'update' else ""
-        ws.update_cell(row_id_target, 17, status_val)
-    
-    invalidate_cache('Jobs')
-
-    # =========================================================================
-    # [NEW LOGIC START] Notification Triggers
-    # =========================================================================
-    if mode == 'update' and len(target_row_data) > 5:
-        # เตรียมข้อมูลสำหรับส่งแจ้งเตือน
-        # ตรวจสอบ index ให้แน่ใจว่าตรงกับ Sheet (Driver=Col E (idx 4), Plate=Col F (idx 5))
-        job_info_for_notify = {
-            'PO_Date': target_row_data[0],
-            'Round': target_row_data[2],
-            'Car_No': target_row_data[3],
-            'Driver': target_row_data[4],
-            'Plate': target_row_data[5]
-        }
+# ==========================================
+# [Offline Sync] รับ Step Events ที่เครื่องคนขับบันทึกไว้ แล้วเขียนลง Sheet ทีละชุด
+# ==========================================
+STEP_SYNC_MAX_EVENTS = 200
+STEP_EVENT_ID_RE = re.compile(r'^[A-Za-z0-9_-]{8,64}$')
+STEP_EVENT_TIME_RE = re.compile(r'^([01]\d|2[0-3]):[0-5]\d$')
+STEP_EVENT_HEADER = ['Event_Id', 'Driver', 'Row_Id', 'Step', 'Mode', 'Value', 'Location', 'Recorded_At', 'Synced_At']
+STEP_EVENT_RETENTION_DAYS = int(os.environ.get('STEP_EVENT_RETENTION_DAYS', '7'))  # เก็บ Event ID ไว้กันส่งซ้ำกี่วัน
+step_sync_lock = threading.Lock()
+
+def get_step_event_log(sheet):
+    """Sheet StepEvents เก็บ Event ID ที่บันทึกแล้ว (กันส่งซ้ำเวลาเน็ตหลุดแล้ว Retry)"""
+    return LogRepository(sheet, 'StepEvents', STEP_EVENT_HEADER)
+
+def trim_step_event_log(sheet, before):
+    """
+    ลบ Event ที่ Sync ก่อนวันที่ before ออกจาก StepEvents (เรียกตอนปิดยอดทุกคืน)
+    sync_steps อ่านคอลัมน์ Event ID ทั้งคอลัมน์ทุกครั้ง จึงต้องไม่ให้ Log โตไปเรื่อย ๆ
+    Log เขียนต่อท้ายตามเวลาเสมอ -> ลบเป็นช่วงเดียวจากบนสุด
+    """
+    with step_sync_lock:
+        step_log = get_step_event_log(sheet)
+        count = step_log.count_before('Synced_At', before)
+        step_log.delete_first(count)
+    return count
+
+def parse_step_event(ev):
+    """ตรวจ/แปลง Event จากเครื่องคนขับ -> dict (ข้อมูลผิดรูปแบบ raise ValueError)"""
+    if not isinstance(ev, dict): raise ValueError('รูปแบบ Event ไม่ถูกต้อง')
+    event_id = str(ev.get('id', ''))
+    if not STEP_EVENT_ID_RE.match(event_id): raise ValueError('Event ID ไม่ถูกต้อง')
+    step = str(ev.get('step', ''))
+    if step not in STEP_TIME_FIELDS: raise ValueError('Step ไม่ถูกต้อง')
+    mode = ev.get('mode', 'update')
+    if mode not in ('update', 'cancel'): raise ValueError('Mode ไม่ถูกต้อง')
+    try:
+        row_id = int(ev.get('row_id'))
+        recorded_ms = int(ev.get('ts') or 0)
+    except (TypeError, ValueError):
+        raise ValueError('Row ID / เวลาไม่ถูกต้อง')
+    if row_id < 2: raise ValueError('Row ID ไม่ถูกต้อง')
+
+    # ใช้เวลาตอนที่คนขับกดจริง (เวลาเครื่อง) ถ้าไม่มีหรือผิดรูปแบบค่อยใช้เวลา Server
+    time_val = str(ev.get('time', ''))
+    if not STEP_EVENT_TIME_RE.match(time_val):
+        time_val = (datetime.now() + timedelta(hours=7)).strftime("%H:%M")
+    lat, long = ev.get('lat') or '', ev.get('long') or ''
+    recorded_at = ''
+    if recorded_ms > 0:
+        try: recorded_at = (datetime.fromtimestamp(recorded_ms / 1000, timezone.utc) + timedelta(hours=7)).strftime("%Y-%m-%d %H:%M:%S")
+        except (OverflowError, OSError, ValueError): recorded_ms = 0
+    return {'id': event_id, 'row_id': row_id, 'step': step, 'mode': mode, 'time': time_val,
+            'location': f"{lat},{long}" if lat and long else "",
+            'trip_key': str(ev.get('trip_key', '')), 'ts': recorded_ms, 'recorded_at': recorded_at}
+
+def trip_key_part(value):
+    """ค่าใน Key เที่ยว: การ์ดได้ค่าจาก get_all_records (แปลงเป็นตัวเลขแล้ว) ส่วน Sheet เป็น Text ดิบ"""
+    text = str(value).strip()
+    try: return repr(float(text))
+    except ValueError: return text
+
+def trip_key_matches(client_key, row, columns):
+    parts = client_key.split('|')
+    return len(parts) == 3 and [trip_key_part(p) for p in parts] == [trip_key_part(v) for v in columns.values(row, TRIP_KEY_FIELDS)]
+
+def step_target_matches(client_key, driver_name, row, columns):
+    """
+    แถวยังเป็นงานที่คนขับกดหรือไม่ (แถวเลื่อนจากการลบ/ย้ายงานหลังเปิดหน้า -> ไม่เขียนทับงานคันอื่น)
+    ไม่มี trip_key (หน้า/คิวที่เปิดไว้ก่อนมี trip_key) -> รับเมื่อแถวเป็นงานของคนขับคนนี้และยังไม่ Done
+    """
+    if client_key: return trip_key_matches(client_key, row, columns)
+    return bool(driver_name) and str(columns.value(row, 'Driver')).strip() == str(driver_name).strip() \
+        and str(columns.value(row, 'Status')).strip() != 'Done'
 
-        # 1. แจ้งเตือนรายคัน (เข้า Step 1 / ออก Step 6)
-        if step == '1' or step == '6':
-            notify_individual_movement(sheet, job_info_for_notify, step)
-        # [NEW] แจ้งเตือนรายคัน (จบงานครบทุกสาขา Step 8)
-        if step == '8':
-            notify_car_completion(sheet, job_info_for_notify)
-        # 2. ตรวจสอบกลุ่ม (เข้าครบ / ออกครบ / จบครบ)
-        # เช็คทุกครั้งที่มีการ update Step 1, 6 หรือ 8
-        if step in ['1', '6', '8']:
-            check_group_completion(sheet, target_row_data[0], target_row_data[2], step)
-            
-        # 3. เช็ค Late (ฝากเช็คทุกครั้งที่มีการกด Update)
-        check_late_and_notify(sheet)
-    # =========================================================================
-    # [NEW LOGIC END]
-    # =========================================================================
-        
-    return redirect(url_for('driver_tasks', name=driver_name))
+def stale_step_message(step):
+    return f"{STEP_LABELS.get(step, step)}: ข้อมูลงานถูกแก้ไขแล้ว กรุณาโหลดหน้าใหม่แล้วกดอีกครั้ง"
+
+@app.route('/sync_steps', methods=['POST'])
+def sync_steps():
+    """
+    รับ Step Events เป็นชุด {driver_name, events: [{id, row_id, step, mode, time, lat, long, trip_key, ts}]}
+    Event ID ที่เคยบันทึกแล้วจะถูกข้าม (Idempotent) ส่วนที่เหลือเขียนลง Jobs ใน batch_update เดียว
+    """
+    data = request.get_json(silent=True) or {}
+    driver_name = data.get('driver_name', '')
+    raw_events = data.get('events')
+    if not isinstance(raw_events, list) or not raw_events:
+        return json.dumps({'status': 'error', 'message': 'ไม่มีข้อมูล Event'}), 400
+    if len(raw_events) > STEP_SYNC_MAX_EVENTS:
+        return json.dumps({'status': 'error', 'message': f'ส่งได้ไม่เกิน {STEP_SYNC_MAX_EVENTS} รายการต่อครั้ง'}), 400
+
+    events, rejected = [], []
+    for ev in raw_events:
+        try: events.append(parse_step_event(ev))
+        except ValueError as e: rejected.append({'id': str(ev.get('id', '')) if isinstance(ev, dict) else '', 'message': str(e)})
+    # เรียงตามเวลาที่กดจริง (กด -> ยกเลิก -> กดใหม่ ต้องได้ค่าสุดท้ายถูกต้อง)
+    events.sort(key=lambda e: e['ts'])
+
+    sheet = get_db()
+    applied, duplicates, notify_queue, trip_targets = [], [], [], {}
+    with step_sync_lock, jobs_write_lock:
+        jobs_repo = JobsRepository(sheet)
+        step_log = get_step_event_log(sheet)
+        seen_ids = set(step_log.column('Event_Id'))
+        all_values = jobs_repo.grid()
+        columns = jobs_repo.columns(all_values)
+
+        cells, sheet_rows, log_rows = [], {}, []
+        synced_at = (datetime.now() + timedelta(hours=7)).strftime("%Y-%m-%d %H:%M:%S")
+        for ev in events:
+            if ev['id'] in seen_ids:
+                duplicates.append(ev['id'])
+                continue
+            target_row_data = all_values[ev['row_id'] - 1] if ev['row_id'] <= len(all_values) else []
+            if not columns.has(target_row_data):
+                rejected.append({'id': ev['id'], 'message': 'ไม่พบข้อมูลงานในแถวนี้'})
+                continue
+            if not step_target_matches(ev['trip_key'], driver_name, target_row_data, columns):
+                rejected.append({'id': ev['id'], 'message': stale_step_message(ev['step'])})
+                continue
+
+            ev_cells, ev_rows = collect_step_cells(ev['step'], ev['mode'], ev['time'], ev['location'], ev['row_id'], target_row_data, columns, all_values)
+            cells.extend(ev_cells)
+            sheet_rows.update(ev_rows)
+            seen_ids.add(ev['id'])
+            applied.append(ev['id'])
+            value = ev['time'] if ev['mode'] == 'update' else ''
+            log_rows.append([ev['id'], driver_name, ev['row_id'], ev['step'], ev['mode'], value,
+                             ev['location'] if ev['mode'] == 'update' else '', ev['recorded_at'], synced_at])
+            # Event แบบไม่มี trip_key: Key จากแถวอาจไม่ตรงกับการ์ด -> เครื่องหาการ์ดไม่เจอแล้วโหลดหน้าใหม่เอง
+            trip_targets[ev['trip_key'] or '|'.join(columns.values(target_row_data, TRIP_KEY_FIELDS))] = target_row_data
+            if ev['mode'] == 'update': notify_queue.append((ev['step'], target_row_data))
+
+        # เขียน Jobs ก่อน Log: ถ้า Log พังแล้วเครื่องส่งซ้ำ ค่าที่เขียนก็ยังเป็นเวลาเดิมของ Event
+        if cells: jobs_repo.update_steps(cells, sheet_rows, columns)
+        step_log.append(log_rows)
+
+    for step, target_row_data in notify_queue:
+        notify_step_update(sheet, step, target_row_data, columns, check_late=False)
+    if notify_queue: check_late_and_notify(sheet)
+
+    trips = {key: build_trip_state(sheet, driver_name, row, columns) for key, row in trip_targets.items()} if driver_name else {}
+    result = {'status': 'success', 'applied': applied, 'duplicates': duplicates, 'rejected': rejected, 'trips': trips}
+    return json.dumps(result), 200, {'Content-Type': 'application/json'}
 
 @app.route('/update_driver', methods=['POST'])
 def update_driver():
@@ -1969,22 +5002,10 @@ def update_driver():
         new_plate = data.get('new_plate')
 
         sheet = get_db()
-        ws = sheet.worksheet('Jobs')
-        all_values = ws.get_all_values()
-        updates = []
-        
-        for i, row in enumerate(all_values):
-            if i == 0: continue 
-            if len(row) < 6: continue
-            if (row[0] == target_po and str(row[2]) == str(target_round) and str(row[3]) == target_car):
-                row_num = i + 1
-                updates.append({'range': f'E{row_num}', 'values': [[new_driver]]})
-                updates.append({'range': f'F{row_num}', 'values': [[new_plate]]})
-
-        if updates:
-            ws.batch_update(updates)
-            invalidate_cache('Jobs')
-            return json.dumps({'status': 'success', 'count': len(updates)/2})
+        count = JobsRepository(sheet).reassign_driver(target_po, target_round, target_car, new_driver, new_plate)
+
+        if count:
+            return json.dumps({'status': 'success', 'count': count})
         else:
             return json.dumps({'status': 'error', 'message': 'ไม่พบรายการงานที่ตรงกัน'})
     except Exception as e:
@@ -1993,50 +5014,153 @@ def update_driver():
         
 @app.route('/save_po_detail', methods=['POST'])
 def save_po_detail():
+    """
+    บันทึก Doc / น้ำหนัก 1 ช่อง แบบ Optimistic Concurrency (ไม่อ่าน Sheet ก่อนเขียน)
+    base_version = Version ของแถวงานตอนที่หน้าคนขับ Render ถ้าช่องเดียวกันถูกแก้หลังจากนั้น -> ตอบ 409 ให้เครื่องเลือกเอง
+    ถ้าเครื่องอื่นแก้คนละช่อง ถือว่ารวมกันได้ ไม่นับเป็นการชน
+    """
     try:
         data = request.json
         row_id = int(data.get('row_id'))
-        po_name = data.get('po_name')
+        po_name = str(data.get('po_name', '')).strip()
         val_type = data.get('type') # 'doc' หรือ 'weight'
-        value = data.get('value')
+        value = str(data.get('value', '')).strip()
+        base_version = data.get('base_version')
+        if val_type not in PO_DETAIL_FIELDS or not po_name:
+            return json.dumps({'status': 'error', 'message': 'ข้อมูลไม่ถูกต้อง'})
         
         sheet = get_db()
-        ws = sheet.worksheet('Jobs')
-        
-        # อ่านข้อมูลเดิมมาก่อน
-        # Col 27 (AA) = Doc, Col 28 (AB) = Weight
-        target_col = 27 if val_type == 'doc' else 28
-        current_val = ws.cell(row_id, target_col).value or ""
-        
-        # แปลงเป็น Map
-        val_map = {}
-        if current_val:
-            parts = current_val.split('|')
-            for p in parts:
-                if ':' in p:
-                    k, v = p.split(':', 1)
-                    val_map[k.strip()] = v.strip()
-        
-        # อัพเดทค่าใหม่
-        val_map[po_name] = value
-        
-        # แปลงกลับเป็น String "PO:Val | PO:Val"
-        new_str_parts = []
-        for k, v in val_map.items():
-            if v: # เก็บเฉพาะที่มีค่า
-                new_str_parts.append(f"{k}:{v}")
-        
-        new_str = " | ".join(new_str_parts)
+        # Key ของงานตามที่หน้าคนขับเห็น (ถ้าไม่ส่งมา ใช้แถวใน Cache)
+        job_key = str(data.get('job_key') or '')
+        if not job_key:
+            jobs = get_cached_records(sheet, 'Jobs')
+            if not (2 <= row_id <= len(jobs) + 1):
+                return json.dumps({'status': 'error', 'message': 'ไม่พบข้อมูลงานในแถวนี้'})
+            job_key = po_job_key(jobs[row_id - 2])
+
+        with po_detail_lock:
+            po_index = get_po_detail_index(sheet)
+            entry = po_index.get(job_key)
+            if base_version is not None and entry:
+                changed_at = entry['changed'].get((po_name, val_type), 0)
+                if changed_at > int(base_version):
+                    current = entry['pos'].get(po_name, {}).get(val_type, '')
+                    return json.dumps({'status': 'conflict', 'message': 'ข้อมูลนี้ถูกแก้ไขจากเครื่องอื่นแล้ว',
+                                       'current': current, 'version': entry['version']}), 409
+
+            # บันทึกเฉพาะช่องนี้ (ไม่ต้องอ่าน Doc_Result / Weight_Result เดิมมารวม)
+            append_po_detail(sheet, job_key, po_name, val_type, value)
+            version = po_detail_version(get_po_detail_index(sheet), job_key)
+            write_back_po_cell(sheet, row_id, job_key, val_type)
         
-        # บันทึก
-        ws.update_cell(row_id, target_col, new_str)
-        invalidate_cache('Jobs')
-        
-        return json.dumps({'status': 'success', 'value': value})
+        return json.dumps({'status': 'success', 'value': value, 'version': version})
     except Exception as e:
         return json.dumps({'status': 'error', 'message': str(e)})
         
 
+# ==========================================
+# [Calendar] สรุปคนขับรายเดือนแบบคำนวณล่วงหน้า (อัปเดตเฉพาะส่วนที่เปลี่ยน)
+# ==========================================
+# calendar_state['months'][(year, month)][day]['day'|'night'][driver] = Counter(trip_id -> จำนวนแถว)
+# เมื่อข้อมูล Jobs เปลี่ยน (สร้าง/ลบ/เปลี่ยนคนขับ) จะ Diff ช่องของแต่ละแถวกับรอบก่อน แล้วแก้เฉพาะเดือนที่กระทบ
+calendar_state = {'version': None, 'slots': Counter(), 'months': {}}
+calendar_month_views = {}  # (year, month) -> {'drivers_version', 'data'} ข้อมูลที่ส่งให้ Template
+
+def calendar_slot(job):
+    """
+    หาช่องบนปฏิทินของงาน 1 แถว: (year, month, day, 'day'|'night', driver, trip_id) หรือ None
+    - งานก่อน 06:00 นับเป็นของวันก่อนหน้า (Midnight Crossover)
+    - trip_id = "รอบ_ลำดับรถ" หลายสาขาในเที่ยวเดียวกันนับเป็น 1 รอบ
+    """
+    if str(job.get('Status', '')).lower() == 'cancel': return None
+
+    date_str = job.get('Load_Date', '').strip()
+    if not date_str: date_str = str(job['PO_Date']).strip()
+    time_str = str(job['Round']).strip()
+    try:
+        if not time_str: time_str = "12:00"
+        fmt_time = "%H:%M" if len(time_str) <= 5 else "%H:%M:%S"
+        job_dt = datetime.strptime(f"{date_str} {time_str}", f"%Y-%m-%d {fmt_time}")
+        if 0 <= job_dt.hour < 6:
+            job_dt = job_dt - timedelta(days=1)
+
+        h = int(time_str.split(':')[0])
+        shift = 'night' if (h < 6 or h >= 19) else 'day'
+        return (job_dt.year, job_dt.month, job_dt.day, shift, job['Driver'], f"{time_str}_{job.get('Car_No', '')}")
+    except Exception:
+        return None
+
+def apply_calendar_delta(months, slot, delta):
+    year, month, day, shift, driver, trip_id = slot
+    days = months.setdefault((year, month), {})
+    drivers = days.setdefault(day, {'day': {}, 'night': {}})[shift]
+    trips = drivers.setdefault(driver, Counter())
+    trips[trip_id] += delta
+    if trips[trip_id] <= 0: del trips[trip_id]
+    if not trips: del drivers[driver]
+
+def refresh_calendar_state(sheet):
+    """อัปเดต Aggregate ให้ตรงกับ Jobs Version ล่าสุด คืนค่า Set ของเดือนที่มีการเปลี่ยนแปลง"""
+    get_cached_records(sheet, 'Jobs')
+    version = get_data_version('Jobs')
+    if calendar_state['version'] == version: return set()
+
+    slots = analytics_calendar_slots(sheet)
+
+    changed = set()
+    old_slots = calendar_state['slots']
+    for slot in set(old_slots) | set(slots):
+        delta = slots.get(slot, 0) - old_slots.get(slot, 0)
+        if delta:
+            apply_calendar_delta(calendar_state['months'], slot, delta)
+            changed.add(slot[:2])
+
+    calendar_state['slots'] = slots
+    calendar_state['version'] = version
+    for month_key in changed: calendar_month_views.pop(month_key, None)
+    return changed
+
+def build_calendar_month_view(days, all_driver_names):
+    """แปลง Aggregate ของเดือนเป็นข้อมูลรายวันสำหรับ calendar.html"""
+    all_names = set(all_driver_names)
+    final_data = {}
+    for d, shifts in days.items():
+        day_active_dict, night_active_dict = shifts['day'], shifts['night']
+        if not day_active_dict and not night_active_dict: continue
+
+        # จำนวนรอบ = จำนวน trip_id ที่ไม่ซ้ำของคนขับในกะนั้น
+        day_active = sorted([{'name': k, 'count': len(v)} for k, v in day_active_dict.items()], key=lambda x: x['name'])
+        night_active = sorted([{'name': k, 'count': len(v)} for k, v in night_active_dict.items()], key=lambda x: x['name'])
+
+        final_data[d] = {
+            'day_active': day_active,
+            'night_active': night_active,
+            'day_standby': sorted(all_names - set(day_active_dict)),
+            'night_standby': sorted(all_names - set(night_active_dict)),
+            'day_count': len(day_active),
+            'night_count': len(night_active)
+        }
+    return final_data
+
+def get_calendar_month(sheet, year, month, is_past=False):
+    """
+    ข้อมูลปฏิทินของเดือน (ดึงจาก Cache ถ้าไม่มีอะไรเปลี่ยน)
+    เดือนที่ผ่านมาแล้วถือว่าปิดแล้ว: ไม่คำนวณ Standby ใหม่เมื่อรายชื่อคนขับเปลี่ยน (คำนวณใหม่เฉพาะเมื่องานในเดือนนั้นถูกแก้)
+    """
+    refresh_calendar_state(sheet)
+    raw_drivers = get_cached_records(sheet, 'Drivers')
+    drivers_version = get_data_version('Drivers')
+
+    month_key = (year, month)
+    view = calendar_month_views.get(month_key)
+    if view is not None and (is_past or view['drivers_version'] == drivers_version):
+        return view['data']
+
+    all_driver_names = [d['Name'] for d in raw_drivers if d.get('Name')]
+    data = build_calendar_month_view(calendar_state['months'].get(month_key, {}), all_driver_names)
+    calendar_month_views[month_key] = {'drivers_version': drivers_version, 'data': data}
+    return data
+
 # ==========================================
 # [UPDATED] Monthly Calendar with Midnight Crossover
 # ==========================================
@@ -2063,95 +5187,7 @@ def monthly_calendar():
     month_name = thai_months[month]
 
     sheet = get_db()
-    raw_jobs = get_cached_records(sheet, 'Jobs')
-    raw_drivers = get_cached_records(sheet, 'Drivers')
-    all_driver_names = [d['Name'] for d in raw_drivers if d.get('Name')]
-
-    # เก็บข้อมูลเป็น Set เพื่อกันซ้ำ (Trip ID)
-    # โครงสร้าง: calendar_data[day] = { 'day': { 'DriverName': {set_of_trip_ids} }, ... }
-    calendar_data = {}
-
-    for job in raw_jobs:
-        if str(job.get('Status', '')).lower() == 'cancel': continue
-        
-        date_str = job.get('Load_Date', '').strip()
-        if not date_str: date_str = str(job['PO_Date']).strip()
-        time_str = str(job['Round']).strip()
-        
-        try:
-            if not time_str: time_str = "12:00"
-            fmt_time = "%H:%M" if len(time_str) <= 5 else "%H:%M:%S"
-            job_dt = datetime.strptime(f"{date_str} {time_str}", f"%Y-%m-%d {fmt_time}")
-            
-            # Logic: Midnight Crossover
-            if 0 <= job_dt.hour < 6:
-                job_dt = job_dt - timedelta(days=1)
-            
-            if job_dt.year != year or job_dt.month != month:
-                continue
-                
-            day_key = job_dt.day
-            
-            if day_key not in calendar_data:
-                calendar_data[day_key] = {'day_drivers': {}, 'night_drivers': {}}
-            
-            is_day = True
-            h = int(time_str.split(':')[0])
-            if h < 6 or h >= 19: is_day = False
-            
-            driver_name = job['Driver']
-            
-            # สร้าง Unique ID สำหรับเที่ยววิ่งนี้ (เช่น "11:00_14")
-            # ถ้าเป็นรอบเดียวกัน คันเดียวกัน แม้จะมีหลายสาขา ID นี้จะเหมือนเดิม
-            trip_id = f"{time_str}_{job.get('Car_No', '')}"
-
-            if is_day:
-                if driver_name not in calendar_data[day_key]['day_drivers']:
-                    calendar_data[day_key]['day_drivers'][driver_name] = set()
-                calendar_data[day_key]['day_drivers'][driver_name].add(trip_id)
-            else:
-                if driver_name not in calendar_data[day_key]['night_drivers']:
-                    calendar_data[day_key]['night_drivers'][driver_name] = set()
-                calendar_data[day_key]['night_drivers'][driver_name].add(trip_id)
-                
-        except Exception as e: 
-            continue
-
-    # จัดรูปแบบข้อมูลสุดท้าย
-    final_data = {}
-    for d in range(1, 32):
-        if d in calendar_data:
-            day_active_dict = calendar_data[d]['day_drivers']
-            night_active_dict = calendar_data[d]['night_drivers']
-            
-            # แปลง Set ให้เป็นจำนวนนับ (len)
-            # ถ้ามี 2 สาขา แต่ trip_id เดียวกัน set จะมีขนาดแค่ 1 -> นับเป็น 1 รอบ (ถูกต้อง)
-            # ถ้ามี 2 รอบ (11:00 และ 18:30) trip_id จะต่างกัน -> นับเป็น 2 รอบ (ถูกต้อง)
-            
-            day_active = sorted(
-                [{'name': k, 'count': len(v)} for k, v in day_active_dict.items()], 
-                key=lambda x: x['name']
-            )
-            
-            night_active = sorted(
-                [{'name': k, 'count': len(v)} for k, v in night_active_dict.items()], 
-                key=lambda x: x['name']
-            )
-            
-            active_day_names = set(day_active_dict.keys())
-            active_night_names = set(night_active_dict.keys())
-            
-            day_standby = sorted(list(set(all_driver_names) - active_day_names))
-            night_standby = sorted(list(set(all_driver_names) - active_night_names))
-            
-            final_data[d] = {
-                'day_active': day_active,
-                'night_active': night_active,
-                'day_standby': day_standby,
-                'night_standby': night_standby,
-                'day_count': len(day_active),
-                'night_count': len(night_active)
-            }
+    final_data = get_calendar_month(sheet, year, month, is_past=(year, month) < (now.year, now.month))
 
     prev_month = month - 1 if month > 1 else 12
     prev_year = year if month > 1 else year - 1
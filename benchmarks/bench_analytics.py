@@ -0,0 +1,130 @@
+"""
+Benchmark: Analytics แบบ Columnar (pandas) เทียบกับ Loop เดิมที่กวาด Jobs ทั้งตาราง
+
+ใช้ข้อมูลสังเคราะห์ชุดเดียวกับ bench_routes.py (In-memory Backend ไม่ต้องเชื่อมต่อ Google Sheets)
+    python benchmarks/bench_analytics.py [--rows 10000 100000 500000] [--repeat 5]
+
+แต่ละงานวัดหลังข้อมูลเปลี่ยน 1 ช่อง (Version ใหม่)
+    loop   = โค้ดเดิม (คัดลอกไว้ด้านล่างเป็นตัวอ้างอิง) กวาด Records ทั้งตาราง
+    frame  = คำนวณผลสรุปจาก Frame ที่สร้างแล้ว (frame_build = เวลาสร้าง Frame 1 ครั้งต่อ Version ใช้ร่วมกันทุกงาน)
+    total  = ทุกงานรวมกันต่อ 1 Version (frame รวมเวลาสร้าง Frame แล้ว)
+ก่อนจับเวลาตรวจว่าผลลัพธ์ตรงกับ Loop เดิม (วันที่, all_done, ช่องปฏิทิน)
+"""
+import argparse
+import gc
+import hashlib
+import json
+import os
+import sys
+import time
+import warnings
+from collections import Counter
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import app as lmt_app  # noqa: E402
+from bench_routes import JOBS_HEADER, make_dataset, percentile  # noqa: E402
+
+
+# --- Loop เดิม (ก่อนใช้ Frame) ---
+def loop_po_dates(raw_jobs):
+    return sorted(list(set([str(j['PO_Date']).strip() for j in raw_jobs])), reverse=True)
+
+def loop_date_index(raw_jobs):
+    index = {}
+    for job in raw_jobs:
+        index.setdefault(str(job['PO_Date']).strip(), {'jobs': []})['jobs'].append(job)
+    for entry in index.values():
+        entry['fingerprint'] = hashlib.sha1(
+            json.dumps(entry['jobs'], sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+        entry['all_done'] = lmt_app.is_jobs_all_done(entry['jobs'])
+    return index
+
+def loop_calendar_slots(raw_jobs):
+    slots = Counter()
+    for job in raw_jobs:
+        slot = lmt_app.calendar_slot(job)
+        if slot is not None: slots[slot] += 1
+    return slots
+
+
+def frame_date_index(sheet):
+    summary = lmt_app.analytics_date_summary(sheet)
+    return {d: {'fingerprint': summary.at[d, 'fingerprint'], 'all_done': bool(summary.at[d, 'all_done'])}
+            for d in summary.index}
+
+TASKS = {
+    'po_dates': (loop_po_dates, lmt_app.analytics_po_dates),
+    'date_index': (loop_date_index, frame_date_index),
+    'calendar_slots': (loop_calendar_slots, lmt_app.analytics_calendar_slots),
+}
+
+
+def check_same(sheet):
+    raw_jobs = lmt_app.get_cached_records(sheet, 'Jobs')
+    assert loop_po_dates(raw_jobs) == lmt_app.analytics_po_dates(sheet), 'po_dates ไม่ตรงกัน'
+    old, new = loop_date_index(raw_jobs), frame_date_index(sheet)
+    assert set(old) == set(new), 'วันที่ใน date_index ไม่ตรงกัน'
+    assert all(old[d]['all_done'] == new[d]['all_done'] for d in old), 'all_done ไม่ตรงกัน'
+    assert loop_calendar_slots(raw_jobs) == lmt_app.analytics_calendar_slots(sheet), 'ช่องปฏิทินไม่ตรงกัน'
+
+
+def touch(sheet, row_id, state):
+    """แก้ 1 ช่องให้ Version ของ Jobs เปลี่ยน (Frame ต้องสร้างใหม่)"""
+    state['i'] += 1
+    sheet.worksheet('Jobs').update_cell(row_id, JOBS_HEADER.index('Weight_Result') + 1, str(state['i']))
+    lmt_app.get_cached_records(sheet, 'Jobs')
+
+
+def clear_derived(sheet):
+    """Frame ของ Version ปัจจุบันพร้อมแล้ว แต่ยังไม่มีผลสรุปใด ๆ"""
+    lmt_app.get_jobs_frame(sheet)
+    lmt_app.jobs_frame_state['derived'] = {}
+
+
+def timed(fn, repeat, before):
+    timings = []
+    for _ in range(repeat):
+        before()
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 500000])
+    parser.add_argument('--rows-per-day', type=int, default=800)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    warnings.simplefilter('ignore')
+
+    today = (datetime.now() + timedelta(hours=7)).date()
+    print(f"{'task':<16}{'rows':>8}{'loop ms':>10}{'frame ms':>10}{'speedup':>9}", flush=True)
+    for n_rows in args.rows:
+        sheet = lmt_app.use_memory_backend(make_dataset(n_rows, args.rows_per_day, today))
+        gc.collect()
+        state = {'i': 0}
+        bump = lambda: touch(sheet, 2, state)  # noqa: E731
+        bump()
+        check_same(sheet)
+
+        build_ms = percentile(timed(lambda: lmt_app.get_jobs_frame(sheet), args.repeat, bump), 50) * 1000
+        print(f"{'frame_build':<16}{n_rows:>8}{'-':>10}{build_ms:>10.1f}{'-':>9}", flush=True)
+        loop_total, frame_total = 0.0, build_ms
+        for name, (loop_fn, frame_fn) in TASKS.items():
+            loop_ms = percentile(timed(lambda: loop_fn(lmt_app.get_cached_records(sheet, 'Jobs')), args.repeat, bump), 50) * 1000
+            frame_ms = percentile(timed(lambda: frame_fn(sheet), args.repeat, lambda: clear_derived(sheet)), 50) * 1000
+            loop_total, frame_total = loop_total + loop_ms, frame_total + frame_ms
+            print(f"{name:<16}{n_rows:>8}{loop_ms:>10.1f}{frame_ms:>10.1f}{loop_ms / frame_ms:>8.1f}x", flush=True)
+        print(f"{'total':<16}{n_rows:>8}{loop_total:>10.1f}{frame_total:>10.1f}{loop_total / frame_total:>8.1f}x", flush=True)
+
+        lmt_app.use_memory_backend({})
+        del sheet, bump
+        gc.collect()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Benchmark: ความเร็วการสร้าง PDF (หน้า/วินาที) ของ /export_pdf และ /export_pdf_summary
+
+ใช้ข้อมูล Jobs สังเคราะห์ในหน่วยความจำ ไม่ต้องเชื่อมต่อ Google Sheets
+    python benchmarks/bench_pdf.py [--trips 50 200 800] [--repeat 3]
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+import warnings
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import app as lmt_app  # noqa: E402
+
+BENCH_DATE = '2025-01-15'
+PAGE_RE = re.compile(rb'/Type\s*/Page\b(?!s)')
+
+
+class FakeWorksheet:
+    def __init__(self, records):
+        self.records = records
+
+    def get_all_records(self):
+        return self.records
+
+
+class FakeSpreadsheet:
+    def __init__(self, jobs):
+        self.sheets = {'Jobs': FakeWorksheet(jobs), 'Drivers': FakeWorksheet([]), 'Users': FakeWorksheet([])}
+
+    def worksheet(self, name):
+        return self.sheets[name]
+
+
+def make_jobs(n_trips, seed=7):
+    """สร้างงานสังเคราะห์ 1 วัน: n_trips เที่ยว เที่ยวละ 1-4 สาขา มีทั้งรอบกลางวัน/กลางคืน"""
+    rnd = random.Random(seed)
+    jobs = []
+    for car in range(1, n_trips + 1):
+        hour = rnd.choice([7, 9, 11, 13, 16, 19, 22, 1, 3])
+        round_t = f"{hour:02d}:{rnd.choice(['00', '30'])}"
+        driver = f"คนขับ {rnd.randint(1, 60)}"
+        for b in range(rnd.randint(1, 4)):
+            times = [f"{(hour + k) % 24:02d}:{rnd.randint(0, 59):02d}" for k in range(8)]
+            jobs.append({
+                'PO_Date': BENCH_DATE, 'Load_Date': BENCH_DATE, 'Round': round_t, 'Car_No': car,
+                'Driver': driver, 'Plate': f"70-{car:04d}", 'Branch_Name': f"สาขา {rnd.randint(1, 300)}",
+                'Weight': rnd.randint(1000, 25000),
+                'T1_Enter': times[0], 'T2_StartLoad': times[1], 'T3_EndLoad': times[2], 'T4_SubmitDoc': times[3],
+                'T5_RecvDoc': times[4], 'T6_Exit': times[5], 'T7_ArriveBranch': times[6], 'T8_EndJob': times[7],
+                'Status': 'Done', 'PO_Nos': '', 'Doc_Result': '', 'Weight_Result': ''
+            })
+    return jobs
+
+
+def bench(client, url, repeat):
+    best = None
+    pages = 0
+    for _ in range(repeat):
+        # ปิด Cache ของไฟล์ Export (ถ้ามี) เพื่อวัดเวลาการสร้างจริง
+        if hasattr(lmt_app, 'ARTIFACT_CACHE_MAX_BYTES'):
+            lmt_app.ARTIFACT_CACHE_MAX_BYTES = 0
+        start = time.perf_counter()
+        resp = client.get(url)
+        elapsed = time.perf_counter() - start
+        assert resp.status_code == 200, resp.status_code
+        pages = len(PAGE_RE.findall(resp.data))
+        best = elapsed if best is None else min(best, elapsed)
+    return pages, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trips', type=int, nargs='+', default=[50, 200, 800])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    warnings.simplefilter('ignore')
+    client = lmt_app.app.test_client()
+    print(f"{'route':<22}{'trips':>7}{'pages':>7}{'seconds':>10}{'pages/s':>10}")
+    for n_trips in args.trips:
+        fake = FakeSpreadsheet(make_jobs(n_trips))
+        lmt_app.get_db = lambda: fake
+        for name in lmt_app.cache_storage:
+            lmt_app.invalidate_cache(name)
+        for route in ('/export_pdf', '/export_pdf_summary'):
+            pages, secs = bench(client, f"{route}?date_filter={BENCH_DATE}", args.repeat)
+            print(f"{route:<22}{n_trips:>7}{pages:>7}{secs:>10.3f}{pages / secs:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
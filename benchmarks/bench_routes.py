@@ -0,0 +1,206 @@
+"""
+Benchmark: เวลาตอบสนอง (p50/p90/p99) และหน่วยความจำสูงสุดของทุกหน้า เมื่อ Jobs มีจำนวนแถวต่าง ๆ
+
+ใช้ In-memory Backend (use_memory_backend) กับข้อมูล Jobs/Drivers สังเคราะห์ ไม่ต้องเชื่อมต่อ Google Sheets
+    python benchmarks/bench_routes.py [--rows 10000 100000 500000] [--repeat 20] [--routes manager driver_tasks]
+    python benchmarks/bench_routes.py --save before.json            # เก็บผล (พร้อม Commit ปัจจุบัน)
+    python benchmarks/bench_routes.py --compare before.json         # เทียบกับผลที่เก็บไว้
+
+แต่ละหน้าวัด 2 แบบ
+    warm = เรียกซ้ำโดยข้อมูลไม่เปลี่ยน (ใช้ Cache ทั้งหมด)
+    cold = แก้ข้อมูล 1 ช่องในวันที่ทดสอบก่อนทุกครั้ง (เหมือนคนขับเพิ่งกดบันทึก แล้วผู้จัดการเปิดหน้า)
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+import warnings
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import app as lmt_app  # noqa: E402
+
+JOBS_HEADER = ['PO_Date', 'Load_Date', 'Round', 'Car_No', 'Driver', 'Plate', 'Branch_Name', 'Weight',
+               'T1_Enter', 'T2_StartLoad', 'T3_EndLoad', 'T4_SubmitDoc', 'T5_RecvDoc', 'T6_Exit', 'T7_ArriveBranch',
+               'T8_EndJob', 'Status', 'L1_Loc', 'L2_Loc', 'L3_Loc', 'L4_Loc', 'L5_Loc', 'L6_Loc', 'L7_Loc', 'L8_Loc',
+               'PO_Nos', 'Doc_Result', 'Weight_Result']
+ROUNDS = ['06:00', '07:30', '09:00', '11:00', '13:00', '16:00', '19:00', '21:30', '23:00', '01:00', '03:00']
+N_DRIVERS = 80
+
+ROUTES = {
+    'manager': '/manager?date_filter={date}',
+    'driver_select': '/driver',
+    'driver_tasks': '/driver/tasks?name={driver}',
+    'calendar': '/calendar?year={year}&month={month}',
+    'export_excel': '/export_excel?date_filter={date}',
+    'export_pdf': '/export_pdf?date_filter={date}',
+    'export_pdf_summary': '/export_pdf_summary?date_filter={date}',
+}
+
+
+def make_dataset(n_rows, rows_per_day, today, seed=11):
+    """
+    Jobs สังเคราะห์ n_rows แถว (เที่ยวละ 1-4 สาขา มีรอบกลางคืน) ย้อนหลังจนถึงพรุ่งนี้ วันละประมาณ rows_per_day แถว
+    วันที่ผ่านมาแล้ว = Done ทั้งหมด, วันนี้ = ทำไปบางส่วน, พรุ่งนี้ = New
+    """
+    rnd = random.Random(seed)
+    n_days = max(1, -(-n_rows // rows_per_day))
+    first_day = today + timedelta(days=1 - n_days + 1)
+    rows = [JOBS_HEADER]
+    day, car, day_rows = 0, 0, 0
+    while len(rows) - 1 < n_rows:
+        if day_rows >= rows_per_day and day < n_days - 1:
+            day, car, day_rows = day + 1, 0, 0
+        po_date = first_day + timedelta(days=day)
+        car += 1
+        round_t = rnd.choice(ROUNDS)
+        hour = int(round_t[:2])
+        driver = f"คนขับ {rnd.randint(1, N_DRIVERS)}"
+        progress = 8 if po_date < today else (rnd.randint(0, 8) if po_date == today else 0)
+        po_nos = ','.join(f"75{rnd.randint(1000000, 9999999)}" for _ in range(rnd.randint(0, 3)))
+        for _ in range(rnd.randint(1, 4)):
+            times = [f"{(hour + k) % 24:02d}:{rnd.randint(0, 59):02d}" if k < progress else '' for k in range(8)]
+            locs = ['13.7,100.5' if t else '' for t in times]
+            load_date = po_date + timedelta(days=1) if hour < 6 else po_date
+            rows.append([po_date.strftime('%Y-%m-%d'), load_date.strftime('%Y-%m-%d'), round_t, str(car), driver,
+                         f"70-{rnd.randint(1000, 9999)}", f"สาขา {rnd.randint(1, 400)}", str(rnd.randint(1000, 25000))]
+                        + times + ['Done' if progress == 8 else 'New'] + locs + [po_nos, '', ''])
+            day_rows += 1
+            if len(rows) - 1 >= n_rows: break
+
+    drivers = [['Name', 'Plate_License']] + [[f"คนขับ {i}", f"70-{1000 + i}"] for i in range(1, N_DRIVERS + 1)]
+    users = [['Username', 'Password'], ['bench', 'bench']]
+    return {'Jobs': rows, 'Drivers': drivers, 'Users': users}
+
+
+def busiest_driver(rows, date):
+    counts = {}
+    for r in rows[1:]:
+        if r[0] == date: counts[r[4]] = counts.get(r[4], 0) + 1
+    return max(counts, key=counts.get) if counts else rows[1][4]
+
+
+def touch_jobs(sheet, row_ids, state):
+    """แก้ 1 ช่องในวันที่ทดสอบ (สลับค่า Weight_Result) ให้ Version ของ Jobs เปลี่ยนจริง"""
+    state['i'] += 1
+    row_id = row_ids[state['i'] % len(row_ids)]
+    ws = sheet.worksheet('Jobs')
+    ws.update_cell(row_id, JOBS_HEADER.index('Weight_Result') + 1, str(state['i']))
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def run_route(client, url, repeat, before=None):
+    timings = []
+    for _ in range(repeat):
+        if before: before()
+        start = time.perf_counter()
+        resp = client.get(url)
+        timings.append(time.perf_counter() - start)
+        assert resp.status_code == 200, (url, resp.status_code)
+    return timings
+
+
+def peak_memory(client, url, before):
+    """หน่วยความจำสูงสุด (MB) ระหว่างเรียกหน้าแบบ cold 1 ครั้ง (tracemalloc)"""
+    before()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        resp = client.get(url)
+        assert resp.status_code == 200, (url, resp.status_code)
+        return tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    finally:
+        tracemalloc.stop()
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(__file__),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 500000])
+    parser.add_argument('--rows-per-day', type=int, default=800)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--routes', nargs='+', choices=sorted(ROUTES), default=list(ROUTES))
+    parser.add_argument('--no-memory', action='store_true', help='ไม่วัดหน่วยความจำ (tracemalloc ทำให้ช้าลง)')
+    parser.add_argument('--save', help='บันทึกผลเป็น JSON')
+    parser.add_argument('--compare', help='JSON ผลเดิมที่จะเทียบ (จาก --save)')
+    args = parser.parse_args()
+
+    warnings.simplefilter('ignore')
+    lmt_app.send_discord_msg = lambda msg: None
+    # วัดเวลาสร้างไฟล์จริงทุกครั้งที่ข้อมูลเปลี่ยน (ไม่ใช้ Export Cache ข้ามรอบ)
+    lmt_app.ARTIFACT_CACHE_MAX_BYTES = 0
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = {(r['route'], r['rows'], r['mode']): r for r in json.load(f)['results']}
+
+    today = (datetime.now() + timedelta(hours=7)).date()
+    results = []
+    header = f"{'route':<20}{'rows':>8}{'mode':>6}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}{'peak MB':>9}"
+    print(header + ('  vs p50' if baseline else ''), flush=True)
+    for n_rows in args.rows:
+        data = make_dataset(n_rows, args.rows_per_day, today)
+        date = today.strftime('%Y-%m-%d')
+        params = {'date': date, 'driver': busiest_driver(data['Jobs'], date), 'year': today.year, 'month': today.month}
+        today_rows = [i + 1 for i, r in enumerate(data['Jobs']) if r[0] == date] or [2]
+        sheet = lmt_app.use_memory_backend(data)
+        del data
+        gc.collect()
+
+        client = lmt_app.app.test_client()
+        with client.session_transaction() as sess:
+            sess['user'] = 'bench'
+        state = {'i': 0}
+        touch = lambda: touch_jobs(sheet, today_rows, state)  # noqa: E731
+
+        for name in args.routes:
+            url = ROUTES[name].format(**params)
+            client.get(url)  # โหลดข้อมูลเข้า Cache ก่อนเริ่มจับเวลา
+            peak = None if args.no_memory else peak_memory(client, url, touch)
+            for mode, before in (('warm', None), ('cold', touch)):
+                timings = run_route(client, url, args.repeat, before)
+                row = {'route': name, 'rows': n_rows, 'mode': mode,
+                       'p50': percentile(timings, 50) * 1000, 'p90': percentile(timings, 90) * 1000,
+                       'p99': percentile(timings, 99) * 1000, 'max': max(timings) * 1000,
+                       'peak_mb': peak if mode == 'cold' else None}
+                results.append(row)
+                peak_txt = f"{row['peak_mb']:>9.1f}" if row['peak_mb'] is not None else f"{'-':>9}"
+                line = (f"{name:<20}{n_rows:>8}{mode:>6}{row['p50']:>10.1f}{row['p90']:>10.1f}"
+                        f"{row['p99']:>10.1f}{row['max']:>10.1f}{peak_txt}")
+                old = baseline.get((name, n_rows, mode))
+                if old and old['p50']:
+                    line += f"  {(row['p50'] - old['p50']) / old['p50'] * 100:+7.1f}%"
+                print(line, flush=True)
+
+        lmt_app.use_memory_backend({})
+        del sheet, touch
+        gc.collect()
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump({'commit': current_commit(), 'created_at': datetime.now().isoformat(timespec='seconds'),
+                       'repeat': args.repeat, 'results': results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()